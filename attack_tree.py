@@ -1,11 +1,37 @@
+import json
 import re
-import requests
 import streamlit as st
-from mistralai import Mistral
-from openai import OpenAI, AzureOpenAI
+
+from llm_clients import get_async_azure_openai_client, get_async_http_client, get_async_mistral_client, get_async_openai_client, get_azure_openai_client, get_http_session, get_mistral_client, get_openai_client, provider_limit
+from llm_cache import cached_generation, cached_stream
+
+# System prompt shared by all providers
+ATTACK_TREE_SYSTEM_PROMPT = """
+Act as a cyber security expert with more than 20 years experience of using the STRIDE threat modelling methodology to produce comprehensive threat models for a wide range of applications. Your task is to use the application description provided to you to produce an attack tree in Mermaid syntax. The attack tree should reflect the potential threats for the application based on the details given.
+
+You MUST only respond with the Mermaid code block. See below for a simple example of the required format and syntax for your output.
+
+```mermaid
+graph TD
+    A[Enter Chart Definition] --> B(Preview)
+    B --> C{{decide}}
+    C --> D["Keep"]
+    C --> E["Edit Definition (Edit)"]
+    E --> B
+    D --> F["Save Image and Code"]
+    F --> B
+```
+
+IMPORTANT: Round brackets are special characters in Mermaid syntax. If you want to use round brackets inside a node label you MUST wrap the label in double quotes. For example, ["Example Node Label (ENL)"].
+"""
+
+# Function to remove the Markdown code block delimiters around Mermaid code
+def strip_mermaid_code_block(attack_tree_code):
+    return re.sub(r'^```mermaid\s*|\s*```$', '', attack_tree_code, flags=re.MULTILINE)
 
 # Function to create a prompt to generate an attack tree
 def create_attack_tree_prompt(app_type, authentication, internet_facing, sensitive_data, app_input,selected_data_classes,deployment_infra,data_storage_location):
+    data_classes_str = ", ".join(selected_data_classes) if selected_data_classes else "None"
     prompt = f"""
 APPLICATION TYPE: {app_type}
 AUTHENTICATION METHODS: {authentication}
@@ -18,30 +44,14 @@ APPLICATION DESCRIPTION: {app_input}
 
 
 # Function to get attack tree from the GPT response.
+@cached_generation("openai")
 def get_attack_tree(api_key, model_name, prompt):
-    client = OpenAI(api_key=api_key)
+    client = get_openai_client(api_key)
 
     response = client.chat.completions.create(
         model=model_name,
         messages=[
-            {"role": "system", "content": """
-Act as a cyber security expert with more than 20 years experience of using the STRIDE threat modelling methodology to produce comprehensive threat models for a wide range of applications. Your task is to use the application description provided to you to produce an attack tree in Mermaid syntax. The attack tree should reflect the potential threats for the application based on the details given.
-
-You MUST only respond with the Mermaid code block. See below for a simple example of the required format and syntax for your output.
-
-```mermaid
-graph TD
-    A[Enter Chart Definition] --> B(Preview)
-    B --> C{{decide}}
-    C --> D["Keep"]
-    C --> E["Edit Definition (Edit)"]
-    E --> B
-    D --> F["Save Image and Code"]
-    F --> B
-```
-
-IMPORTANT: Round brackets are special characters in Mermaid syntax. If you want to use round brackets inside a node label you MUST wrap the label in double quotes. For example, ["Example Node Label (ENL)"].
-"""},
+            {"role": "system", "content": ATTACK_TREE_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ]
     )
@@ -55,34 +65,14 @@ IMPORTANT: Round brackets are special characters in Mermaid syntax. If you want
     return attack_tree_code
 
 # Function to get attack tree from the Azure OpenAI response.
+@cached_generation("azure")
 def get_attack_tree_azure(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, prompt):
-    client = AzureOpenAI(
-        azure_endpoint = azure_api_endpoint,
-        api_key = azure_api_key,
-        api_version = azure_api_version,
-    )
+    client = get_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version)
 
     response = client.chat.completions.create(
         model = azure_deployment_name,
         messages=[
-            {"role": "system", "content": """
-Act as a cyber security expert with more than 20 years experience of using the STRIDE threat modelling methodology to produce comprehensive threat models for a wide range of applications. Your task is to use the application description provided to you to produce an attack tree in Mermaid syntax. The attack tree should reflect the potential threats for the application based on the details given.
-
-You MUST only respond with the Mermaid code block. See below for a simple example of the required format and syntax for your output.
-
-```mermaid
-graph TD
-    A[Enter Chart Definition] --> B(Preview)
-    B --> C{{decide}}
-    C --> D["Keep"]
-    C --> E["Edit Definition (Edit)"]
-    E --> B
-    D --> F["Save Image and Code"]
-    F --> B
-```
-
-IMPORTANT: Round brackets are special characters in Mermaid syntax. If you want to use round brackets inside a node label you MUST wrap the label in double quotes. For example, ["Example Node Label (ENL)"].
-"""},
+            {"role": "system", "content": ATTACK_TREE_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ]
     )
@@ -96,30 +86,14 @@ IMPORTANT: Round brackets are special characters in Mermaid syntax. If you want
     return attack_tree_code
 
 # Function to get attack tree from the Mistral model's response.
+@cached_generation("mistral")
 def get_attack_tree_mistral(mistral_api_key, mistral_model, prompt):
-    client = Mistral(api_key=mistral_api_key)
+    client = get_mistral_client(mistral_api_key)
 
     response = client.chat.complete(
         model=mistral_model,
         messages=[
-            {"role": "system", "content": """
-Act as a cyber security expert with more than 20 years experience of using the STRIDE threat modelling methodology to produce comprehensive threat models for a wide range of applications. Your task is to use the application description provided to you to produce an attack tree in Mermaid syntax. The attack tree should reflect the potential threats for the application based on the details given.
-
-You MUST only respond with the Mermaid code block. See below for a simple example of the required format and syntax for your output.
-
-```mermaid
-graph TD
-    A[Enter Chart Definition] --> B(Preview)
-    B --> C{{decide}}
-    C --> D["Keep"]
-    C --> E["Edit Definition (Edit)"]
-    E --> B
-    D --> F["Save Image and Code"]
-    F --> B
-```
-
-IMPORTANT: Round brackets are special characters in Mermaid syntax. If you want to use round brackets inside a node label you MUST wrap the label in double quotes. For example, ["Example Node Label (ENL)"].
-"""},
+            {"role": "system", "content": ATTACK_TREE_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ]
     )
@@ -133,6 +107,7 @@ IMPORTANT: Round brackets are special characters in Mermaid syntax. If you want
     return attack_tree_code
 
 # Function to get attack tree from Ollama hosted LLM.
+@cached_generation("ollama")
 def get_attack_tree_ollama(ollama_model, prompt):
 
     url = "http://localhost:11434/api/chat"
@@ -143,31 +118,14 @@ def get_attack_tree_ollama(ollama_model, prompt):
         "messages": [
             {
                 "role": "system",
-                "content": """
-Act as a cyber security expert with more than 20 years experience of using the STRIDE threat modelling methodology to produce comprehensive threat models for a wide range of applications. Your task is to use the application description provided to you to produce an attack tree in Mermaid syntax. The attack tree should reflect the potential threats for the application based on the details given.
-
-You MUST only respond with the Mermaid code block. See below for a simple example of the required format and syntax for your output.
-
-```mermaid
-graph TD
-    A[Enter Chart Definition] --> B(Preview)
-    B --> C{{decide}}
-    C --> D["Keep"]
-    C --> E["Edit Definition (Edit)"]
-    E --> B
-    D --> F["Save Image and Code"]
-    F --> B
-```
-
-IMPORTANT: Round brackets are special characters in Mermaid syntax. If you want to use round brackets inside a node label you MUST wrap the label in double quotes. For example, ["Example Node Label (ENL)"].
-"""},
+                "content": ATTACK_TREE_SYSTEM_PROMPT},
             {
                 "role": "user",
                 "content": prompt
             }
         ]
     }
-    response = requests.post(url, json=data)
+    response = get_http_session().post(url, json=data)
 
     outer_json = response.json()
 
@@ -178,3 +136,148 @@ IMPORTANT: Round brackets are special characters in Mermaid syntax. If you want
     attack_tree_code = re.sub(r'^```mermaid\s*|\s*```$', '', attack_tree_code, flags=re.MULTILINE)
 
     return attack_tree_code
+
+# Async variants of the functions above, for running several generations at once from one event loop.
+# Each provider's requests are limited by its semaphore in llm_clients.
+
+@cached_generation("openai")
+async def get_attack_tree_async(api_key, model_name, prompt):
+    client = get_async_openai_client(api_key)
+
+    async with provider_limit("openai"):
+        response = await client.chat.completions.create(
+            model=model_name,
+            messages=[
+                {"role": "system", "content": ATTACK_TREE_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
+        )
+
+    # Remove Markdown code block delimiters using regular expression
+    return re.sub(r'^```mermaid\s*|\s*```$', '', response.choices[0].message.content, flags=re.MULTILINE)
+
+@cached_generation("azure")
+async def get_attack_tree_azure_async(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, prompt):
+    client = get_async_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version)
+
+    async with provider_limit("azure"):
+        response = await client.chat.completions.create(
+            model = azure_deployment_name,
+            messages=[
+                {"role": "system", "content": ATTACK_TREE_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
+        )
+
+    # Remove Markdown code block delimiters using regular expression
+    return re.sub(r'^```mermaid\s*|\s*```$', '', response.choices[0].message.content, flags=re.MULTILINE)
+
+@cached_generation("mistral")
+async def get_attack_tree_mistral_async(mistral_api_key, mistral_model, prompt):
+    client = get_async_mistral_client(mistral_api_key)
+
+    async with provider_limit("mistral"):
+        response = await client.chat.complete_async(
+            model=mistral_model,
+            messages=[
+                {"role": "system", "content": ATTACK_TREE_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
+        )
+
+    # Remove Markdown code block delimiters using regular expression
+    return re.sub(r'^```mermaid\s*|\s*```$', '', response.choices[0].message.content, flags=re.MULTILINE)
+
+@cached_generation("ollama")
+async def get_attack_tree_ollama_async(ollama_model, prompt):
+    url = "http://localhost:11434/api/chat"
+
+    data = {
+        "model": ollama_model,
+        "stream": False,
+        "messages": [
+            {"role": "system", "content": ATTACK_TREE_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    }
+
+    async with provider_limit("ollama"):
+        response = await get_async_http_client().post(url, json=data)
+
+    # Remove Markdown code block delimiters using regular expression
+    return re.sub(r'^```mermaid\s*|\s*```$', '', response.json()["message"]["content"], flags=re.MULTILINE)
+
+# Streaming variants of the functions above, yielding the response text as it is generated.
+# They share their cache entries with the non-streaming functions.
+
+@cached_stream("openai", get_attack_tree, postprocess=strip_mermaid_code_block)
+def get_attack_tree_stream(api_key, model_name, prompt):
+    client = get_openai_client(api_key)
+
+    with client.chat.completions.create(
+        model = model_name,
+        messages=[
+            {"role": "system", "content": ATTACK_TREE_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        stream=True,
+    ) as stream:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+@cached_stream("azure", get_attack_tree_azure, postprocess=strip_mermaid_code_block)
+def get_attack_tree_azure_stream(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, prompt):
+    client = get_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version)
+
+    with client.chat.completions.create(
+        model = azure_deployment_name,
+        messages=[
+            {"role": "system", "content": ATTACK_TREE_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        stream=True,
+    ) as stream:
+        for chunk in stream:
+            # Azure sends chunks without choices for its content filter results
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+@cached_stream("mistral", get_attack_tree_mistral, postprocess=strip_mermaid_code_block)
+def get_attack_tree_mistral_stream(mistral_api_key, mistral_model, prompt):
+    client = get_mistral_client(mistral_api_key)
+
+    stream = client.chat.stream(
+        model = mistral_model,
+        messages=[
+            {"role": "system", "content": ATTACK_TREE_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    )
+    for event in stream:
+        if event.data.choices and event.data.choices[0].delta.content:
+            yield event.data.choices[0].delta.content
+
+@cached_stream("ollama", get_attack_tree_ollama, postprocess=strip_mermaid_code_block)
+def get_attack_tree_ollama_stream(ollama_model, prompt):
+    url = "http://localhost:11434/api/chat"
+
+    data = {
+        "model": ollama_model,
+        "stream": True,
+        "messages": [
+            {"role": "system", "content": ATTACK_TREE_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    }
+
+    # Ollama streams one JSON object per line, the last one has "done" set
+    with get_http_session().post(url, json=data, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                message = json.loads(line)
+                if message.get("message", {}).get("content"):
+                    yield message["message"]["content"]
+                if message.get("done"):
+                    break
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import zlib
+
+import numpy as np
+
+# Default location of the persisted indexes and the number of indexes kept, can be overridden with
+# CODE_INDEX_PATH and CODE_INDEX_MAX_INDEXES
+DEFAULT_INDEX_PATH = os.path.join(os.path.expanduser("~"), ".cache", "genai4dso", "indexes")
+DEFAULT_MAX_INDEXES = 8
+
+# Number of hashed features per vector. Features are hashed with a sign, so collisions cancel out on average
+# instead of adding to the scores.
+DIMENSIONS = 4096
+
+# Chunks scoring below this are never returned, weaker matches are mostly hash collisions
+MIN_SCORE = 0.05
+
+# Lines per chunk of a file summary
+CHUNK_LINES = 30
+
+# Bump when the tokenizer or the features change so persisted indexes are rebuilt
+INDEX_VERSION = "1"
+
+# Token budget of the repository description when the relevant code is retrieved from the index instead
+DESCRIPTION_TOKEN_BUDGET = 6000
+
+# Characters of file summaries indexed per repository, files beyond it are not read for the index
+MAX_INDEXED_CHARS = 4 * 1024 * 1024
+
+TOKEN_PATTERN = re.compile(r'[A-Za-z][a-z]+|[A-Z]+(?![a-z])')
+
+# Function to split text into lower-case word tokens, identifiers are split on camelCase and snake_case
+def tokenize(text):
+    return [token.lower() for token in TOKEN_PATTERN.findall(text)]
+
+# Function to map text to the ids and signs of its hashed unigram and bigram features
+def hashed_features(text):
+    tokens = tokenize(text)
+    features = tokens + [f"{first} {second}" for first, second in zip(tokens, tokens[1:])]
+    hashes = np.array([zlib.crc32(feature.encode()) for feature in features], dtype=np.int64)
+    return hashes % DIMENSIONS, np.where(hashes & (1 << 31), -1.0, 1.0).astype(np.float32)
+
+# Function to turn the hashed features of a text into a sublinear TF vector, keeping the sign of each slot
+def term_frequencies(text):
+    vector = np.zeros(DIMENSIONS, dtype=np.float32)
+    ids, signs = hashed_features(text)
+    np.add.at(vector, ids, signs)
+    return np.sign(vector) * np.log1p(np.abs(vector))
+
+# Function to split (path, text) pairs into chunks of at most CHUNK_LINES lines
+def chunk_documents(documents):
+    chunks = []
+    for path, text in documents:
+        lines = text.splitlines()
+        for start in range(0, max(1, len(lines)), CHUNK_LINES):
+            chunk = "\n".join(lines[start:start + CHUNK_LINES]).strip()
+            if chunk:
+                chunks.append((path, chunk))
+    return chunks
+
+# Function to pass (path, summary) pairs through while appending them to indexed, until max_chars of summaries
+# have been indexed. The pairs are read lazily, so nothing past the budget is fetched or summarized.
+def iter_indexed(summaries, indexed, max_chars=MAX_INDEXED_CHARS):
+    chars = 0
+    for path, summary in summaries:
+        indexed.append((path, summary))
+        yield path, summary
+        chars += len(summary or "")
+        if chars > max_chars:
+            print(f"Indexed {len(indexed)} files, the remaining files exceed the index budget of {max_chars} characters")
+            return
+
+# Function to load the persisted index of a set of documents, or build and persist it when there is none.
+# Indexes are stored under a hash of their chunks, so any change to the documents builds a new one.
+def load_or_build_code_index(documents, index_path=None, max_indexes=None):
+    index_path = index_path or os.getenv("CODE_INDEX_PATH", DEFAULT_INDEX_PATH)
+    max_indexes = max_indexes or int(os.getenv("CODE_INDEX_MAX_INDEXES", DEFAULT_MAX_INDEXES))
+
+    chunks = chunk_documents(documents)
+    digest = hashlib.sha256(json.dumps([INDEX_VERSION, chunks]).encode()).hexdigest()
+    directory = os.path.join(index_path, digest)
+
+    if os.path.isfile(os.path.join(directory, "chunks.json")):
+        os.utime(directory)
+        return CodeIndex.load(directory)
+
+    index = CodeIndex.build(chunks)
+    index.save(directory)
+    prune_indexes(index_path, max_indexes)
+    return index
+
+# Function to delete all but the most recently used persisted indexes
+def prune_indexes(index_path, max_indexes):
+    directories = sorted(
+        (entry for entry in os.scandir(index_path) if entry.is_dir() and not entry.name.endswith(".tmp")),
+        key=lambda entry: entry.stat().st_mtime,
+        reverse=True,
+    )
+    for entry in directories[max_indexes:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+# Vector index of text chunks embedded as L2-normalized hashed n-gram TF-IDF vectors.
+# Searching is a single matrix-vector product, and persisted vectors are memory-mapped when loaded.
+class CodeIndex:
+    def __init__(self, chunks, vectors, idf):
+        self.chunks = chunks
+        self.vectors = vectors
+        self.idf = idf
+
+    @classmethod
+    def build(cls, chunks):
+        vectors = np.zeros((len(chunks), DIMENSIONS), dtype=np.float32)
+        for row, (path, text) in enumerate(chunks):
+            # The path is indexed with the chunk, so a query for "auth" also finds auth/ and login_handler.py
+            vectors[row] = term_frequencies(f"{path}\n{text}")
+
+        document_frequency = np.count_nonzero(vectors, axis=0)
+        idf = (np.log((1 + len(chunks)) / (1 + document_frequency)) + 1).astype(np.float32)
+
+        vectors *= idf
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.maximum(norms, 1e-12)
+        return cls(chunks, vectors, idf)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, "chunks.json"), encoding="utf-8") as f:
+            chunks = [tuple(chunk) for chunk in json.load(f)]
+        vectors = np.load(os.path.join(directory, "vectors.npy"), mmap_mode="r")
+        idf = np.load(os.path.join(directory, "idf.npy"))
+        return cls(chunks, vectors, idf)
+
+    def save(self, directory):
+        # Write to a temporary directory first so a concurrent load never sees a partial index
+        temporary = f"{directory}.{os.getpid()}.tmp"
+        os.makedirs(temporary, exist_ok=True)
+        np.save(os.path.join(temporary, "vectors.npy"), self.vectors)
+        np.save(os.path.join(temporary, "idf.npy"), self.idf)
+        with open(os.path.join(temporary, "chunks.json"), "w", encoding="utf-8") as f:
+            json.dump(self.chunks, f)
+        try:
+            os.replace(temporary, directory)
+        except OSError:
+            # Another session persisted the same index in the meantime
+            shutil.rmtree(temporary, ignore_errors=True)
+
+    def embed(self, text):
+        vector = term_frequencies(text) * self.idf
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    # Returns the (score, path, text) of the k chunks most similar to the query, best first
+    def search(self, query, k=5):
+        if not self.chunks:
+            return []
+        scores = self.vectors @ self.embed(query)
+        k = min(k, len(self.chunks))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), *self.chunks[i]) for i in top if scores[i] >= MIN_SCORE]
+
+    def __len__(self):
+        return len(self.chunks)
@@ -1,31 +1,49 @@
 import json
-import requests
-import time
-from mistralai import Mistral, UserMessage
-from openai import OpenAI, AzureOpenAI
+from mistralai import UserMessage
 import streamlit as st
 
 import google.generativeai as genai
 
+from llm_clients import configure_google, get_async_azure_openai_client, get_async_http_client, get_async_mistral_client, get_async_openai_client, get_azure_openai_client, get_http_session, get_mistral_client, get_openai_client, google_request_options, provider_limit
+from llm_cache import cached_generation, cached_stream
+from json_stream import parse_json_response
+
+# System prompts, shared by the sync, async and streaming variants so that they share cache entries.
+# Google gets its instructions as the first turn of a chat, which the model acknowledges.
+DREAD_SYSTEM_PROMPT = "You are a helpful assistant designed to output JSON."
+DREAD_GOOGLE_SYSTEM_PROMPT = "You are a helpful assistant designed to output JSON. Only provide the DREAD risk assessment in JSON format with no additional text. Do not wrap the output in a code block."
+DREAD_GOOGLE_ACKNOWLEDGEMENT = "Understood. I will provide DREAD risk assessments in JSON format only and will not wrap the output in a code block."
+DREAD_OLLAMA_SYSTEM_PROMPT = "You are a helpful assistant designed to output JSON. Only provide the DREAD risk assessment in JSON format with no additional text."
+
+# Table header of the Markdown DREAD assessment
+DREAD_MARKDOWN_HEADER = (
+    "| Threat Type | Scenario | Damage Potential | Reproducibility | Exploitability | Affected Users | Discoverability | Risk Score |\n"
+    "|-------------|----------|------------------|-----------------|----------------|----------------|-----------------|-------------|\n"
+)
+
+# Function to convert the assessment of one threat to a row of the Markdown DREAD table,
+# rows can be appended as the assessment is streamed
+def dread_markdown_row(threat):
+    damage_potential = threat.get('Damage Potential', 0)
+    reproducibility = threat.get('Reproducibility', 0)
+    exploitability = threat.get('Exploitability', 0)
+    affected_users = threat.get('Affected Users', 0)
+    discoverability = threat.get('Discoverability', 0)
+
+    # Calculate the Risk Score
+    risk_score = (damage_potential + reproducibility + exploitability + affected_users + discoverability) / 5
+
+    return f"| {threat.get('Threat Type', 'N/A')} | {threat.get('Scenario', 'N/A')} | {damage_potential} | {reproducibility} | {exploitability} | {affected_users} | {discoverability} | {risk_score:.2f} |\n"
+
 def dread_json_to_markdown(dread_assessment):
-    markdown_output = "| Threat Type | Scenario | Damage Potential | Reproducibility | Exploitability | Affected Users | Discoverability | Risk Score |\n"
-    markdown_output += "|-------------|----------|------------------|-----------------|----------------|----------------|-----------------|-------------|\n"
+    markdown_output = DREAD_MARKDOWN_HEADER
     try:
         # Access the list of threats under the "Risk Assessment" key
         threats = dread_assessment.get("Risk Assessment", [])
         for threat in threats:
             # Check if threat is a dictionary
             if isinstance(threat, dict):
-                damage_potential = threat.get('Damage Potential', 0)
-                reproducibility = threat.get('Reproducibility', 0)
-                exploitability = threat.get('Exploitability', 0)
-                affected_users = threat.get('Affected Users', 0)
-                discoverability = threat.get('Discoverability', 0)
-
-                # Calculate the Risk Score
-                risk_score = (damage_potential + reproducibility + exploitability + affected_users + discoverability) / 5
-
-                markdown_output += f"| {threat.get('Threat Type', 'N/A')} | {threat.get('Scenario', 'N/A')} | {damage_potential} | {reproducibility} | {exploitability} | {affected_users} | {discoverability} | {risk_score:.2f} |\n"
+                markdown_output += dread_markdown_row(threat)
             else:
                 raise TypeError(f"Expected a dictionary, got {type(threat)}: {threat}")
     except Exception as e:
@@ -81,13 +99,14 @@ Ensure the JSON response is correctly formatted and does not contain any additio
     return prompt
 
 # Function to get DREAD risk assessment from the GPT response.
+@cached_generation("openai")
 def get_dread_assessment(api_key, model_name, prompt):
-    client = OpenAI(api_key=api_key)
+    client = get_openai_client(api_key)
     response = client.chat.completions.create(
         model=model_name,
         response_format={"type": "json_object"},
         messages=[
-            {"role": "system", "content": "You are a helpful assistant designed to output JSON."},
+            {"role": "system", "content": DREAD_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ]
     )
@@ -102,18 +121,15 @@ def get_dread_assessment(api_key, model_name, prompt):
     return dread_assessment
 
 # Function to get DREAD risk assessment from the Azure OpenAI response.
+@cached_generation("azure")
 def get_dread_assessment_azure(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, prompt):
-    client = AzureOpenAI(
-        azure_endpoint = azure_api_endpoint,
-        api_key = azure_api_key,
-        api_version = azure_api_version,
-    )
+    client = get_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version)
 
     response = client.chat.completions.create(
         model = azure_deployment_name,
         response_format={"type": "json_object"},
         messages=[
-            {"role": "system", "content": "You are a helpful assistant designed to output JSON."},
+            {"role": "system", "content": DREAD_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ]
     )
@@ -128,18 +144,16 @@ def get_dread_assessment_azure(azure_api_endpoint, azure_api_key, azure_api_vers
     return dread_assessment
 
 # Function to get DREAD risk assessment from the Google model's response.
+@cached_generation("google")
 def get_dread_assessment_google(google_api_key, google_model, prompt):
-    genai.configure(api_key=google_api_key)
+    configure_google(google_api_key)
 
     model = genai.GenerativeModel(google_model)
 
-    # Create the system message
-    system_message = "You are a helpful assistant designed to output JSON. Only provide the DREAD risk assessment in JSON format with no additional text. Do not wrap the output in a code block."
-
     # Start a chat session with the system message in the history
     chat = model.start_chat(history=[
-        {"role": "user", "parts": [system_message]},
-        {"role": "model", "parts": ["Understood. I will provide DREAD risk assessments in JSON format only and will not wrap the output in a code block."]}
+        {"role": "user", "parts": [DREAD_GOOGLE_SYSTEM_PROMPT]},
+        {"role": "model", "parts": [DREAD_GOOGLE_ACKNOWLEDGEMENT]}
     ])
 
     # Send the actual prompt
@@ -147,7 +161,8 @@ def get_dread_assessment_google(google_api_key, google_model, prompt):
         prompt,
         safety_settings={
             'DANGEROUS': 'block_only_high' # Set safety filter to allow generation of DREAD risk assessments
-        })
+        },
+        request_options=google_request_options())
     print(response)
 
     try:
@@ -161,8 +176,9 @@ def get_dread_assessment_google(google_api_key, google_model, prompt):
         return {}
 
 # Function to get DREAD risk assessment from the Mistral model's response.
+@cached_generation("mistral")
 def get_dread_assessment_mistral(mistral_api_key, mistral_model, prompt):
-    client = Mistral(api_key=mistral_api_key)
+    client = get_mistral_client(mistral_api_key)
 
     response = client.chat.complete(
         model=mistral_model,
@@ -184,57 +200,285 @@ def get_dread_assessment_mistral(mistral_api_key, mistral_model, prompt):
     return dread_assessment
 
 # Function to get DREAD risk assessment from Ollama hosted LLM.
+@cached_generation("ollama")
 def get_dread_assessment_ollama(ollama_model, prompt):
     url = "http://localhost:11434/api/chat"
-    max_retries = 3
-    retry_delay = 2  # seconds
     if not isinstance(prompt, str):
         st.error("Prompt should be a string.")
         return {}
 
-    for attempt in range(1, max_retries + 1):
-        data = {
-            "model": ollama_model,
-            "stream": False,
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "You are a helpful assistant designed to output JSON. Only provide the DREAD risk assessment in JSON format with no additional text."
-                },
-                {
-                    "role": "user",
-                    "content": prompt,
-                    "format": "json"
-                }
+    data = {
+        "model": ollama_model,
+        "stream": False,
+        "messages": [
+            {
+                "role": "system",
+                "content": DREAD_OLLAMA_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": prompt,
+                "format": "json"
+            }
+        ]
+    }
+
+    response = get_http_session().post(url, json=data)
+    response.raise_for_status()  # Check for HTTP errors, rate limits and server errors are retried by the controller
+    response_content = response.json().get("message", {}).get("content", "")  # Safely access content
+
+    try:
+        dread_assessment = json.loads(response_content)
+    except json.JSONDecodeError as e:
+        # Raised so that the controller asks the model again
+        print(f"Error decoding JSON: {str(e)}")
+        print("Raw JSON string:")
+        print(response_content)
+        raise
+
+    return dread_assessment
+
+# Async variants of the functions above, for running several generations at once from one event loop.
+# Each provider's requests are limited by its semaphore in llm_clients.
+# They run on the background loop of run_async, away from the Streamlit script thread, so invalid responses
+# are raised for the pipeline to report instead of being written to the page.
+
+@cached_generation("openai")
+async def get_dread_assessment_async(api_key, model_name, prompt):
+    client = get_async_openai_client(api_key)
+
+    async with provider_limit("openai"):
+        response = await client.chat.completions.create(
+            model=model_name,
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": DREAD_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
             ]
-        }
-
-        try:
-            response = requests.post(url, json=data)
-            response.raise_for_status()  # Check for HTTP errors
-            outer_json = response.json()
-            response_content = outer_json.get("message", {}).get("content", "")  # Safely access content
-
-            # Attempt to parse JSON
-            dread_assessment = json.loads(response_content)
-            return dread_assessment
-        except requests.exceptions.HTTPError as http_err:
-             st.error(f"Attempt {attempt}: HTTP error occurred: {http_err}")
-             print(f"HTTP error occurred: {http_err}")
-             print(f"Response: {response.text}")  # Log the full response
-
-        except json.JSONDecodeError as e:
-            st.error(f"Attempt {attempt}: Error decoding JSON. Retrying...")
-            print(f"Error decoding JSON: {str(e)}")
-            print("Raw JSON string:")
-            print(response_content)
-
-            if attempt < max_retries:
-                time.sleep(retry_delay)
-            else:
-                st.error("Max retries reached. Unable to generate valid JSON response.")
-                return {}
+        )
+
+    # Convert the JSON string in the 'content' field to a Python dictionary
+    try:
+        dread_assessment = json.loads(response.choices[0].message.content)
+    except json.JSONDecodeError as e:
+        print(f"Error decoding JSON: {str(e)}")
+        print("Raw JSON string:")
+        print(response.choices[0].message.content)
+        raise
+
+    return dread_assessment
+
+@cached_generation("azure")
+async def get_dread_assessment_azure_async(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, prompt):
+    client = get_async_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version)
+
+    async with provider_limit("azure"):
+        response = await client.chat.completions.create(
+            model = azure_deployment_name,
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": DREAD_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
+        )
+
+    # Convert the JSON string in the 'content' field to a Python dictionary
+    try:
+        dread_assessment = json.loads(response.choices[0].message.content)
+    except json.JSONDecodeError as e:
+        print(f"Error decoding JSON: {str(e)}")
+        print("Raw JSON string:")
+        print(response.choices[0].message.content)
+        raise
+
+    return dread_assessment
+
+@cached_generation("google")
+async def get_dread_assessment_google_async(google_api_key, google_model, prompt):
+    configure_google(google_api_key)
+
+    model = genai.GenerativeModel(google_model)
+
+    # Start a chat session with the system message in the history
+    chat = model.start_chat(history=[
+        {"role": "user", "parts": [DREAD_GOOGLE_SYSTEM_PROMPT]},
+        {"role": "model", "parts": [DREAD_GOOGLE_ACKNOWLEDGEMENT]}
+    ])
+
+    async with provider_limit("google"):
+        response = await chat.send_message_async(
+            prompt,
+            safety_settings={
+                'DANGEROUS': 'block_only_high' # Set safety filter to allow generation
+            },
+            request_options=google_request_options())
+
+    try:
+        # Access the JSON content from the response
+        return json.loads(response.text)
+    except json.JSONDecodeError as e:
+        print(f"Error decoding JSON: {str(e)}")
+        print("Raw JSON string:")
+        print(response.text)
+        raise
+
+@cached_generation("mistral")
+async def get_dread_assessment_mistral_async(mistral_api_key, mistral_model, prompt):
+    client = get_async_mistral_client(mistral_api_key)
+
+    async with provider_limit("mistral"):
+        response = await client.chat.complete_async(
+            model=mistral_model,
+            response_format={"type": "json_object"},
+            messages=[
+                UserMessage(content=prompt)
+            ]
+        )
+
+    try:
+        # Convert the JSON string in the 'content' field to a Python dictionary
+        dread_assessment = json.loads(response.choices[0].message.content)
+    except json.JSONDecodeError as e:
+        print(f"Error decoding JSON: {str(e)}")
+        print("Raw JSON string:")
+        print(response.choices[0].message.content)
+        raise
+
+    return dread_assessment
+
+@cached_generation("ollama")
+async def get_dread_assessment_ollama_async(ollama_model, prompt):
+    url = "http://localhost:11434/api/chat"
+    if not isinstance(prompt, str):
+        raise TypeError("Prompt should be a string.")
+
+    data = {
+        "model": ollama_model,
+        "stream": False,
+        "messages": [
+            {
+                "role": "system",
+                "content": DREAD_OLLAMA_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": prompt,
+                "format": "json"
+            }
+        ]
+    }
+
+    async with provider_limit("ollama"):
+        response = await get_async_http_client().post(url, json=data)
+    response.raise_for_status()  # Check for HTTP errors, rate limits and server errors are retried by the controller
+    response_content = response.json().get("message", {}).get("content", "")  # Safely access content
+
+    try:
+        return json.loads(response_content)
+    except json.JSONDecodeError as e:
+        # Raised so that the controller asks the model again
+        print(f"Error decoding JSON: {str(e)}")
+        print("Raw JSON string:")
+        print(response_content)
+        raise
+
+# Streaming variants of the functions above, yielding the JSON response text as it is generated so that
+# JsonArrayStream can parse each row as soon as it is complete.
+# They share their cache entries with the non-streaming functions.
+
+@cached_stream("openai", get_dread_assessment, postprocess=parse_json_response)
+def get_dread_assessment_stream(api_key, model_name, prompt):
+    client = get_openai_client(api_key)
+
+    with client.chat.completions.create(
+        model=model_name,
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": DREAD_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        stream=True,
+    ) as stream:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+@cached_stream("azure", get_dread_assessment_azure, postprocess=parse_json_response)
+def get_dread_assessment_azure_stream(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, prompt):
+    client = get_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version)
+
+    with client.chat.completions.create(
+        model = azure_deployment_name,
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": DREAD_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        stream=True,
+    ) as stream:
+        for chunk in stream:
+            # Azure sends chunks without choices for its content filter results
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+@cached_stream("google", get_dread_assessment_google, postprocess=parse_json_response)
+def get_dread_assessment_google_stream(google_api_key, google_model, prompt):
+    configure_google(google_api_key)
+
+    model = genai.GenerativeModel(google_model)
+
+    # Start a chat session with the system message in the history
+    chat = model.start_chat(history=[
+        {"role": "user", "parts": [DREAD_GOOGLE_SYSTEM_PROMPT]},
+        {"role": "model", "parts": [DREAD_GOOGLE_ACKNOWLEDGEMENT]}
+    ])
+
+    response = chat.send_message(
+        prompt,
+        safety_settings={
+            'DANGEROUS': 'block_only_high' # Set safety filter to allow generation of DREAD risk assessments
+        },
+        stream=True,
+        request_options=google_request_options())
+    for chunk in response:
+        if chunk.parts:
+            yield chunk.text
+
+@cached_stream("mistral", get_dread_assessment_mistral, postprocess=parse_json_response)
+def get_dread_assessment_mistral_stream(mistral_api_key, mistral_model, prompt):
+    client = get_mistral_client(mistral_api_key)
+
+    stream = client.chat.stream(
+        model = mistral_model,
+        response_format={"type": "json_object"},
+        messages=[
+            UserMessage(content=prompt)
+        ]
+    )
+    for event in stream:
+        if event.data.choices and event.data.choices[0].delta.content:
+            yield event.data.choices[0].delta.content
+
+@cached_stream("ollama", get_dread_assessment_ollama, postprocess=parse_json_response)
+def get_dread_assessment_ollama_stream(ollama_model, prompt):
+    url = "http://localhost:11434/api/chat"
+
+    data = {
+        "model": ollama_model,
+        "stream": True,
+        "messages": [
+            {"role": "system", "content": DREAD_OLLAMA_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt, "format": "json"}
+        ]
+    }
 
-    # This line should never be reached due to the return statements above,
-    # but it's here as a fallback
-    return {}
+    # Ollama streams one JSON object per line, the last one has "done" set
+    with get_http_session().post(url, json=data, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                message = json.loads(line)
+                if message.get("message", {}).get("content"):
+                    yield message["message"]["content"]
+                if message.get("done"):
+                    break
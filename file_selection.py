@@ -0,0 +1,136 @@
+import fnmatch
+import os
+import re
+from collections import defaultdict
+
+# Path tokens that point at security-relevant code, matched as prefixes of the path tokens
+SECURITY_PATH_HINTS = {
+    'auth': 8, 'login': 8, 'logout': 6, 'oauth': 8, 'saml': 8, 'sso': 8, 'jwt': 8, 'token': 7,
+    'session': 7, 'password': 8, 'passwd': 8, 'credential': 8, 'secret': 8, 'crypt': 7, 'security': 8,
+    'permission': 7, 'acl': 7, 'rbac': 7, 'role': 5, 'policy': 5, 'guard': 6, 'admin': 6, 'account': 5,
+    'user': 4, 'payment': 7, 'billing': 6, 'checkout': 6, 'upload': 6, 'download': 4, 'webhook': 6,
+    'api': 5, 'route': 6, 'router': 6, 'urls': 6, 'controller': 6, 'handler': 5, 'endpoint': 6,
+    'middleware': 7, 'views': 5, 'resource': 4, 'graphql': 6, 'rpc': 5, 'server': 5, 'gateway': 5,
+    'app': 4, 'main': 4, 'index': 2, 'config': 5, 'settings': 6, 'env': 4, 'db': 4, 'database': 5,
+    'model': 3, 'query': 4, 'sql': 5, 'repository': 3, 'storage': 4, 'exec': 5, 'shell': 5,
+}
+
+# Path tokens of code that rarely matters for a threat model
+LOW_VALUE_PATH_HINTS = {
+    'test': -8, 'tests': -8, 'spec': -8, 'specs': -8, 'mock': -6, 'mocks': -6, 'fixture': -6,
+    'fixtures': -6, 'example': -6, 'examples': -6, 'sample': -6, 'samples': -6, 'demo': -6,
+    'doc': -8, 'docs': -8, 'documentation': -8, 'benchmark': -6, 'benchmarks': -6, 'bench': -6,
+    'migration': -4, 'migrations': -4, 'locale': -5, 'locales': -5, 'i18n': -5, 'static': -4,
+    'assets': -5, 'public': -3, 'dist': -8, 'build': -6, 'vendor': -8, 'third_party': -8,
+    'node_modules': -10, 'generated': -6, 'stories': -6, 'storybook': -6, 'e2e': -6, 'scripts': -2,
+}
+
+# Base score of each file extension
+EXTENSION_SCORES = {
+    '.py': 4, '.js': 3, '.ts': 4, '.java': 4, '.go': 4, '.rb': 4, '.html': 1, '.css': -4,
+}
+
+# Function to split a path into lower-case tokens on separators and camelCase boundaries
+def path_tokens(path):
+    tokens = re.split(r'[/\\._\-\s]+', re.sub(r'([a-z0-9])([A-Z])', r'\1_\2', path))
+    return [token.lower() for token in tokens if token]
+
+# Function to score a file from its path and size alone, before anything is downloaded
+def score_file(path, size=None):
+    if path.lower() == 'readme.md':
+        return float('inf')
+
+    tokens = path_tokens(path)
+    score = EXTENSION_SCORES.get(os.path.splitext(path)[1], 0)
+
+    for token in set(tokens):
+        if token in LOW_VALUE_PATH_HINTS:
+            score += LOW_VALUE_PATH_HINTS[token]
+            continue
+        score += max((weight for hint, weight in SECURITY_PATH_HINTS.items() if token.startswith(hint)), default=0)
+
+    # Prefer code close to the root of the repository
+    score -= 0.5 * path.count('/')
+
+    if size is not None:
+        if size < 200:
+            score -= 3
+        elif size > 200 * 1024:
+            score -= 4
+
+    return score
+
+# Function to order files by descending score, ties keep their original order.
+# key returns the (path, size) of an item.
+def rank_files(items, key=lambda item: item):
+    return sorted(items, key=lambda item: -score_file(*key(item)))
+
+# Files larger than this are skipped before they are downloaded, can be overridden with MAX_FILE_SIZE_KB
+DEFAULT_MAX_FILE_SIZE = 512 * 1024
+
+# Number of characters sampled from the head of a file to detect minified code
+MINIFIED_SAMPLE_SIZE = 4096
+
+# Path segments of vendored dependencies and build output
+VENDORED_DIRECTORIES = {
+    'node_modules', 'bower_components', 'jspm_packages', 'vendor', 'vendors', 'third_party', 'thirdparty',
+    'site-packages', '.venv', 'venv', 'dist', 'build', 'target', '.next', '.nuxt',
+    'coverage', '__generated__', 'generated', 'gen',
+}
+
+# File name patterns of minified, bundled and generated code
+GENERATED_FILE_PATTERN = re.compile(
+    r'(?:\.min\.(?:js|css)|[.\-_]bundle\.js|\.chunk\.js|_pb2(?:_grpc)?\.py|\.pb(?:\.gw)?\.go|_gen\.go|'
+    r'\.generated\.\w+|_generated\.\w+|\.g\.(?:dart|cs)|-lock\.\w+|\.d\.ts)$'
+    r'|(?:^|/)(?:jquery|bootstrap|lodash|angular|react(?:-dom)?|vue)(?:[.\-][\w.\-]*)?\.js$'
+)
+
+# Extensions that are commonly shipped minified
+MINIFIABLE_EXTENSIONS = ('.js', '.mjs', '.ts', '.css', '.html')
+
+# Function to read the file size cap from the environment
+def get_max_file_size(max_file_size=None):
+    if max_file_size is None:
+        max_file_size = int(os.getenv('MAX_FILE_SIZE_KB', DEFAULT_MAX_FILE_SIZE // 1024)) * 1024
+    return max_file_size
+
+# Function to parse a comma or newline separated list of globs as entered in the UI
+def parse_globs(text):
+    return tuple(glob.strip() for glob in re.split(r'[,\n]', text or '') if glob.strip())
+
+# Function to decide from tree metadata alone whether a file should be skipped, returns the reason or None
+def skip_reason(path, size=None, exclude_globs=(), max_file_size=None):
+    if path.lower() == 'readme.md':
+        return None
+    if any(fnmatch.fnmatch(path, pattern) for pattern in exclude_globs):
+        return "excluded"
+    if size is not None and size > get_max_file_size(max_file_size):
+        return "too large"
+    if any(part in VENDORED_DIRECTORIES for part in path.split('/')[:-1]):
+        return "vendored"
+    if GENERATED_FILE_PATTERN.search(path):
+        return "generated"
+    return None
+
+# Function to drop skipped files before any content request is made.
+# key returns the (path, size) of an item.
+def filter_files(items, key=lambda item: item, exclude_globs=(), max_file_size=None):
+    max_file_size = get_max_file_size(max_file_size)
+    kept = []
+    skipped = defaultdict(int)
+    for item in items:
+        reason = skip_reason(*key(item), exclude_globs=exclude_globs, max_file_size=max_file_size)
+        if reason is None:
+            kept.append(item)
+        else:
+            skipped[reason] += 1
+    if skipped:
+        print("Skipped files: " + ", ".join(f"{count} {reason}" for reason, count in skipped.items()))
+    return kept
+
+# Function to detect minified code from a small sample of the head of a file
+def looks_minified(path, sample):
+    if not path.endswith(MINIFIABLE_EXTENSIONS) or len(sample) < 1024:
+        return False
+    lines = sample.split('\n')
+    return max(len(line) for line in lines) > 1000 or len(sample) / len(lines) > 300
@@ -0,0 +1,251 @@
+import email.utils
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# GitHub REST API root, and the default location and size of the store of conditional responses,
+# can be overridden with GITHUB_API_URL, GITHUB_RESPONSE_CACHE_PATH and GITHUB_RESPONSE_CACHE_MAX_MB
+DEFAULT_API_URL = "https://api.github.com"
+DEFAULT_RESPONSE_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "genai4dso", "github_responses.sqlite")
+DEFAULT_RESPONSE_CACHE_MAX_MB = 64
+
+# Share of the rate limit kept in reserve. Requests are only paced once the remaining quota falls below it.
+DEFAULT_RESERVE = 0.1
+
+# Number of requests that may be sent back to back once pacing kicks in
+DEFAULT_BURST = 10
+
+# Longest time to wait for the rate limit to reset before giving up, can be overridden with GITHUB_MAX_RATE_LIMIT_WAIT
+DEFAULT_MAX_RATE_LIMIT_WAIT = 60
+
+# Size of the shared connection pool
+DEFAULT_POOL_SIZE = 32
+
+_clients = {}
+_clients_lock = threading.Lock()
+_default_response_store = None
+
+# Function to get the GitHub client shared by all sessions using the same token
+def get_github_client(token):
+    global _default_response_store
+    key = hashlib.sha256((token or "").encode()).hexdigest()
+    with _clients_lock:
+        if _default_response_store is None:
+            _default_response_store = ResponseStore(
+                os.getenv("GITHUB_RESPONSE_CACHE_PATH", DEFAULT_RESPONSE_CACHE_PATH),
+                int(os.getenv("GITHUB_RESPONSE_CACHE_MAX_MB", DEFAULT_RESPONSE_CACHE_MAX_MB)) * 1024 * 1024,
+            )
+        if key not in _clients:
+            _clients[key] = GitHubClient(
+                token,
+                api_url=os.getenv("GITHUB_API_URL", DEFAULT_API_URL),
+                response_store=_default_response_store,
+                max_wait=float(os.getenv("GITHUB_MAX_RATE_LIMIT_WAIT", DEFAULT_MAX_RATE_LIMIT_WAIT)),
+            )
+        return _clients[key]
+
+# Function to parse a Retry-After header given in seconds or as an HTTP date, returns the seconds to wait
+# or None when there is no header or it cannot be parsed
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Token bucket paced from the rate limit headers of the last response.
+# Requests go out unpaced while most of the quota is left. Once the remaining quota falls below the reserve, it is
+# spread evenly over the time left until the reset, with a small burst allowance.
+class RateLimitBucket:
+    def __init__(self, burst=DEFAULT_BURST, reserve=DEFAULT_RESERVE, max_wait=DEFAULT_MAX_RATE_LIMIT_WAIT):
+        self.burst = burst
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.tokens = float(burst)
+        self.rate = None
+        self.remaining = None
+        self.reset = None
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if self.rate is not None:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.remaining == 0:
+                    wait = self.reset - time.time()
+                    if wait <= 0:
+                        # The window has reset, allow requests again until the next headers arrive
+                        self.remaining = None
+                        self.rate = None
+                        self.tokens = float(self.burst)
+                        continue
+                    if wait > self.max_wait:
+                        raise RuntimeError(f"GitHub rate limit exhausted, it resets in {int(wait)} seconds")
+                elif self.rate is None:
+                    if self.remaining is not None:
+                        self.remaining -= 1
+                    return
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    self.remaining -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(min(wait, self.max_wait))
+
+    # A request that did not count against the quota (e.g. a 304) gives its token back
+    def refund(self):
+        with self._lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+            if self.remaining is not None:
+                self.remaining += 1
+
+    def update(self, headers):
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        limit = headers.get("X-RateLimit-Limit")
+        if remaining is None or reset is None:
+            return
+        with self._lock:
+            self.remaining = int(remaining)
+            self.reset = int(reset)
+            if limit is not None and self.remaining > int(limit) * self.reserve:
+                self.rate = None
+                self.tokens = float(self.burst)
+            else:
+                self.rate = self.remaining / max(1.0, self.reset - time.time())
+
+# Client for the GitHub REST and GraphQL APIs sharing one connection pool.
+# Requests are paced per rate limit resource, and get_json sends conditional requests whose 304 responses
+# are served from the response store without using any quota.
+class GitHubClient:
+    def __init__(self, token, api_url=DEFAULT_API_URL, response_store=None, max_wait=DEFAULT_MAX_RATE_LIMIT_WAIT, pool_size=DEFAULT_POOL_SIZE):
+        self.api_url = api_url.rstrip("/")
+        self.response_store = response_store
+        self.max_wait = max_wait
+        self._token_key = hashlib.sha256((token or "").encode()).hexdigest()[:16]
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept"] = "application/vnd.github+json"
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def bucket(self, resource):
+        with self._buckets_lock:
+            if resource not in self._buckets:
+                self._buckets[resource] = RateLimitBucket(max_wait=self.max_wait)
+            return self._buckets[resource]
+
+    # Send a paced request, resource is the rate limit it counts against ("core", "graphql", ...)
+    def request(self, method, url, resource="core", **kwargs):
+        if url.startswith("/"):
+            url = self.api_url + url
+        bucket = self.bucket(resource)
+        while True:
+            bucket.acquire()
+            response = self.session.request(method, url, **kwargs)
+            bucket.update(response.headers)
+            # Secondary rate limits ask the client to back off for a while
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if response.status_code in (403, 429) and retry_after is not None and retry_after <= self.max_wait:
+                response.close()
+                time.sleep(retry_after)
+                continue
+            return response
+
+    # GET a JSON resource, conditional=False skips the response store for immutable or one-off resources
+    def get_json(self, path, params=None, conditional=True, resource="core"):
+        store_key = None
+        cached = None
+        headers = {}
+        if conditional and self.response_store is not None:
+            store_key = f"{self._token_key} {path}?{json.dumps(params or {}, sort_keys=True)}"
+            cached = self.response_store.get(store_key)
+            if cached is not None:
+                headers["If-None-Match"] = cached[0]
+
+        response = self.request("GET", path, resource=resource, params=params, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            self.bucket(resource).refund()
+            return json.loads(cached[1])
+        response.raise_for_status()
+
+        etag = response.headers.get("ETag")
+        if store_key is not None and etag:
+            self.response_store.put(store_key, etag, response.text)
+        return response.json()
+
+# Store of the last ETag and body of each conditional GET.
+# Entries are evicted least recently used first once the stored bodies exceed max_bytes.
+class ResponseStore:
+    def __init__(self, path=DEFAULT_RESPONSE_CACHE_PATH, max_bytes=DEFAULT_RESPONSE_CACHE_MAX_MB * 1024 * 1024):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " etag TEXT NOT NULL,"
+            " body TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.commit()
+
+    # Returns (etag, body) of the last response stored under key
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT etag, body FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            return row
+
+    def put(self, key, etag, body):
+        size = len(body.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, etag, body, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, etag, body, size, time.time()),
+            )
+            self._evict()
+            self._conn.commit()
+
+    # Drop the least recently used entries until the store fits in max_bytes
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self._conn.execute("SELECT key, size FROM responses ORDER BY last_used ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", evicted)
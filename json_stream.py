@@ -0,0 +1,83 @@
+import json
+import re
+
+# Incremental parser of a JSON response streamed in chunks. It returns each object of the array under a top-level key
+# as soon as the object is complete, long before the whole response can be parsed with json.loads.
+# Anything before the first "{", such as a Markdown code fence, is ignored.
+class JsonArrayStream:
+    def __init__(self, key):
+        self.key = key
+        # One [bracket, last key, expecting a key] entry per open object or array
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string = []
+        self._array_depth = None
+        self._item = None
+
+    # Feed the next chunk of the response, returns the objects of the array completed by it
+    def feed(self, text):
+        items = []
+        for char in text:
+            if self._item is not None:
+                self._item.append(char)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    self._end_string()
+                    continue
+                self._string.append(char)
+                continue
+
+            if char == '"' and self._stack:
+                self._in_string = True
+                self._string = []
+            elif char in "{[":
+                if char == "[" and len(self._stack) == 1 and self._stack[0][1] == self.key:
+                    self._array_depth = len(self._stack) + 1
+                elif char == "{" and self._array_depth is not None and len(self._stack) == self._array_depth:
+                    self._item = ["{"]
+                self._stack.append([char, None, char == "{"])
+            elif char in "}]" and self._stack:
+                self._stack.pop()
+                if self._array_depth is not None:
+                    if char == "}" and self._item is not None and len(self._stack) == self._array_depth:
+                        try:
+                            items.append(json.loads("".join(self._item)))
+                        except json.JSONDecodeError:
+                            pass
+                        self._item = None
+                    elif char == "]" and len(self._stack) == self._array_depth - 1:
+                        self._array_depth = None
+            elif self._stack and self._stack[-1][0] == "{":
+                if char == ",":
+                    self._stack[-1][2] = True
+                elif char == ":":
+                    self._stack[-1][2] = False
+        return items
+
+    # Remember the keys of objects, to find the array under self.key
+    def _end_string(self):
+        top = self._stack[-1]
+        if top[0] == "{" and top[2]:
+            try:
+                top[1] = json.loads('"' + "".join(self._string) + '"')
+            except json.JSONDecodeError:
+                top[1] = None
+
+# Function to parse a complete JSON response, ignoring a Markdown code fence around it.
+# Returns an empty dictionary when the response is not valid JSON, like the non-streaming generators.
+def parse_json_response(text):
+    text = re.sub(r'^\s*```(?:json)?\s*|\s*```\s*$', '', text)
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError as e:
+        print(f"Error decoding JSON: {str(e)}")
+        print("Raw JSON string:")
+        print(text)
+        return {}
@@ -0,0 +1,393 @@
+import asyncio
+import concurrent.futures
+import copy
+import functools
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from code_index import tokenize
+from llm_retry import estimate_tokens, get_retry_controller
+from llm_router import measured
+
+# Default location, size and lifetime of the LLM response cache, can be overridden with LLM_CACHE_PATH,
+# LLM_CACHE_MAX_MB, LLM_CACHE_MEMORY_ENTRIES and LLM_CACHE_TTL_HOURS
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "genai4dso", "llm_responses.sqlite")
+DEFAULT_CACHE_MAX_MB = 64
+DEFAULT_MEMORY_ENTRIES = 256
+DEFAULT_TTL_HOURS = 24 * 7
+
+# Near-duplicate lookups compare MinHash signatures of word shingles. Two texts are near-duplicates when the estimated
+# Jaccard similarity of their shingles reaches the threshold, which can be overridden with LLM_CACHE_SIMILARITY_THRESHOLD.
+DEFAULT_SIMILARITY_THRESHOLD = 0.85
+MINHASH_PERMUTATIONS = 256
+SHINGLE_WORDS = 2
+MINHASH_PRIME = (1 << 61) - 1
+_minhash_random = np.random.default_rng(20240901)
+MINHASH_A = _minhash_random.integers(1, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+MINHASH_B = _minhash_random.integers(0, MINHASH_PRIME, MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+# Positional arguments of the generator functions holding credentials, which are left out of the cache key
+# so that everyone using the same model shares the cached responses
+CREDENTIAL_ARGS = {"openai": (0,), "azure": (1,), "google": (0,), "mistral": (0,), "ollama": ()}
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+# Function to get the LLM response cache shared by all sessions
+def get_llm_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = LLMCache(
+                os.getenv("LLM_CACHE_PATH", DEFAULT_CACHE_PATH),
+                int(os.getenv("LLM_CACHE_MAX_MB", DEFAULT_CACHE_MAX_MB)) * 1024 * 1024,
+                int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", DEFAULT_MEMORY_ENTRIES)),
+                float(os.getenv("LLM_CACHE_TTL_HOURS", DEFAULT_TTL_HOURS)) * 3600,
+                float(os.getenv("LLM_CACHE_SIMILARITY_THRESHOLD", DEFAULT_SIMILARITY_THRESHOLD)),
+            )
+        return _default_cache
+
+# Function to compute the cache key of an LLM request
+def cache_key(provider, model, system_prompt, prompt, params=None):
+    return hashlib.sha256(
+        json.dumps([provider, model, system_prompt, prompt, params], sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+# Function to compute the MinHash signature of the word shingles of text.
+# Whitespace, punctuation and case are ignored, so reflowed or re-punctuated text has the same signature.
+def minhash_signature(text):
+    tokens = tokenize(text)
+    shingles = {" ".join(tokens[i:i + SHINGLE_WORDS]) for i in range(max(len(tokens) - SHINGLE_WORDS + 1, 1))}
+    hashes = np.array([zlib.crc32(shingle.encode()) for shingle in shingles], dtype=np.uint64)
+    # Universal hashing (a * h + b) % p, where a * h wraps around at 2**64 like in most MinHash implementations
+    return (((np.outer(hashes, MINHASH_A) + MINHASH_B) % np.uint64(MINHASH_PRIME)) & np.uint64(0xFFFFFFFF)).min(axis=0)
+
+# Function to get the module-level string constants, such as system prompts, used by a function
+def string_constants(func):
+    return {value for value in (func.__globals__.get(name) for name in func.__code__.co_names) if isinstance(value, str)}
+
+# Function to fingerprint the system prompt and generation params of a generator function.
+# They are literals in the function body or module-level string constants, so a change to either invalidates its entries.
+# The sync and async variants of a generator only differ by their name, so they share their entries.
+# extra_strings are added to the fingerprint, see cached_stream.
+def generator_fingerprint(func, provider, extra_strings=()):
+    code = func.__code__
+    strings = {value for value in code.co_consts if isinstance(value, str)}
+    strings |= string_constants(func) | set(extra_strings)
+    strings.discard(provider)
+    name = func.__name__[:-len("_async")] if func.__name__.endswith("_async") else func.__name__
+    return hashlib.sha256(json.dumps([func.__module__, name, sorted(strings)]).encode()).hexdigest()
+
+# Function to get the key of the route (provider and model) of a call to a generator function, given its arguments
+# without the prompt. Credentials are left out, like in the cache key.
+def route_key(provider, model_args):
+    return ":".join([provider] + [str(arg) for i, arg in enumerate(model_args) if i not in CREDENTIAL_ARGS[provider]])
+
+# Function to compute the cache key of a call to a generator function with the given fingerprint
+def generation_key(provider, fingerprint, args):
+    model = [arg for i, arg in enumerate(args[:-1]) if i not in CREDENTIAL_ARGS[provider]]
+    return cache_key(provider, model, fingerprint, args[-1])
+
+# Decorator caching the results of a generator function taking (*model args, prompt) for the given provider.
+# Pass use_cache=False to a decorated function to bypass the cache for one request; its result is still stored.
+# Empty results, which the generators return when the model output could not be parsed, are never cached.
+# Identical requests made while one is in flight, from any session or thread, wait for its result instead of
+# calling the model again. Requests that reach the model go through the provider's retry controller, and their
+# latency or failure is recorded in the health of their route.
+def cached_generation(provider):
+    def decorator(func):
+        fingerprint = generator_fingerprint(func, provider)
+
+        def key_of(args):
+            return generation_key(provider, fingerprint, args)
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, use_cache=True):
+                cache = get_llm_cache()
+                key = key_of(args)
+                found, value = cache.get(key) if use_cache else cache.bypass()
+                if found:
+                    return value
+                future, leader = cache.begin(key)
+                if not leader:
+                    try:
+                        # Shielded so that a cancelled follower does not cancel the request for everyone else
+                        return copy.deepcopy(await asyncio.shield(asyncio.wrap_future(future)))
+                    except asyncio.CancelledError:
+                        # The leader was cancelled by its own caller, make the request again unless this one was too
+                        if asyncio.current_task().cancelling():
+                            raise
+                        return await wrapper(*args, use_cache=use_cache)
+                try:
+                    with measured(route_key(provider, args[:-1])):
+                        value = await get_retry_controller(provider).call_async(func, *args, tokens=estimate_tokens(args[-1]))
+                except BaseException as e:
+                    cache.finish(key, future, error=e)
+                    raise
+                if value:
+                    cache.put(key, value)
+                cache.finish(key, future, value)
+                return value
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, use_cache=True):
+                cache = get_llm_cache()
+                key = key_of(args)
+                found, value = cache.get(key) if use_cache else cache.bypass()
+                if found:
+                    return value
+                future, leader = cache.begin(key)
+                if not leader:
+                    try:
+                        return copy.deepcopy(future.result())
+                    except concurrent.futures.CancelledError:
+                        # The leader was cancelled by its own caller, make the request again
+                        return wrapper(*args, use_cache=use_cache)
+                try:
+                    with measured(route_key(provider, args[:-1])):
+                        value = get_retry_controller(provider).call(func, *args, tokens=estimate_tokens(args[-1]))
+                except BaseException as e:
+                    cache.finish(key, future, error=e)
+                    raise
+                if value:
+                    cache.put(key, value)
+                cache.finish(key, future, value)
+                return value
+
+        return wrapper
+    return decorator
+
+# Decorator caching the text streamed by a function yielding the chunks of a model response, taking the same arguments
+# as the non-streaming generator it streams. Both share their cache entries: the joined text, after postprocess,
+# is stored as the result of generator, and a cached result is yielded as a single chunk, as JSON unless it is text.
+# The prompts of a stream must be the module-level constants generator uses: they are part of the fingerprint, so a
+# stream sending any other prompt gets entries of its own instead of generator's results.
+# Streams are not coalesced, each caller of an in-flight request gets its own stream. They are retried until their
+# first chunk arrives.
+def cached_stream(provider, generator, postprocess=None):
+    def decorator(func):
+        fingerprint = generator_fingerprint(inspect.unwrap(generator), provider, string_constants(func))
+
+        @functools.wraps(func)
+        def wrapper(*args, use_cache=True):
+            cache = get_llm_cache()
+            key = generation_key(provider, fingerprint, args)
+            found, value = cache.get(key) if use_cache else cache.bypass()
+            if found:
+                yield value if isinstance(value, str) else json.dumps(value)
+                return
+            chunks = []
+            stream = get_retry_controller(provider).stream(func, *args, tokens=estimate_tokens(args[-1]))
+            try:
+                with measured(route_key(provider, args[:-1])):
+                    for chunk in stream:
+                        chunks.append(chunk)
+                        yield chunk
+            finally:
+                # Closes the response as soon as the caller stops reading, e.g. when Streamlit reruns the script
+                stream.close()
+            value = "".join(chunks)
+            if postprocess is not None:
+                value = postprocess(value)
+            if value:
+                cache.put(key, value)
+
+        return wrapper
+    return decorator
+
+# Two-tier cache of LLM responses: an in-memory LRU of the most recent entries in front of a SQLite table.
+# Entries expire ttl seconds after they were stored, and the table is evicted least recently used first
+# once the stored responses exceed max_bytes. Values are stored as JSON, so callers always get their own copy.
+# A ttl of 0 disables the cache, nothing is written to disk.
+# Results can also be stored for near-duplicate lookups, which return the result stored for the most similar text
+# within a namespace, see get_similar.
+class LLMCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_CACHE_MAX_MB * 1024 * 1024, memory_entries=DEFAULT_MEMORY_ENTRIES, ttl=DEFAULT_TTL_HOURS * 3600, similarity_threshold=DEFAULT_SIMILARITY_THRESHOLD):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.metrics = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "bypasses": 0, "expired": 0, "similar_hits": 0, "similar_misses": 0, "coalesced": 0}
+        self._memory = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS near_duplicates ("
+            " key TEXT PRIMARY KEY,"
+            " namespace TEXT NOT NULL,"
+            " signature BLOB NOT NULL,"
+            " value TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS near_duplicates_namespace ON near_duplicates (namespace)")
+        self._conn.commit()
+
+    # Returns (found, value) of the response stored under key
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self._memory.move_to_end(key)
+                self.metrics["memory_hits"] += 1
+                return True, json.loads(entry[0])
+
+            row = self._conn.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[1] >= self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                self._memory.pop(key, None)
+                self.metrics["expired"] += 1
+                row = None
+            if row is None:
+                self.metrics["misses"] += 1
+                return False, None
+
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self._remember(key, row[0], row[1])
+            self.metrics["disk_hits"] += 1
+            return True, json.loads(row[0])
+
+    # Records a request that skipped the cache, returns the same (found, value) as a miss
+    def bypass(self):
+        with self._lock:
+            self.metrics["bypasses"] += 1
+        return False, None
+
+    def put(self, key, value):
+        value = json.dumps(value)
+        size = len(value.encode("utf-8"))
+        if size > self.max_bytes or self.ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, value, size, now, now),
+            )
+            self._evict("responses")
+            self._conn.commit()
+            self._remember(key, value, now)
+
+    # Returns (future, leader) for a request about to be sent. The first caller of a request is its leader and must
+    # call finish() once it is done; callers of an identical request in the meantime wait on the leader's future.
+    def begin(self, key):
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.metrics["coalesced"] += 1
+                return future, False
+            future = self._in_flight[key] = concurrent.futures.Future()
+            return future, True
+
+    def finish(self, key, future, value=None, error=None):
+        with self._lock:
+            self._in_flight.pop(key, None)
+        if isinstance(error, asyncio.CancelledError):
+            # Cancellation is not the request's outcome, the waiting callers retry it
+            future.cancel()
+        elif error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(value)
+
+    # Returns (similarity, value) of the result stored for the text most similar to text in namespace,
+    # or (similarity, None) when no stored text reaches the threshold
+    def get_similar(self, namespace, text, threshold=None):
+        threshold = self.similarity_threshold if threshold is None else threshold
+        signature = minhash_signature(text)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, signature, value FROM near_duplicates WHERE namespace = ? AND created > ?",
+                (namespace, time.time() - self.ttl),
+            ).fetchall()
+            best, best_similarity = None, 0.0
+            for key, stored, value in rows:
+                similarity = float(np.mean(np.frombuffer(stored, dtype=np.uint64) == signature))
+                if similarity > best_similarity:
+                    best, best_similarity = (key, value), similarity
+            if best is None or best_similarity < threshold:
+                self.metrics["similar_misses"] += 1
+                return best_similarity, None
+
+            self._conn.execute("UPDATE near_duplicates SET last_used = ? WHERE key = ?", (time.time(), best[0]))
+            self._conn.commit()
+            self.metrics["similar_hits"] += 1
+            return best_similarity, json.loads(best[1])
+
+    def put_similar(self, namespace, text, value):
+        value = json.dumps(value)
+        signature = minhash_signature(text).tobytes()
+        size = len(value.encode("utf-8")) + len(signature)
+        if size > self.max_bytes or self.ttl <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO near_duplicates (key, namespace, signature, value, size, created, last_used) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (cache_key(namespace, None, None, text), namespace, signature, value, size, now, now),
+            )
+            self._evict("near_duplicates")
+            self._conn.commit()
+
+    # Returns the hit and miss counters along with the number and size of the stored responses
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+            stats = dict(self.metrics, entries=entries, bytes=size)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._conn.execute("DELETE FROM responses")
+            self._conn.execute("DELETE FROM near_duplicates")
+            self._conn.commit()
+
+    # Keep an entry in the in-memory tier, dropping the least recently used ones beyond memory_entries
+    def _remember(self, key, value, created):
+        self._memory[key] = (value, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    # Drop the least recently used entries of table until it fits in max_bytes
+    def _evict(self, table):
+        total = self._conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self._conn.execute(f"SELECT key, size FROM {table} ORDER BY last_used ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+            self._memory.pop(key, None)
+        self._conn.executemany(f"DELETE FROM {table} WHERE key = ?", evicted)
@@ -0,0 +1,298 @@
+import asyncio
+import concurrent.futures
+import contextlib
+import contextvars
+import hashlib
+import os
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from mistralai import Mistral
+from openai import AsyncAzureOpenAI, AsyncOpenAI, OpenAI, AzureOpenAI
+from requests.adapters import HTTPAdapter
+
+import google.generativeai as genai
+
+# Size of the keep-alive connection pool of each client
+# The SDKs' own retries are disabled, requests are retried by the controllers in llm_retry
+DEFAULT_POOL_SIZE = 20
+
+# Default timeout of a provider request, in seconds, can be overridden with LLM_REQUEST_TIMEOUT.
+# Requests made under a deadline time out when it expires instead, if that is sooner.
+DEFAULT_REQUEST_TIMEOUT = 300
+DEFAULT_CONNECT_TIMEOUT = 10
+
+# Default time a whole generation (an assessment stage, a tab's request) may take, in seconds, including its retries.
+# Can be overridden with LLM_STAGE_TIMEOUT.
+DEFAULT_STAGE_TIMEOUT = 600
+
+# Seconds between the checks run_async makes for a cancellation while it waits
+CANCEL_POLL_INTERVAL = 0.25
+
+# Default number of concurrent async requests per provider, can be overridden with <PROVIDER>_MAX_CONCURRENCY
+DEFAULT_CONCURRENCY = {"openai": 8, "azure": 8, "google": 4, "mistral": 4, "ollama": 1}
+
+_clients = {}
+_clients_lock = threading.Lock()
+_google_api_key = None
+
+# Async clients and semaphores are bound to the event loop they were created on, so they are kept per loop
+_loop_state = weakref.WeakKeyDictionary()
+_background_loop = None
+
+# Monotonic time by which the provider requests of the current thread or task must be done, None without a deadline
+_deadline = contextvars.ContextVar("llm_deadline", default=None)
+
+# Raised instead of sending a request once its deadline has passed
+class DeadlineExceeded(TimeoutError):
+    pass
+
+# Context manager bounding the provider requests made inside it to seconds from now, or sooner under an outer deadline.
+# The deadline follows the coroutines passed to run_async and the tasks they create.
+@contextlib.contextmanager
+def deadline(seconds):
+    value = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(value if current is None else min(current, value))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+# Function to get the seconds left before the current deadline, None without a deadline
+def time_remaining():
+    value = _deadline.get()
+    return None if value is None else value - time.monotonic()
+
+def stage_timeout():
+    return float(os.getenv("LLM_STAGE_TIMEOUT", DEFAULT_STAGE_TIMEOUT))
+
+# Function to get the timeout of a request about to be sent: the default timeout, or the time left before the deadline
+def request_timeout():
+    timeout = float(os.getenv("LLM_REQUEST_TIMEOUT", DEFAULT_REQUEST_TIMEOUT))
+    remaining = time_remaining()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise DeadlineExceeded("The deadline for the request has passed")
+    return min(timeout, remaining)
+
+# httpx request hook applying request_timeout() to every request of the clients below, whatever timeout the SDK set
+def apply_deadline(request):
+    timeout = request_timeout()
+    request.extensions["timeout"] = httpx.Timeout(timeout, connect=min(timeout, DEFAULT_CONNECT_TIMEOUT)).as_dict()
+
+async def apply_deadline_async(request):
+    apply_deadline(request)
+
+# Options passed to the Google SDK calls, which do not go through httpx
+def google_request_options():
+    return {"timeout": request_timeout()}
+
+# Session applying request_timeout() to the requests sent without a timeout of their own
+class TimeoutSession(requests.Session):
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            timeout = request_timeout()
+            kwargs["timeout"] = (min(timeout, DEFAULT_CONNECT_TIMEOUT), timeout)
+        return super().request(method, url, **kwargs)
+
+# Function to build the registry key of a client, credentials are hashed rather than kept as keys
+def client_key(provider, *credentials):
+    return (provider,) + tuple(hashlib.sha256((value or "").encode()).hexdigest() for value in credentials)
+
+# Function to get the client registered under key, creating it with create() on first use.
+# Clients are shared by all calls and Streamlit sessions, so their connection pools and TLS sessions are reused.
+def get_client(key, create):
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _clients[key] = create()
+        return client
+
+# Function to create the pooled HTTP client passed to the OpenAI SDK
+def create_httpx_client():
+    return httpx.Client(
+        limits=httpx.Limits(max_connections=DEFAULT_POOL_SIZE, max_keepalive_connections=DEFAULT_POOL_SIZE),
+        event_hooks={"request": [apply_deadline]},
+    )
+
+def get_openai_client(api_key):
+    return get_client(
+        client_key("openai", api_key),
+        lambda: OpenAI(api_key=api_key, http_client=create_httpx_client(), max_retries=0),
+    )
+
+def get_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version):
+    return get_client(
+        client_key("azure", azure_api_endpoint, azure_api_key, azure_api_version),
+        lambda: AzureOpenAI(
+            azure_endpoint = azure_api_endpoint,
+            api_key = azure_api_key,
+            api_version = azure_api_version,
+            http_client = create_httpx_client(),
+            max_retries = 0,
+        ),
+    )
+
+def get_mistral_client(mistral_api_key):
+    return get_client(client_key("mistral", mistral_api_key), lambda: Mistral(api_key=mistral_api_key, client=create_httpx_client()))
+
+# Function to configure the Google SDK. Its client is global, so it is only rebuilt when the key changes.
+def configure_google(google_api_key):
+    global _google_api_key
+    with _clients_lock:
+        if google_api_key != _google_api_key:
+            genai.configure(api_key=google_api_key)
+            _google_api_key = google_api_key
+
+# Function to get the pooled HTTP session used for Ollama and other plain HTTP APIs
+def get_http_session():
+    def create():
+        session = TimeoutSession()
+        adapter = HTTPAdapter(pool_connections=DEFAULT_POOL_SIZE, pool_maxsize=DEFAULT_POOL_SIZE)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    return get_client(("http",), create)
+
+# Function to get the async client registered under key for the running event loop, creating it on first use
+def get_async_client(key, create):
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        state = _loop_state.setdefault(loop, {"clients": {}, "semaphores": {}})
+        client = state["clients"].get(key)
+        if client is None:
+            client = state["clients"][key] = create()
+        return client
+
+# Function to create the pooled async HTTP client passed to the OpenAI SDK and used for Ollama
+def create_async_httpx_client():
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=DEFAULT_POOL_SIZE, max_keepalive_connections=DEFAULT_POOL_SIZE),
+        event_hooks={"request": [apply_deadline_async]},
+    )
+
+def get_async_openai_client(api_key):
+    return get_async_client(
+        client_key("openai", api_key),
+        lambda: AsyncOpenAI(api_key=api_key, http_client=create_async_httpx_client(), max_retries=0),
+    )
+
+def get_async_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version):
+    return get_async_client(
+        client_key("azure", azure_api_endpoint, azure_api_key, azure_api_version),
+        lambda: AsyncAzureOpenAI(
+            azure_endpoint = azure_api_endpoint,
+            api_key = azure_api_key,
+            api_version = azure_api_version,
+            http_client = create_async_httpx_client(),
+            max_retries = 0,
+        ),
+    )
+
+# The Mistral client has async methods of its own, a separate instance is kept per loop for its async pool
+def get_async_mistral_client(mistral_api_key):
+    return get_async_client(client_key("mistral", mistral_api_key), lambda: Mistral(api_key=mistral_api_key, async_client=create_async_httpx_client()))
+
+def get_async_http_client():
+    return get_async_client(("http",), create_async_httpx_client)
+
+# Function to get the semaphore that limits the concurrent async requests to a provider on the running loop
+def provider_limit(provider):
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        state = _loop_state.setdefault(loop, {"clients": {}, "semaphores": {}})
+        semaphore = state["semaphores"].get(provider)
+        if semaphore is None:
+            limit = int(os.getenv(f"{provider.upper()}_MAX_CONCURRENCY", DEFAULT_CONCURRENCY[provider]))
+            semaphore = state["semaphores"][provider] = asyncio.Semaphore(limit)
+        return semaphore
+
+async def _run_with_deadline(coro, seconds):
+    with deadline(seconds):
+        return await coro
+
+# Function to run a coroutine from synchronous code such as the Streamlit script thread.
+# Everything runs on one long-lived background loop, so async clients and their pools survive between reruns.
+# The caller's deadline applies to the coroutine. While waiting, should_cancel() is checked every few tenths of
+# a second; once it returns True the coroutine is cancelled, which aborts its requests, and CancelledError is raised.
+def run_async(coro, should_cancel=None):
+    global _background_loop
+    with _clients_lock:
+        if _background_loop is None:
+            _background_loop = asyncio.new_event_loop()
+            threading.Thread(target=_background_loop.run_forever, name="llm-event-loop", daemon=True).start()
+    remaining = time_remaining()
+    if remaining is not None:
+        coro = _run_with_deadline(coro, remaining)
+    future = asyncio.run_coroutine_threadsafe(coro, _background_loop)
+    while should_cancel is not None and not future.done():
+        concurrent.futures.wait([future], timeout=CANCEL_POLL_INTERVAL)
+        if not future.done() and should_cancel():
+            future.cancel()
+            raise concurrent.futures.CancelledError()
+    return future.result()
+
+# Check that the shared clients reuse their connections: python llm_clients.py
+# Serves a local HTTP server that records the client port of every request, then makes several calls through the
+# shared session, the shared async client and a cached OpenAI client, each of which must use a single connection.
+if __name__ == "__main__":
+    import json
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    ports = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self):
+            ports.append(self.client_address[1])
+            body = json.dumps({
+                "id": "check", "object": "chat.completion", "created": 0, "model": "check",
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "ok"}}],
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            self.reply()
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.reply()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    def check(name, call, calls=5):
+        ports.clear()
+        for _ in range(calls):
+            call()
+        assert len(ports) == calls, f"{name}: {len(ports)} of {calls} requests arrived"
+        assert len(set(ports)) == 1, f"{name}: {calls} requests used {len(set(ports))} connections"
+        print(f"{name}: {calls} requests over 1 connection")
+
+    check("requests session", lambda: get_http_session().get(url).raise_for_status())
+
+    async def get_async():
+        (await get_async_http_client().get(url)).raise_for_status()
+
+    check("async httpx client", lambda: run_async(get_async()))
+
+    # The SDK reads its endpoint from OPENAI_BASE_URL, each call looks the client up again like the generators do
+    os.environ["OPENAI_BASE_URL"] = url
+    check("OpenAI client", lambda: get_openai_client("check").chat.completions.create(model="check", messages=[{"role": "user", "content": "check"}]))
+
+    server.shutdown()
@@ -0,0 +1,278 @@
+import asyncio
+import email.utils
+import json
+import os
+import random
+import threading
+import time
+
+import httpx
+import requests
+from openai import APIConnectionError
+
+from llm_clients import DeadlineExceeded, time_remaining
+
+# Attempts per request, including the first one, can be overridden with LLM_MAX_ATTEMPTS
+DEFAULT_MAX_ATTEMPTS = 3
+
+# Exponential backoff between attempts, in seconds: a random delay up to base * 2 ** (attempt - 1), capped at max
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 30.0
+
+# Longest a request waits for its provider's budget or a Retry-After, in seconds, before it fails instead.
+# A throttled provider then fails fast for every session rather than piling up blocked requests.
+DEFAULT_MAX_WAIT = 60.0
+
+# Default (requests, tokens) per minute sent to each provider from all sessions, 0 is unlimited.
+# Can be overridden with <PROVIDER>_REQUESTS_PER_MINUTE and <PROVIDER>_TOKENS_PER_MINUTE.
+DEFAULT_BUDGETS = {
+    "openai": (500, 200000),
+    "azure": (300, 120000),
+    "google": (300, 1000000),
+    "mistral": (300, 500000),
+    "ollama": (0, 0),
+}
+
+# HTTP statuses worth retrying: timeouts, conflicts, rate limits and server errors
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+# Rough number of characters per token, to charge prompts against the token budgets before they are sent
+CHARS_PER_TOKEN = 4
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+# Raised instead of waiting when a provider asks to back off for longer than the maximum wait
+class ProviderThrottled(RuntimeError):
+    pass
+
+# Function to get the retry controller of a provider, shared by all sessions
+def get_retry_controller(provider):
+    with _controllers_lock:
+        if provider not in _controllers:
+            requests_per_minute, tokens_per_minute = DEFAULT_BUDGETS[provider]
+            _controllers[provider] = RetryController(
+                provider,
+                ProviderBudget(
+                    requests_per_minute=int(os.getenv(f"{provider.upper()}_REQUESTS_PER_MINUTE", requests_per_minute)),
+                    tokens_per_minute=int(os.getenv(f"{provider.upper()}_TOKENS_PER_MINUTE", tokens_per_minute)),
+                ),
+                max_attempts=int(os.getenv("LLM_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)),
+                max_wait=float(os.getenv("LLM_MAX_RATE_LIMIT_WAIT", DEFAULT_MAX_WAIT)),
+            )
+        return _controllers[provider]
+
+# Function to estimate the number of tokens of a prompt
+def estimate_tokens(prompt):
+    return len(prompt) // CHARS_PER_TOKEN if isinstance(prompt, str) else 0
+
+# Function to get the HTTP status of an error raised by any of the provider SDKs, None for other errors.
+# OpenAI and Mistral errors have a status_code, requests and httpx errors a response, Google errors a code.
+def status_of(error):
+    for value in (
+        getattr(error, "status_code", None),
+        getattr(getattr(error, "response", None), "status_code", None),
+        getattr(error, "code", None),
+    ):
+        if isinstance(value, int):
+            return value
+    return None
+
+# Function to get the seconds a provider asked to wait in the Retry-After (or retry-after-ms) header of an error
+def retry_after_of(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        response = getattr(error, "raw_response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# Function to decide whether a failed request is worth retrying: connection errors, timeouts, the statuses above
+# and model outputs that are not valid JSON, which a second generation usually fixes
+def is_retryable(error):
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, httpx.TransportError, APIConnectionError, json.JSONDecodeError)):
+        return True
+    return status_of(error) in RETRYABLE_STATUSES
+
+# Request and token budgets of a provider, refilled continuously at their rate per minute.
+# A provider answering with a rate limit pauses every request to it until the time it asked for.
+class ProviderBudget:
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0):
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.available = {name: float(limit) for name, limit in self.limits.items()}
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    # Take one request and tokens from the budget. Returns 0 once they were taken, else the seconds to wait before
+    # trying again; nothing is taken then. Requests larger than a whole minute of budget wait for a full budget.
+    def reserve(self, tokens=0):
+        with self._lock:
+            now = time.monotonic()
+            for name, limit in self.limits.items():
+                if limit:
+                    self.available[name] = min(limit, self.available[name] + (now - self.updated) * limit / 60)
+            self.updated = now
+
+            needed = {"requests": 1, "tokens": tokens}
+            wait = self.paused_until - now
+            for name, limit in self.limits.items():
+                if limit and self.available[name] < min(needed[name], limit):
+                    wait = max(wait, (min(needed[name], limit) - self.available[name]) * 60 / limit)
+            if wait > 0:
+                return wait
+
+            for name, limit in self.limits.items():
+                if limit:
+                    self.available[name] -= min(needed[name], limit)
+            return 0
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+# Retries the requests to a provider with exponential backoff and full jitter, honouring Retry-After, after
+# waiting for the provider's budget before each attempt. Counts are kept for the sidebar.
+class RetryController:
+    def __init__(self, provider, budget, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY, max_wait=DEFAULT_MAX_WAIT):
+        self.provider = provider
+        self.budget = budget
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.retries = 0
+        self.rate_limited = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    # Call func(*args), retrying the errors accepted by retryable. The budget is charged a request and tokens
+    # for each attempt unless acquire is False, e.g. when func makes its requests through the controller itself.
+    def call(self, func, *args, tokens=0, acquire=True, retryable=is_retryable):
+        attempt = 0
+        while True:
+            attempt += 1
+            if acquire:
+                self.acquire(tokens)
+            try:
+                return func(*args)
+            except Exception as e:
+                delay = self._retry_delay(attempt, e, retryable)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+
+    async def call_async(self, func, *args, tokens=0, acquire=True, retryable=is_retryable):
+        attempt = 0
+        while True:
+            attempt += 1
+            if acquire:
+                await self.acquire_async(tokens)
+            try:
+                return await func(*args)
+            except Exception as e:
+                delay = self._retry_delay(attempt, e, retryable)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+    # Yield the chunks of the generator func(*args), retrying until its first chunk arrives.
+    # Errors after the first chunk are raised, the chunks already yielded cannot be taken back.
+    # The generator is closed, which closes its response, when the deadline passes or the caller stops iterating.
+    def stream(self, func, *args, tokens=0, retryable=is_retryable):
+        attempt = 0
+        while True:
+            attempt += 1
+            self.acquire(tokens)
+            chunks = func(*args)
+            try:
+                first = next(chunks, None)
+                break
+            except Exception as e:
+                chunks.close()
+                delay = self._retry_delay(attempt, e, retryable)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+        try:
+            if first is not None:
+                yield first
+            for chunk in chunks:
+                remaining = time_remaining()
+                if remaining is not None and remaining <= 0:
+                    raise DeadlineExceeded(f"The {self.provider} response was not complete before its deadline")
+                yield chunk
+        finally:
+            chunks.close()
+
+    # Wait until the budget has a request and tokens for this request
+    def acquire(self, tokens=0):
+        waited = 0.0
+        while True:
+            wait = self._budget_wait(tokens, waited)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+            waited += wait
+
+    async def acquire_async(self, tokens=0):
+        waited = 0.0
+        while True:
+            wait = self._budget_wait(tokens, waited)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def stats(self):
+        with self._lock:
+            return {"retries": self.retries, "rate_limited": self.rate_limited, "waited": self.waited}
+
+    def _budget_wait(self, tokens, waited):
+        remaining = time_remaining()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(f"The deadline for the {self.provider} request passed before it was sent")
+        wait = self.budget.reserve(tokens)
+        if wait > 0:
+            if remaining is not None and wait > remaining:
+                raise DeadlineExceeded(f"The {self.provider} request budget is exhausted until after the request's deadline")
+            if waited + wait > self.max_wait:
+                raise ProviderThrottled(f"The {self.provider} request budget is exhausted, try again in {int(wait) + 1} seconds")
+            with self._lock:
+                self.waited += wait
+        return wait
+
+    # Seconds to wait before retrying a failed attempt, None when it should not be retried,
+    # including when the retry could not start before the deadline
+    def _retry_delay(self, attempt, error, retryable):
+        if attempt >= self.max_attempts or not retryable(error):
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        retry_after = retry_after_of(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        remaining = time_remaining()
+        status = status_of(error)
+        if status == 429 or (status == 503 and retry_after is not None):
+            # Every session backs off, not just this request
+            self.budget.pause(delay)
+            with self._lock:
+                self.rate_limited += 1
+            if delay > self.max_wait:
+                raise ProviderThrottled(f"{self.provider} is rate limiting requests, try again in {int(delay) + 1} seconds") from error
+        if remaining is not None and delay >= remaining:
+            return None
+        with self._lock:
+            self.retries += 1
+        print(f"{self.provider} request failed ({error}), retrying in {delay:.1f}s (attempt {attempt + 1}/{self.max_attempts})")
+        return delay
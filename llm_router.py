@@ -0,0 +1,180 @@
+import asyncio
+import contextlib
+import functools
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# Number of latest requests kept per route (a provider and model) for its latency percentiles and error rate,
+# can be overridden with LLM_ROUTER_WINDOW
+DEFAULT_WINDOW = 100
+
+# Successful requests a route needs before its p95 latency is trusted for hedging, can be overridden with
+# LLM_ROUTER_MIN_SAMPLES
+DEFAULT_MIN_SAMPLES = 10
+
+# The circuit of a route opens after this many failures in a row, or once this share of its window failed.
+# Can be overridden with LLM_BREAKER_FAILURES and LLM_BREAKER_ERROR_RATE.
+DEFAULT_BREAKER_FAILURES = 3
+DEFAULT_BREAKER_ERROR_RATE = 0.5
+
+# Seconds an open circuit rejects requests before it lets one through to test the route again,
+# can be overridden with LLM_BREAKER_COOLDOWN
+DEFAULT_BREAKER_COOLDOWN = 30
+
+_routes = {}
+_routes_lock = threading.Lock()
+
+# Raised when the circuits of all the routes of a request are open
+class ProviderUnavailable(RuntimeError):
+    pass
+
+# Function to get the health of a route, shared by all sessions
+def get_route_health(key):
+    with _routes_lock:
+        if key not in _routes:
+            _routes[key] = RouteHealth(
+                window=int(os.getenv("LLM_ROUTER_WINDOW", DEFAULT_WINDOW)),
+                min_samples=int(os.getenv("LLM_ROUTER_MIN_SAMPLES", DEFAULT_MIN_SAMPLES)),
+                breaker_failures=int(os.getenv("LLM_BREAKER_FAILURES", DEFAULT_BREAKER_FAILURES)),
+                breaker_error_rate=float(os.getenv("LLM_BREAKER_ERROR_RATE", DEFAULT_BREAKER_ERROR_RATE)),
+                breaker_cooldown=float(os.getenv("LLM_BREAKER_COOLDOWN", DEFAULT_BREAKER_COOLDOWN)),
+            )
+        return _routes[key]
+
+# Rolling latencies and outcomes of the requests sent to a route, with a circuit breaker.
+# Only requests that reached the provider are recorded, cached responses would make it look faster than it is.
+class RouteHealth:
+    def __init__(self, window=DEFAULT_WINDOW, min_samples=DEFAULT_MIN_SAMPLES, breaker_failures=DEFAULT_BREAKER_FAILURES, breaker_error_rate=DEFAULT_BREAKER_ERROR_RATE, breaker_cooldown=DEFAULT_BREAKER_COOLDOWN):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.breaker_failures = breaker_failures
+        self.breaker_error_rate = breaker_error_rate
+        self.breaker_cooldown = breaker_cooldown
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def record_success(self, seconds):
+        with self._lock:
+            self.latencies.append(seconds)
+            self.outcomes.append(True)
+            self.consecutive_failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.outcomes.append(False)
+            self.consecutive_failures += 1
+            failed = self.outcomes.count(False)
+            if self.consecutive_failures >= self.breaker_failures or (
+                len(self.outcomes) >= self.min_samples and failed / len(self.outcomes) >= self.breaker_error_rate
+            ):
+                if self.opened_at is None:
+                    self.trips += 1
+                self.opened_at = time.monotonic()
+
+    # Returns whether a request may be sent to the route. Once the cooldown of an open circuit has passed, one request
+    # is let through and the cooldown starts again; its success closes the circuit.
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - self.opened_at >= self.breaker_cooldown:
+                self.opened_at = now
+                return True
+            return False
+
+    # Returns the q-th percentile of the latencies of successful requests, None until there are min_samples of them
+    def percentile(self, q):
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            return float(np.percentile(self.latencies, q))
+
+    def stats(self):
+        p50, p95 = self.percentile(50), self.percentile(95)
+        with self._lock:
+            return {
+                "requests": len(self.outcomes),
+                "p50": p50,
+                "p95": p95,
+                "error_rate": self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0,
+                "open": self.opened_at is not None,
+                "trips": self.trips,
+            }
+
+# Context manager recording the latency or the failure of the request made inside it in the health of route key.
+# Cancelled requests, such as the slower of two hedged requests, are not recorded.
+@contextlib.contextmanager
+def measured(key):
+    health = get_route_health(key)
+    started = time.monotonic()
+    try:
+        yield
+    except Exception:
+        health.record_failure()
+        raise
+    health.record_success(time.monotonic() - started)
+
+# Function to call the generator of the first route whose circuit is closed with prompt. routes is a list of
+# (key, async generator) in order of preference. A request still running after the p95 latency of its route is sent
+# to the next route as well (a hedged request), and the first result wins; the other request is cancelled.
+# A failed request is sent to the next route straight away. Raises the first error once every route failed.
+async def route_request(routes, prompt):
+    remaining = iter(routes)
+    pending = {}
+    started = {}
+    errors = []
+    hedges_left = True
+
+    def start_next():
+        for key, generate in remaining:
+            if get_route_health(key).allow():
+                task = asyncio.ensure_future(generate(prompt))
+                pending[task] = key
+                started[task] = time.monotonic()
+                return True
+        return False
+
+    if not start_next():
+        raise ProviderUnavailable("The circuits of all the model providers are open after repeated failures, try again shortly")
+    try:
+        while pending:
+            timeout = None
+            if hedges_left:
+                latest = max(pending, key=started.get)
+                p95 = get_route_health(pending[latest]).percentile(95)
+                if p95 is not None:
+                    timeout = max(0.0, started[latest] + p95 - time.monotonic())
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                hedges_left = start_next()
+                continue
+            for task in done:
+                del pending[task]
+                if task.exception() is None:
+                    return task.result()
+                errors.append(task.exception())
+                if hedges_left:
+                    hedges_left = start_next()
+        raise errors[0]
+    finally:
+        for task in pending:
+            task.cancel()
+
+# Function to combine the generators of several routes into one per stage, going through route_request.
+# routes is a list of (key, {stage: async generator}) in order of preference; each stage is routed to the routes
+# that have a generator for it.
+def routed_generators(routes):
+    stages = {}
+    for key, generators in routes:
+        for stage, generate in generators.items():
+            stages.setdefault(stage, []).append((key, generate))
+    return {stage: functools.partial(route_request, candidates) for stage, candidates in stages.items()}
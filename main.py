@@ -1,21 +1,34 @@
 #main.py
 
 import base64
+import concurrent.futures
 import requests
 import streamlit as st
 import streamlit.components.v1 as components
-from github import Github
-from collections import defaultdict
-import re
 import os
+import time
+from functools import partial
 from dotenv import load_dotenv
-
-from threat_model import create_threat_model_prompt, get_threat_model, get_threat_model_azure, get_threat_model_google, get_threat_model_mistral, get_threat_model_ollama, json_to_markdown, get_image_analysis, create_image_analysis_prompt
-from attack_tree import create_attack_tree_prompt, get_attack_tree, get_attack_tree_azure, get_attack_tree_mistral, get_attack_tree_ollama
-from mitigations import create_mitigations_prompt, get_mitigations, get_mitigations_azure, get_mitigations_google, get_mitigations_mistral, get_mitigations_ollama
-from test_cases import create_test_cases_prompt, get_test_cases, get_test_cases_azure, get_test_cases_google, get_test_cases_mistral, get_test_cases_ollama
-from dread import create_dread_assessment_prompt, get_dread_assessment, get_dread_assessment_azure, get_dread_assessment_google, get_dread_assessment_mistral, get_dread_assessment_ollama, dread_json_to_markdown
-from ast_analysis import create_ast_analysis_prompt, get_ast_analysis, get_ast_analysis_azure, get_ast_analysis_google, get_ast_analysis_mistral, get_ast_analysis_ollama, ast_json_to_markdown
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+from threat_model import create_threat_model_prompt, get_threat_model_async, get_threat_model_azure_async, get_threat_model_google_async, get_threat_model_mistral_async, get_threat_model_ollama_async, get_threat_model_stream, get_threat_model_azure_stream, get_threat_model_google_stream, get_threat_model_mistral_stream, get_threat_model_ollama_stream, THREAT_MODEL_MARKDOWN_HEADER, threat_markdown_row, get_similar_threat_model, put_similar_threat_model, json_to_markdown, get_image_analysis, create_image_analysis_prompt
+from attack_tree import create_attack_tree_prompt, strip_mermaid_code_block, get_attack_tree_stream, get_attack_tree_azure_stream, get_attack_tree_mistral_stream, get_attack_tree_ollama_stream, get_attack_tree_async, get_attack_tree_azure_async, get_attack_tree_mistral_async, get_attack_tree_ollama_async
+from mitigations import create_mitigations_prompt, get_mitigations_stream, get_mitigations_azure_stream, get_mitigations_google_stream, get_mitigations_mistral_stream, get_mitigations_ollama_stream, get_mitigations_async, get_mitigations_azure_async, get_mitigations_google_async, get_mitigations_mistral_async, get_mitigations_ollama_async
+from test_cases import create_test_cases_prompt, get_test_cases_stream, get_test_cases_azure_stream, get_test_cases_google_stream, get_test_cases_mistral_stream, get_test_cases_ollama_stream, get_test_cases_async, get_test_cases_azure_async, get_test_cases_google_async, get_test_cases_mistral_async, get_test_cases_ollama_async
+from dread import create_dread_assessment_prompt, get_dread_assessment_async, get_dread_assessment_azure_async, get_dread_assessment_google_async, get_dread_assessment_mistral_async, get_dread_assessment_ollama_async, get_dread_assessment_stream, get_dread_assessment_azure_stream, get_dread_assessment_google_stream, get_dread_assessment_mistral_stream, get_dread_assessment_ollama_stream, DREAD_MARKDOWN_HEADER, dread_markdown_row, dread_json_to_markdown
+from ast_analysis import create_ast_analysis_prompt, get_ast_analysis_stream, get_ast_analysis_azure_stream, get_ast_analysis_google_stream, get_ast_analysis_mistral_stream, get_ast_analysis_ollama_stream, AST_MARKDOWN_HEADER, ast_markdown_row, ast_json_to_markdown
+from repo_analysis import analyze_github_repo, analyze_github_repo_archive, analyze_github_repo_graphql, analyze_local_repo, merge_service_descriptions, summarize_repository
+from summary_cache import get_summary_cache
+from file_selection import parse_globs
+from services import service_label
+from code_index import DESCRIPTION_TOKEN_BUDGET, iter_indexed, load_or_build_code_index
+from repo_summary import summarize_repository_map_reduce, get_directory_summary, get_directory_summary_azure, get_directory_summary_google, get_directory_summary_mistral, get_directory_summary_ollama
+from pipeline import create_assessment_stages, run_pipeline
+from llm_cache import get_llm_cache, route_key
+from llm_router import get_route_health, routed_generators
+from llm_retry import get_retry_controller
+from json_stream import JsonArrayStream, parse_json_response
+from llm_clients import DEFAULT_CONNECT_TIMEOUT, deadline, run_async, stage_timeout
 
 # ------------------ Helper Functions ------------------ #
 def load_css():
@@ -30,23 +43,116 @@ def load_css():
 
 # Function to get user input for the application description and key details
 def get_input():
-    github_url = st.text_input(
-        label="Enter GitHub repository URL (optional)",
-        placeholder="https://github.com/owner/repo",
-        key="github_url",
-        help="Enter the URL of the GitHub repository you want to analyze.",
+    ingestion_mode = st.radio(
+        label="Repository ingestion mode",
+        options=["GitHub API", "GitHub GraphQL", "Archive download", "Local checkout"],
+        key="github_ingestion_mode",
+        horizontal=True,
+        help="GitHub API fetches each file separately. GitHub GraphQL fetches dozens of files per request, which cuts the number of round trips and rate limit points used. Archive download fetches the whole repository as a single tarball, which is faster and uses far less of the GitHub rate limit on large repositories. Local checkout reads a directory or bare git repository on this machine without any network access.",
     )
 
+    if ingestion_mode == "Local checkout":
+        github_url = st.text_input(
+            label="Enter the path of a local repository checkout (optional)",
+            placeholder="/path/to/repo",
+            key="github_url",
+            help="Enter the path of a working tree or bare git repository on the machine running this app. Files excluded by .gitignore are skipped.",
+        )
+    else:
+        github_url = st.text_input(
+            label="Enter GitHub repository URL (optional)",
+            placeholder="https://github.com/owner/repo",
+            key="github_url",
+            help="Enter the URL of the GitHub repository you want to analyze.",
+        )
+
+    exclude_globs = parse_globs(st.text_input(
+        label="Paths to exclude from the repository analysis (optional)",
+        placeholder="docs/*, *_test.go, legacy/**",
+        key="github_exclude_globs",
+        help="Comma-separated glob patterns. Vendored dependencies, generated and minified files and files over the size limit are always skipped.",
+    ))
+
+    by_service = False
+    if ingestion_mode in ("Archive download", "Local checkout"):
+        by_service = st.checkbox(
+            label="Summarize each service separately (monorepo)",
+            key="github_by_service",
+            help="Detects service roots from manifests such as package.json, go.mod, pyproject.toml and Dockerfile and summarizes the services in parallel. Each service can then be threat modelled on its own, or all of them together.",
+        )
+
+    map_reduce = st.checkbox(
+        label="Summarize large repositories with the LLM",
+        key="github_map_reduce",
+        help="Instead of truncating the code summary to fit the prompt, directories are summarized with the selected model and reduced into an architecture summary. Directory summaries are cached, so re-runs only summarize the directories that changed.",
+    )
+    use_code_index = st.checkbox(
+        label="Retrieve the most relevant code for each STRIDE category",
+        key="github_code_index",
+        help="Indexes the summaries of all repository files locally and adds the code most relevant to each STRIDE category to the threat model prompt, with a shorter repository description. This keeps the prompt small on large codebases.",
+    )
+
+    describe = None
+    if map_reduce:
+        complete, cache_namespace = get_repo_summary_complete()
+        describe = partial(summarize_repository_map_reduce, complete=complete, cache=get_summary_cache(), cache_namespace=cache_namespace)
+
+    # Collect the summaries of the files for the code index as the description reads them, the description itself
+    # gets a smaller budget. Files past the description's budget are then read for the index alone, up to its budget.
+    indexed_summaries = []
+    if use_code_index:
+        def describe(repo_url, summaries, token_budget, describe=describe or summarize_repository):
+            summaries = iter_indexed(summaries, indexed_summaries)
+            description = describe(repo_url, summaries, min(token_budget, DESCRIPTION_TOKEN_BUDGET))
+            for _ in summaries:
+                pass
+            return description
+
     if github_url and github_url != st.session_state.get('last_analyzed_url', ''):
-        if 'github_api_key' not in st.session_state or not st.session_state['github_api_key']:
+        if ingestion_mode == "Local checkout" and not os.path.isdir(github_url):
+            st.warning("The local repository path does not exist or is not a directory.")
+        elif ingestion_mode != "Local checkout" and not st.session_state.get('github_api_key'):
             st.warning("Please enter a GitHub API key to analyze the repository.")
         else:
             with st.spinner('Analyzing GitHub repository...'):
-                system_description = analyze_github_repo(github_url)
+                service_descriptions = None
+                if ingestion_mode == "Local checkout" and by_service:
+                    service_descriptions = analyze_local_repo(github_url, cache=get_summary_cache(), exclude_globs=exclude_globs, by_service=True, describe=describe)
+                elif ingestion_mode == "Archive download" and by_service:
+                    service_descriptions = analyze_github_repo_archive(github_url, st.session_state['github_api_key'], cache=get_summary_cache(), exclude_globs=exclude_globs, by_service=True, describe=describe)
+                elif ingestion_mode == "Local checkout":
+                    system_description = analyze_local_repo(github_url, cache=get_summary_cache(), exclude_globs=exclude_globs, describe=describe)
+                elif ingestion_mode == "GitHub GraphQL":
+                    system_description = analyze_github_repo_graphql(github_url, st.session_state['github_api_key'], cache=get_summary_cache(), exclude_globs=exclude_globs, describe=describe)
+                elif ingestion_mode == "Archive download":
+                    system_description = analyze_github_repo_archive(github_url, st.session_state['github_api_key'], cache=get_summary_cache(), exclude_globs=exclude_globs, describe=describe)
+                else:
+                    system_description = analyze_github_repo(github_url, st.session_state['github_api_key'], cache=get_summary_cache(), exclude_globs=exclude_globs, describe=describe)
+                if service_descriptions is not None:
+                    system_description = merge_service_descriptions(service_descriptions)
+                    st.session_state['github_service'] = None
+                st.session_state['service_descriptions'] = service_descriptions
+                st.session_state['code_index'] = load_or_build_code_index(
+                    [(path, summary) for path, summary in indexed_summaries if path.lower() != 'readme.md']
+                ) if use_code_index else None
                 st.session_state['github_analysis'] = system_description
                 st.session_state['last_analyzed_url'] = github_url
                 st.session_state['app_input'] = system_description + "\n\n" + st.session_state.get('app_input', '')
 
+    # Swap the repository analysis in the description for the selected service
+    service_descriptions = st.session_state.get('service_descriptions')
+    if service_descriptions:
+        service = st.selectbox(
+            label="Service to threat model",
+            options=[None] + list(service_descriptions),
+            format_func=lambda root: "All services (merged)" if root is None else service_label(root),
+            key="github_service",
+        )
+        system_description = merge_service_descriptions(service_descriptions) if service is None else service_descriptions[service]
+        if system_description != st.session_state['github_analysis']:
+            st.session_state['app_input'] = st.session_state.get('app_input', '').replace(st.session_state['github_analysis'], system_description, 1)
+            st.session_state['github_analysis'] = system_description
+
     input_text = st.text_area(
         label="Describe the application to be modelled",
         value=st.session_state.get('app_input', ''),
@@ -60,80 +166,165 @@ def get_input():
 
     return input_text
 
-def analyze_github_repo(repo_url):
-    # Extract owner and repo name from URL
-    parts = repo_url.split('/')
-    owner = parts[-2]
-    repo_name = parts[-1]
-
-    # Initialize PyGithub
-    g = Github(st.session_state.get('github_api_key', ''))
-
-    # Get the repository
-    repo = g.get_repo(f"{owner}/{repo_name}")
-
-    # Get the default branch
-    default_branch = repo.default_branch
-
-    # Get the tree of the default branch
-    tree = repo.get_git_tree(default_branch, recursive=True)
-
-    # Analyze files
-    file_summaries = defaultdict(list)
-    total_chars = 0
-    char_limit = 100000  # Adjust this based on your model's token limit
-    readme_content = ""
-
-    for file in tree.tree:
-        if file.path.lower() == 'readme.md':
-            content = repo.get_contents(file.path, ref=default_branch)
-            readme_content = base64.b64decode(content.content).decode()
-        elif file.type == "blob" and file.path.endswith(('.py', '.js', '.ts', '.html', '.css', '.java', '.go', '.rb')):
-            content = repo.get_contents(file.path, ref=default_branch)
-            decoded_content = base64.b64decode(content.content).decode()
-
-            # Summarize the file content
-            summary = summarize_file(file.path, decoded_content)
-            file_summaries[file.path.split('.')[-1]].append(summary)
-
-            total_chars += len(summary)
-            if total_chars > char_limit:
-                break
-
-    # Compile the analysis into a system description
-    system_description = f"Repository: {repo_url}\n\n"
-
-    if readme_content:
-        system_description += "README.md Content:\n"
-        # Truncate README if it's too long
-        if len(readme_content) > 5000:
-            system_description += readme_content[:5000] + "...\n(README truncated due to length)\n\n"
-        else:
-            system_description += readme_content + "\n\n"
-
-    for file_type, summaries in file_summaries.items():
-        system_description += f"{file_type.upper()} Files:\n"
-        for summary in summaries:
-            system_description += summary + "\n"
-        system_description += "\n"
-
-    return system_description
-
-def summarize_file(file_path, content):
-    # Extract important parts of the file
-    imports = re.findall(r'^import .*|^from .* import .*', content, re.MULTILINE)
-    functions = re.findall(r'def .*\(.*\):', content)
-    classes = re.findall(r'class .*:', content)
-
-    summary = f"File: {file_path}\n"
-    if imports:
-        summary += "Imports:\n" + "\n".join(imports[:5]) + "\n"  # Limit to first 5 imports
-    if functions:
-        summary += "Functions:\n" + "\n".join(functions[:5]) + "\n"  # Limit to first 5 functions
-    if classes:
-        summary += "Classes:\n" + "\n".join(classes[:5]) + "\n"  # Limit to first 5 classes
-
-    return summary
+# Function to build the LLM call used to summarize large repositories with the selected model provider.
+# Returns the call and a namespace that keeps the cached summaries of different models apart.
+def get_repo_summary_complete():
+    if model_provider == "Azure OpenAI Service":
+        return partial(get_directory_summary_azure, azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name), f"azure:{azure_deployment_name}"
+    elif model_provider == "OpenAI API":
+        return partial(get_directory_summary, openai_api_key, selected_model), f"openai:{selected_model}"
+    elif model_provider == "Google AI API":
+        return partial(get_directory_summary_google, google_api_key, google_model), f"google:{google_model}"
+    elif model_provider == "Mistral API":
+        return partial(get_directory_summary_mistral, mistral_api_key, mistral_model), f"mistral:{mistral_model}"
+    elif model_provider == "Ollama":
+        return partial(get_directory_summary_ollama, ollama_model), f"ollama:{ollama_model}"
+
+# Version of the Azure OpenAI API, update this as needed
+AZURE_API_VERSION = '2023-12-01-preview'
+
+# Provider names used by the LLM cache and retry controllers for each model provider
+PROVIDER_KEYS = {
+    "Azure OpenAI Service": "azure",
+    "OpenAI API": "openai",
+    "Google AI API": "google",
+    "Mistral API": "mistral",
+    "Ollama": "ollama",
+}
+
+# Function to get a key identifying the selected model, for caching its outputs
+def get_model_key():
+    if model_provider == "Azure OpenAI Service":
+        return f"azure:{azure_api_endpoint}:{azure_deployment_name}"
+    elif model_provider == "OpenAI API":
+        return f"openai:{selected_model}"
+    elif model_provider == "Google AI API":
+        return f"google:{google_model}"
+    elif model_provider == "Mistral API":
+        return f"mistral:{mistral_model}"
+    elif model_provider == "Ollama":
+        return f"ollama:{ollama_model}"
+
+# Async generator of each assessment stage for each model provider.
+# Google's safety filters prevent the reliable generation of attack trees.
+ASSESSMENT_GENERATORS = {
+    "Azure OpenAI Service": {
+        "threat_model": get_threat_model_azure_async,
+        "attack_tree": get_attack_tree_azure_async,
+        "mitigations": get_mitigations_azure_async,
+        "dread": get_dread_assessment_azure_async,
+        "test_cases": get_test_cases_azure_async,
+    },
+    "OpenAI API": {
+        "threat_model": get_threat_model_async,
+        "attack_tree": get_attack_tree_async,
+        "mitigations": get_mitigations_async,
+        "dread": get_dread_assessment_async,
+        "test_cases": get_test_cases_async,
+    },
+    "Google AI API": {
+        "threat_model": get_threat_model_google_async,
+        "mitigations": get_mitigations_google_async,
+        "dread": get_dread_assessment_google_async,
+        "test_cases": get_test_cases_google_async,
+    },
+    "Mistral API": {
+        "threat_model": get_threat_model_mistral_async,
+        "attack_tree": get_attack_tree_mistral_async,
+        "mitigations": get_mitigations_mistral_async,
+        "dread": get_dread_assessment_mistral_async,
+        "test_cases": get_test_cases_mistral_async,
+    },
+    "Ollama": {
+        "threat_model": get_threat_model_ollama_async,
+        "attack_tree": get_attack_tree_ollama_async,
+        "mitigations": get_mitigations_ollama_async,
+        "dread": get_dread_assessment_ollama_async,
+        "test_cases": get_test_cases_ollama_async,
+    },
+}
+
+# Model used when a provider is the secondary provider of hedged requests
+SECONDARY_MODELS = {
+    "OpenAI API": "gpt-4o-mini",
+    "Google AI API": "gemini-1.5-pro-latest",
+    "Mistral API": "mistral-small-latest",
+}
+
+# Function to get the arguments the generators of the selected model provider take before the prompt
+def get_model_args():
+    if model_provider == "Azure OpenAI Service":
+        return (azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name)
+    elif model_provider == "OpenAI API":
+        return (openai_api_key, selected_model)
+    elif model_provider == "Google AI API":
+        return (google_api_key, google_model)
+    elif model_provider == "Mistral API":
+        return (mistral_api_key, mistral_model)
+    elif model_provider == "Ollama":
+        return (ollama_model,)
+
+# Function to get the arguments the generators of a secondary provider take before the prompt, from the credentials
+# saved in the session state. Returns None when they are missing.
+def get_secondary_model_args(provider):
+    if provider == "Azure OpenAI Service":
+        args = (st.session_state.get('azure_api_endpoint'), st.session_state.get('azure_api_key'), AZURE_API_VERSION, st.session_state.get('azure_deployment_name'))
+    elif provider == "OpenAI API":
+        args = (st.session_state.get('openai_api_key'), SECONDARY_MODELS[provider])
+    elif provider == "Google AI API":
+        args = (st.session_state.get('google_api_key'), SECONDARY_MODELS[provider])
+    elif provider == "Mistral API":
+        args = (st.session_state.get('mistral_api_key'), SECONDARY_MODELS[provider])
+    else:
+        # Ollama is not offered as a secondary provider, a single local model has no spare capacity to hedge with
+        raise ValueError(f"{provider} cannot be used as a secondary provider")
+    return args if all(args) else None
+
+# Function to get the async generator of each assessment stage for a model provider, taking the prompt
+def get_assessment_generators(provider, args):
+    return {name: partial(generate, *args, use_cache=use_llm_cache) for name, generate in ASSESSMENT_GENERATORS[provider].items()}
+
+# Function to pass through a stream of response chunks, recording in timings the seconds until the first
+# content ("first_content") and until the end of the stream ("total")
+def timed_stream(chunks, timings):
+    started = time.monotonic()
+    for chunk in chunks:
+        if chunk and "first_content" not in timings:
+            timings["first_content"] = time.monotonic() - started
+        yield chunk
+    timings["total"] = time.monotonic() - started
+    timings.setdefault("first_content", timings["total"])
+
+# Function to check whether the user reran the app or left the page since this script run started.
+# Streamlit only stops a script at its next st call, so long waits check this to cancel their requests early.
+def script_run_cancelled():
+    script_requests = getattr(get_script_run_ctx(suppress_warning=True), "script_requests", None)
+    # ScriptRequests has no public accessor for its state, CONTINUE is the state of a run nobody asked to stop.
+    # This private attribute was checked against Streamlit 1.65; if a release renames it, requests are just not
+    # cancelled early and Streamlit still stops the script at its next st call.
+    try:
+        return script_requests is not None and script_requests._state.name != "CONTINUE"
+    except AttributeError:
+        return False
+
+# Function to render the rows of a streamed JSON response into placeholder as soon as each one is complete.
+# key is the top-level key of the array of rows, header the Markdown table header and row the function converting
+# one object to a table row. Records the seconds until the first row in timings ("first_row") and returns the
+# whole response text.
+def stream_markdown_rows(chunks, key, header, row, placeholder, timings):
+    started = time.monotonic()
+    parser = JsonArrayStream(key)
+    response_text = ""
+    rows = ""
+    for chunk in timed_stream(chunks, timings):
+        response_text += chunk
+        items = [item for item in parser.feed(chunk) if isinstance(item, dict)]
+        if items:
+            timings.setdefault("first_row", time.monotonic() - started)
+            rows += "".join(row(item) for item in items)
+            placeholder.markdown(header + rows)
+    timings.setdefault("first_row", timings["total"])
+    return response_text
 
 # Function to render Mermaid diagram
 def mermaid(code: str, height: int = 500) -> None:
@@ -279,7 +470,7 @@ with st.sidebar:
 
         st.info("Please note that you must use an 1106-preview model deployment.")
 
-        azure_api_version = '2023-12-01-preview' # Update this as needed
+        azure_api_version = AZURE_API_VERSION
 
         st.write(f"Azure API Version: {azure_api_version}")
 
@@ -336,7 +527,7 @@ with st.sidebar:
     if model_provider == "Ollama":
         # Make a request to the Ollama API to get the list of available models
         try:
-            response = requests.get("http://localhost:11434/api/tags")
+            response = requests.get("http://localhost:11434/api/tags", timeout=DEFAULT_CONNECT_TIMEOUT)
             response.raise_for_status() # Raise an exception for 4xx/5xx status codes
         except requests.exceptions.RequestException as e:
             st.error("Ollama endpoint not found, please select a different model provider.")
@@ -364,6 +555,33 @@ with st.sidebar:
     if github_api_key:
         st.session_state['github_api_key'] = github_api_key
 
+    # Add a toggle for answering repeated requests from the LLM response cache
+    use_llm_cache = st.checkbox(
+        "Reuse cached model responses",
+        value=True,
+        key="use_llm_cache",
+        help="Requests identical to an earlier one (same provider, model and prompt) are answered from a local cache instead of calling the model again. Untick to always get a fresh response, which then replaces the cached one.",
+    )
+    llm_cache_stats = get_llm_cache().stats()
+    st.caption(
+        f"Response cache: {llm_cache_stats['memory_hits'] + llm_cache_stats['disk_hits']} hits, "
+        f"{llm_cache_stats['misses']} misses ({llm_cache_stats['hit_rate']:.0%} hit rate), "
+        f"{llm_cache_stats['entries']} responses stored, {llm_cache_stats['coalesced']} duplicate requests saved"
+    )
+    retry_stats = get_retry_controller(PROVIDER_KEYS[model_provider]).stats()
+    st.caption(
+        f"Provider requests: {retry_stats['retries']} retried, {retry_stats['rate_limited']} rate limited, "
+        f"{retry_stats['waited']:.0f}s spent waiting for the request budget"
+    )
+
+    # Add an optional secondary provider for the requests of the full assessment
+    hedge_provider = st.selectbox(
+        "Secondary provider for the full assessment:",
+        ["None"] + [provider for provider in PROVIDER_KEYS if provider not in (model_provider, "Ollama")],
+        key="hedge_provider",
+        help="Requests still running after the usual (95th percentile) latency of the selected provider are also sent to this one, and the first answer is used. Providers failing repeatedly are skipped for a while. Uses the API key entered for it earlier or set in the environment.",
+    )
+
     st.markdown("""---""")
 
 # Add "About" section to the sidebar
@@ -401,7 +619,7 @@ with st.sidebar:
     st.markdown(
         """
     ### **Do you store the application details provided?**
-    No, STRIDE GPT does not store your application description or other details. All entered data is deleted after you close the browser tab.
+    STRIDE GPT does not keep your application description or other details once you close the browser tab. To answer repeated requests instantly, the model responses, and the threat models used to answer near-identical application descriptions, are cached on the machine running the app for up to a week (see `LLM_CACHE_TTL_HOURS`); set `LLM_CACHE_TTL_HOURS=0` to disable the cache.
     """
     )
     st.markdown(
@@ -426,7 +644,7 @@ with st.sidebar:
 
 # ------------------ Main App UI ------------------ #
 
-tab1, tab2, tab3, tab4, tab5 = st.tabs(["Threat Model", "Attack Tree", "Mitigations", "DREAD", "AST Analysis"])
+tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["Threat Model", "Attack Tree", "Mitigations", "DREAD", "AST Analysis", "Test Cases"])
 
 with tab1:
     st.markdown("""
@@ -453,7 +671,7 @@ understanding possible vulnerabilities and attack vectors. Use this tab to gener
                 else:
                     if 'uploaded_file' not in st.session_state or st.session_state.uploaded_file != uploaded_file:
                         st.session_state.uploaded_file = uploaded_file
-                        with st.spinner("Analysing the uploaded image..."):
+                        with st.spinner("Analysing the uploaded image..."), deadline(stage_timeout()):
                             def encode_image(uploaded_file):
                                 return base64.b64encode(uploaded_file.read()).decode('utf-8')
 
@@ -641,25 +859,46 @@ understanding possible vulnerabilities and attack vectors. Use this tab to gener
     if threat_model_submit_button and st.session_state.get('app_input'):
         app_input = st.session_state['app_input']  # Retrieve from session state
         # Generate the prompt using the create_prompt function
-        threat_model_prompt = create_threat_model_prompt(app_type, authentication, internet_facing, sensitive_data, app_input,selected_data_classes,deployment_infra,data_storage_location)
+        threat_model_prompt = create_threat_model_prompt(app_type, authentication, internet_facing, sensitive_data, app_input,selected_data_classes,deployment_infra,data_storage_location, code_index=st.session_state.get('code_index'))
+
+        # Reuse the threat model generated for a near-identical application description, if any
+        similarity, model_output = get_similar_threat_model(get_model_key(), threat_model_prompt, app_input) if use_llm_cache else (0.0, None)
+        if model_output:
+            threat_model = model_output.get("threat_model", [])
+            improvement_suggestions = model_output.get("improvement_suggestions", [])
+            st.session_state['threat_model'] = threat_model
+            st.info(f"Reused the threat model generated for a near-identical application description ({similarity:.0%} similar). Untick \"Reuse cached model responses\" in the sidebar to generate a new one.")
+
+        # Placeholder showing the threats as they are generated, then the whole threat model
+        threat_model_placeholder = st.empty()
+
+        # Function to stream the threat model, showing each threat as soon as it is complete, then parse the whole response.
+        # Transient errors are retried by the provider's controller, this only retries responses that are not valid JSON.
+        def generate_threat_model():
+            if model_provider == "Azure OpenAI Service":
+                chunks = get_threat_model_azure_stream(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, threat_model_prompt, use_cache=use_llm_cache)
+            elif model_provider == "OpenAI API":
+                chunks = get_threat_model_stream(openai_api_key, selected_model, threat_model_prompt, use_cache=use_llm_cache)
+            elif model_provider == "Google AI API":
+                chunks = get_threat_model_google_stream(google_api_key, google_model, threat_model_prompt, use_cache=use_llm_cache)
+            elif model_provider == "Mistral API":
+                chunks = get_threat_model_mistral_stream(mistral_api_key, mistral_model, threat_model_prompt, use_cache=use_llm_cache)
+            elif model_provider == "Ollama":
+                chunks = get_threat_model_ollama_stream(ollama_model, threat_model_prompt, use_cache=use_llm_cache)
+
+            timings = {}
+            model_output = parse_json_response(stream_markdown_rows(chunks, "threat_model", THREAT_MODEL_MARKDOWN_HEADER, threat_markdown_row, threat_model_placeholder, timings))
+            if not model_output:
+                raise ValueError("The model response is not valid JSON")
+            st.caption(f"First threat after {timings['first_row']:.1f}s, complete after {timings['total']:.1f}s")
+            return model_output
 
         # Show a spinner while generating the threat model
-        with st.spinner("Analysing potential threats..."):
-            max_retries = 3
-            retry_count = 0
-            while retry_count < max_retries:
-                try:
-                    # Call the relevant get_threat_model function with the generated prompt
-                    if model_provider == "Azure OpenAI Service":
-                        model_output = get_threat_model_azure(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, threat_model_prompt)
-                    elif model_provider == "OpenAI API":
-                        model_output = get_threat_model(openai_api_key, selected_model, threat_model_prompt)
-                    elif model_provider == "Google AI API":
-                        model_output = get_threat_model_google(google_api_key, google_model, threat_model_prompt)
-                    elif model_provider == "Mistral API":
-                        model_output = get_threat_model_mistral(mistral_api_key, mistral_model, threat_model_prompt)
-                    elif model_provider == "Ollama":
-                        model_output = get_threat_model_ollama(ollama_model, threat_model_prompt)
+        with st.spinner("Analysing potential threats..."), deadline(stage_timeout()):
+            try:
+                if not model_output:
+                    retry_controller = get_retry_controller(PROVIDER_KEYS[model_provider])
+                    model_output = retry_controller.call(generate_threat_model, acquire=False, retryable=lambda e: isinstance(e, ValueError))
 
                     # Access the threat model and improvement suggestions from the parsed content
                     threat_model = model_output.get("threat_model", [])
@@ -667,21 +906,17 @@ understanding possible vulnerabilities and attack vectors. Use this tab to gener
 
                     # Save the threat model to the session state for later use in mitigations
                     st.session_state['threat_model'] = threat_model
-                    break  # Exit the loop if successful
-                except Exception as e:
-                    retry_count += 1
-                    if retry_count == max_retries:
-                        st.error(f"Error generating threat model after {max_retries} attempts: {e}")
-                        threat_model = []
-                        improvement_suggestions = []
-                    else:
-                        st.warning(f"Error generating threat model. Retrying attempt {retry_count+1}/{max_retries}...")
+                    put_similar_threat_model(get_model_key(), threat_model_prompt, app_input, model_output)
+            except Exception as e:
+                st.error(f"Error generating threat model: {e}")
+                threat_model = []
+                improvement_suggestions = []
 
         # Convert the threat model JSON to Markdown
         markdown_output = json_to_markdown(threat_model, improvement_suggestions)
 
         # Display the threat model in Markdown
-        st.markdown(markdown_output)
+        threat_model_placeholder.markdown(markdown_output)
 
         # Add a button to allow the user to download the output as a Markdown file
         st.download_button(
@@ -691,8 +926,97 @@ understanding possible vulnerabilities and attack vectors. Use this tab to gener
             mime="text/markdown",
        )
 
+    # ------------------ Full Assessment ------------------ #
+
+    # Create a submit button for running every stage of the assessment at once
+    full_assessment_submit_button = st.button(
+        label="Run Full Assessment",
+        help="Generate the threat model, attack tree, mitigations, DREAD assessment and test cases in one go. Stages that do not depend on each other run concurrently, and stages whose inputs have not changed since the last run are reused.",
+    )
+
+    # If the Run Full Assessment button is clicked and the user has provided an application description
+    if full_assessment_submit_button and st.session_state.get('app_input'):
+        app_input = st.session_state['app_input']
+        threat_model_prompt = create_threat_model_prompt(app_type, authentication, internet_facing, sensitive_data, app_input,selected_data_classes,deployment_infra,data_storage_location, code_index=st.session_state.get('code_index'))
+        attack_tree_prompt = create_attack_tree_prompt(app_type, authentication, internet_facing, sensitive_data, app_input,selected_data_classes,deployment_infra,data_storage_location)
+        generators = get_assessment_generators(model_provider, get_model_args())
+        routes = [(route_key(PROVIDER_KEYS[model_provider], get_model_args()), generators)]
+        if hedge_provider != "None":
+            secondary_args = get_secondary_model_args(hedge_provider)
+            if secondary_args is None:
+                st.warning(f"No credentials saved for {hedge_provider}, running the assessment without a secondary provider.")
+            else:
+                routes.append((route_key(PROVIDER_KEYS[hedge_provider], secondary_args), get_assessment_generators(hedge_provider, secondary_args)))
+                generators = routed_generators(routes)
+        stages = create_assessment_stages(generators, app_input, threat_model_prompt, attack_tree_prompt, get_model_key(), reuse_similar=use_llm_cache)
+
+        # Show a spinner while running the assessment
+        with st.spinner("Running the full assessment..."):
+            started = time.monotonic()
+            try:
+                outputs, errors, timings = run_async(run_pipeline(stages, memo=st.session_state.setdefault('pipeline_memo', {})), should_cancel=script_run_cancelled)
+            except concurrent.futures.CancelledError:
+                # The requests were cancelled because the user reran the app or left, let Streamlit carry on with that
+                st.stop()
+            elapsed = time.monotonic() - started
+
+        st.caption(
+            f"Completed in {elapsed:.1f}s (stages took {sum(timings.values()):.1f}s in total: "
+            + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in timings.items())
+            + ")"
+        )
+        if len(routes) > 1:
+            route_captions = []
+            for provider, (key, _) in zip((model_provider, hedge_provider), routes):
+                health = get_route_health(key).stats()
+                if health["p95"] is None:
+                    route_captions.append(f"{provider}: {health['requests']} requests, not enough for latency percentiles yet")
+                else:
+                    route_captions.append(f"{provider}: p50 {health['p50']:.1f}s, p95 {health['p95']:.1f}s, {health['error_rate']:.0%} errors")
+                if health["open"]:
+                    route_captions[-1] += " (skipped after repeated failures)"
+            st.caption("; ".join(route_captions))
+        for name, error in errors.items():
+            st.error(f"Error running the {name.replace('_', ' ')} stage: {error}")
+
+        if "threat_model" in outputs:
+            if outputs["threat_model"].get("reused_similarity"):
+                st.info(f"Reused the threat model generated for a near-identical application description ({outputs['threat_model']['reused_similarity']:.0%} similar). Untick \"Reuse cached model responses\" in the sidebar to generate a new one.")
+            threat_model = outputs["threat_model"].get("threat_model", [])
+            improvement_suggestions = outputs["threat_model"].get("improvement_suggestions", [])
+            # Save the threat model to the session state for later use in mitigations
+            st.session_state['threat_model'] = threat_model
+
+            st.subheader("Threat Model")
+            markdown_output = json_to_markdown(threat_model, improvement_suggestions)
+            st.markdown(markdown_output)
+            st.download_button(
+                label="Download Threat Model",
+                data=markdown_output,
+                file_name="stride_gpt_threat_model.md",
+                mime="text/markdown",
+                key="full_assessment_threat_model_download",
+            )
+
+        if "attack_tree" in outputs:
+            st.subheader("Attack Tree")
+            st.code(outputs["attack_tree"])
+            mermaid(outputs["attack_tree"])
+
+        if "mitigations" in outputs:
+            st.subheader("Mitigations")
+            st.markdown(outputs["mitigations"])
+
+        if "dread" in outputs:
+            st.subheader("DREAD Assessment")
+            st.markdown(dread_json_to_markdown(outputs["dread"]))
+
+        if "test_cases" in outputs:
+            st.subheader("Test Cases")
+            st.markdown(outputs["test_cases"])
+
 # If the submit button is clicked and the user has not provided an application description
-if threat_model_submit_button and not st.session_state.get('app_input'):
+if (threat_model_submit_button or full_assessment_submit_button) and not st.session_state.get('app_input'):
     st.error("Please enter your application details before submitting.")
 
 
@@ -718,27 +1042,35 @@ vulnerabilities and prioritising mitigation efforts.
         attack_tree_submit_button = st.button(label="Generate Attack Tree")
 
         # If the Generate Attack Tree button is clicked and the user has provided an application description
-        if attack_tree_submit_button and attack_tree_submit_button.get('app_input'):
-            app_input = attack_tree_submit_button.get('app_input')
+        if attack_tree_submit_button and st.session_state.get('app_input'):
+            app_input = st.session_state['app_input']
             # Generate the prompt using the create_attack_tree_prompt function
-            attack_tree_prompt = create_attack_tree_prompt(app_type, authentication, internet_facing, sensitive_data, app_input)
+            attack_tree_prompt = create_attack_tree_prompt(app_type, authentication, internet_facing, sensitive_data, app_input,selected_data_classes,deployment_infra,data_storage_location)
 
             # Show a spinner while generating the attack tree
-            with st.spinner("Generating attack tree..."):
+            with st.spinner("Generating attack tree..."), deadline(stage_timeout()):
                 try:
-                    # Call the relevant get_attack_tree function with the generated prompt
+                    # Call the relevant get_attack_tree function with the generated prompt, streaming the response
                     if model_provider == "Azure OpenAI Service":
-                        mermaid_code = get_attack_tree_azure(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, attack_tree_prompt)
+                        chunks = get_attack_tree_azure_stream(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, attack_tree_prompt, use_cache=use_llm_cache)
                     elif model_provider == "OpenAI API":
-                        mermaid_code = get_attack_tree(openai_api_key, selected_model, attack_tree_prompt)
+                        chunks = get_attack_tree_stream(openai_api_key, selected_model, attack_tree_prompt, use_cache=use_llm_cache)
                     elif model_provider == "Mistral API":
-                        mermaid_code = get_attack_tree_mistral(mistral_api_key, mistral_model, attack_tree_prompt)
+                        chunks = get_attack_tree_mistral_stream(mistral_api_key, mistral_model, attack_tree_prompt, use_cache=use_llm_cache)
                     elif model_provider == "Ollama":
-                        mermaid_code = get_attack_tree_ollama(ollama_model, attack_tree_prompt)
+                        chunks = get_attack_tree_ollama_stream(ollama_model, attack_tree_prompt, use_cache=use_llm_cache)
 
-                    # Display the generated attack tree code
+                    # Display the attack tree code as it is generated
                     st.write("Attack Tree Code:")
-                    st.code(mermaid_code)
+                    code_placeholder = st.empty()
+                    timings = {}
+                    mermaid_code = ""
+                    for chunk in timed_stream(chunks, timings):
+                        mermaid_code += chunk
+                        code_placeholder.code(mermaid_code)
+                    mermaid_code = strip_mermaid_code_block(mermaid_code)
+                    code_placeholder.code(mermaid_code)
+                    st.caption(f"First content after {timings['first_content']:.1f}s, complete after {timings['total']:.1f}s")
 
                     # Visualise the attack tree using the Mermaid custom component
                     st.write("Attack Tree Diagram Preview:")
@@ -799,33 +1131,27 @@ the security posture of the application and protect against potential attacks.
             mitigations_prompt = create_mitigations_prompt(threats_markdown)
 
             # Show a spinner while suggesting mitigations
-            with st.spinner("Suggesting mitigations..."):
-                max_retries = 3
-                retry_count = 0
-                while retry_count < max_retries:
-                    try:
-                        # Call the relevant get_mitigations function with the generated prompt
-                        if model_provider == "Azure OpenAI Service":
-                            mitigations_markdown = get_mitigations_azure(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, mitigations_prompt)
-                        elif model_provider == "OpenAI API":
-                            mitigations_markdown = get_mitigations(openai_api_key, selected_model, mitigations_prompt)
-                        elif model_provider == "Google AI API":
-                            mitigations_markdown = get_mitigations_google(google_api_key, google_model, mitigations_prompt)
-                        elif model_provider == "Mistral API":
-                            mitigations_markdown = get_mitigations_mistral(mistral_api_key, mistral_model, mitigations_prompt)
-                        elif model_provider == "Ollama":
-                            mitigations_markdown = get_mitigations_ollama(ollama_model, mitigations_prompt)
-
-                        # Display the suggested mitigations in Markdown
-                        st.markdown(mitigations_markdown)
-                        break  # Exit the loop if successful
-                    except Exception as e:
-                        retry_count += 1
-                        if retry_count == max_retries:
-                            st.error(f"Error suggesting mitigations after {max_retries} attempts: {e}")
-                            mitigations_markdown = ""
-                        else:
-                            st.warning(f"Error suggesting mitigations. Retrying attempt {retry_count+1}/{max_retries}...")
+            with st.spinner("Suggesting mitigations..."), deadline(stage_timeout()):
+                try:
+                    # Call the relevant get_mitigations function with the generated prompt, streaming the response
+                    if model_provider == "Azure OpenAI Service":
+                        chunks = get_mitigations_azure_stream(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, mitigations_prompt, use_cache=use_llm_cache)
+                    elif model_provider == "OpenAI API":
+                        chunks = get_mitigations_stream(openai_api_key, selected_model, mitigations_prompt, use_cache=use_llm_cache)
+                    elif model_provider == "Google AI API":
+                        chunks = get_mitigations_google_stream(google_api_key, google_model, mitigations_prompt, use_cache=use_llm_cache)
+                    elif model_provider == "Mistral API":
+                        chunks = get_mitigations_mistral_stream(mistral_api_key, mistral_model, mitigations_prompt, use_cache=use_llm_cache)
+                    elif model_provider == "Ollama":
+                        chunks = get_mitigations_ollama_stream(ollama_model, mitigations_prompt, use_cache=use_llm_cache)
+
+                    # Display the suggested mitigations in Markdown as they are generated
+                    timings = {}
+                    mitigations_markdown = st.write_stream(timed_stream(chunks, timings)) or ""
+                    st.caption(f"First content after {timings['first_content']:.1f}s, complete after {timings['total']:.1f}s")
+                except Exception as e:
+                    st.error(f"Error suggesting mitigations: {e}")
+                    mitigations_markdown = ""
             
             st.markdown("")
 
@@ -866,25 +1192,32 @@ Discoverability – how easy is it to discover the threat?.
             dread_prompt = create_dread_assessment_prompt(dread_input)
 
             # Show a spinner while generating DREAD assessment
-            with st.spinner("Generating DREAD assessment..."):
+            with st.spinner("Generating DREAD assessment..."), deadline(stage_timeout()):
                 try:
-                    # Call the relevant get_attack_tree function with the generated prompt
+                    # Call the relevant get_dread_assessment function with the generated prompt, streaming the response
                     if model_provider == "Azure OpenAI Service":
-                        dread_results = get_dread_assessment_azure(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, dread_prompt)
+                        chunks = get_dread_assessment_azure_stream(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, dread_prompt, use_cache=use_llm_cache)
                     elif model_provider == "OpenAI API":
-                        dread_results = get_dread_assessment(openai_api_key, selected_model, dread_prompt)
+                        chunks = get_dread_assessment_stream(openai_api_key, selected_model, dread_prompt, use_cache=use_llm_cache)
+                    elif model_provider == "Google AI API":
+                        chunks = get_dread_assessment_google_stream(google_api_key, google_model, dread_prompt, use_cache=use_llm_cache)
                     elif model_provider == "Mistral API":
-                        dread_results = get_dread_assessment_mistral(mistral_api_key, mistral_model, dread_prompt)
+                        chunks = get_dread_assessment_mistral_stream(mistral_api_key, mistral_model, dread_prompt, use_cache=use_llm_cache)
                     elif model_provider == "Ollama":
-                        dread_results = get_dread_assessment_ollama(ollama_model, dread_prompt)
+                        chunks = get_dread_assessment_ollama_stream(ollama_model, dread_prompt, use_cache=use_llm_cache)
 
-                    # Display the generated DREAD assessment
+                    # Display the generated DREAD assessment, each threat as soon as it is complete
                     st.write("DREAD Assessment:")
+                    dread_placeholder = st.empty()
+                    timings = {}
+                    dread_results = parse_json_response(stream_markdown_rows(chunks, "Risk Assessment", DREAD_MARKDOWN_HEADER, dread_markdown_row, dread_placeholder, timings))
+
                     # Convert the DREAD JSON to Markdown
                     dread_markdown_output = dread_json_to_markdown(dread_results)
 
                     # Display the threat model in Markdown
-                    st.markdown(dread_markdown_output)
+                    dread_placeholder.markdown(dread_markdown_output)
+                    st.caption(f"First threat after {timings['first_row']:.1f}s, complete after {timings['total']:.1f}s")
 
                     st.download_button(
                         label="Download DREAD Assessment",
@@ -918,25 +1251,32 @@ previously to provide a summary of each vulnerability in non-technical terms, an
             ast_prompt = create_ast_analysis_prompt(ast_input.read())
 
             # Show a spinner while generating AST assessment
-            with st.spinner("Generating AST Analysis..."):
+            with st.spinner("Generating AST Analysis..."), deadline(stage_timeout()):
                 try:
-                    # Call the relevant get_attack_tree function with the generated prompt
+                    # Call the relevant get_ast_analysis function with the generated prompt, streaming the response
                     if model_provider == "Azure OpenAI Service":
-                        ast_results = get_ast_analysis_azure(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, ast_prompt)
+                        chunks = get_ast_analysis_azure_stream(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, ast_prompt, use_cache=use_llm_cache)
                     elif model_provider == "OpenAI API":
-                        ast_results = get_ast_analysis(openai_api_key, selected_model, ast_prompt)
+                        chunks = get_ast_analysis_stream(openai_api_key, selected_model, ast_prompt, use_cache=use_llm_cache)
+                    elif model_provider == "Google AI API":
+                        chunks = get_ast_analysis_google_stream(google_api_key, google_model, ast_prompt, use_cache=use_llm_cache)
                     elif model_provider == "Mistral API":
-                        ast_results = get_ast_analysis_mistral(mistral_api_key, mistral_model, ast_prompt)
+                        chunks = get_ast_analysis_mistral_stream(mistral_api_key, mistral_model, ast_prompt, use_cache=use_llm_cache)
                     elif model_provider == "Ollama":
-                        ast_results = get_ast_analysis_ollama(ollama_model, ast_prompt)
+                        chunks = get_ast_analysis_ollama_stream(ollama_model, ast_prompt, use_cache=use_llm_cache)
 
-                    # Display the generated AST assessment
+                    # Display the generated AST assessment, each vulnerability as soon as it is complete
                     st.write("AST Analysis:")
+                    ast_placeholder = st.empty()
+                    timings = {}
+                    ast_results = parse_json_response(stream_markdown_rows(chunks, "AST Analysis", AST_MARKDOWN_HEADER, ast_markdown_row, ast_placeholder, timings))
+
                     # Convert the AST Analysis JSON to Markdown
                     ast_markdown_output = ast_json_to_markdown(ast_results)
 
                     # Display the threat model in Markdown
-                    st.markdown(ast_markdown_output)
+                    ast_placeholder.markdown(ast_markdown_output)
+                    st.caption(f"First vulnerability after {timings['first_row']:.1f}s, complete after {timings['total']:.1f}s")
 
                     st.download_button(
                         label="Download AST Analysis",
@@ -947,3 +1287,53 @@ previously to provide a summary of each vulnerability in non-technical terms, an
                         )
                 except Exception as e:
                     st.error(f"Error generating AST analysis: {e}")
+
+# ------------------ Test Cases Generation ------------------ #
+
+with tab6:
+    st.markdown("""
+Use this tab to generate Gherkin test cases for the threats identified in the threat model. The test cases describe how to verify
+that the application is protected against each threat, and can be used as a starting point for security testing.
+""")
+    st.markdown("""---""")
+
+    # Create a submit button for Test Cases
+    test_cases_submit_button = st.button(label="Generate Test Cases")
+
+    # If the Generate Test Cases button is clicked and the user has identified threats
+    if test_cases_submit_button:
+        if st.session_state.get('threat_model'):
+            # Convert the threat_model data into a Markdown list and generate the prompt
+            test_cases_prompt = create_test_cases_prompt(json_to_markdown(st.session_state['threat_model'], []))
+
+            # Show a spinner while generating test cases
+            with st.spinner("Generating test cases..."), deadline(stage_timeout()):
+                try:
+                    # Call the relevant get_test_cases function with the generated prompt, streaming the response
+                    if model_provider == "Azure OpenAI Service":
+                        chunks = get_test_cases_azure_stream(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, test_cases_prompt, use_cache=use_llm_cache)
+                    elif model_provider == "OpenAI API":
+                        chunks = get_test_cases_stream(openai_api_key, selected_model, test_cases_prompt, use_cache=use_llm_cache)
+                    elif model_provider == "Google AI API":
+                        chunks = get_test_cases_google_stream(google_api_key, google_model, test_cases_prompt, use_cache=use_llm_cache)
+                    elif model_provider == "Mistral API":
+                        chunks = get_test_cases_mistral_stream(mistral_api_key, mistral_model, test_cases_prompt, use_cache=use_llm_cache)
+                    elif model_provider == "Ollama":
+                        chunks = get_test_cases_ollama_stream(ollama_model, test_cases_prompt, use_cache=use_llm_cache)
+
+                    # Display the test cases in Markdown as they are generated
+                    timings = {}
+                    test_cases_markdown = st.write_stream(timed_stream(chunks, timings)) or ""
+                    st.caption(f"First content after {timings['first_content']:.1f}s, complete after {timings['total']:.1f}s")
+
+                    # Add a button to allow the user to download the test cases as a Markdown file
+                    st.download_button(
+                        label="Download Test Cases",
+                        data=test_cases_markdown,
+                        file_name="test_cases.md",
+                        mime="text/markdown",
+                    )
+                except Exception as e:
+                    st.error(f"Error generating test cases: {e}")
+        else:
+            st.error("Please generate a threat model first before generating test cases.")
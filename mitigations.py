@@ -1,9 +1,12 @@
-import requests
-from mistralai import Mistral
-from openai import OpenAI, AzureOpenAI
-
+import json
 import google.generativeai as genai
 
+from llm_clients import configure_google, get_async_azure_openai_client, get_async_http_client, get_async_mistral_client, get_async_openai_client, get_azure_openai_client, get_http_session, get_mistral_client, get_openai_client, google_request_options, provider_limit
+from llm_cache import cached_generation, cached_stream
+
+# System prompt shared by all providers, and by the sync, async and streaming variants so that they share cache entries
+MITIGATIONS_SYSTEM_PROMPT = "You are a helpful assistant that provides threat mitigation strategies in Markdown format."
+
 # Function to create a prompt to generate mitigating controls
 def create_mitigations_prompt(threats):
     prompt = f"""
@@ -23,13 +26,14 @@ YOUR RESPONSE (do not wrap in a code block):
 
 
 # Function to get mitigations from the GPT response.
+@cached_generation("openai")
 def get_mitigations(api_key, model_name, prompt):
-    client = OpenAI(api_key=api_key)
+    client = get_openai_client(api_key)
 
     response = client.chat.completions.create(
         model = model_name,
         messages=[
-            {"role": "system", "content": "You are a helpful assistant that provides threat mitigation strategies in Markdown format."},
+            {"role": "system", "content": MITIGATIONS_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ]
     )
@@ -41,17 +45,14 @@ def get_mitigations(api_key, model_name, prompt):
 
 
 # Function to get mitigations from the Azure OpenAI response.
+@cached_generation("azure")
 def get_mitigations_azure(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, prompt):
-    client = AzureOpenAI(
-        azure_endpoint = azure_api_endpoint,
-        api_key = azure_api_key,
-        api_version = azure_api_version,
-    )
+    client = get_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version)
 
     response = client.chat.completions.create(
         model = azure_deployment_name,
         messages=[
-            {"role": "system", "content": "You are a helpful assistant that provides threat mitigation strategies in Markdown format."},
+            {"role": "system", "content": MITIGATIONS_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ]
     )
@@ -62,13 +63,14 @@ def get_mitigations_azure(azure_api_endpoint, azure_api_key, azure_api_version,
     return mitigations
 
 # Function to get mitigations from the Google model's response.
+@cached_generation("google")
 def get_mitigations_google(google_api_key, google_model, prompt):
-    genai.configure(api_key=google_api_key)
+    configure_google(google_api_key)
     model = genai.GenerativeModel(
         google_model,
-        system_instruction="You are a helpful assistant that provides threat mitigation strategies in Markdown format.",
+        system_instruction=MITIGATIONS_SYSTEM_PROMPT,
     )
-    response = model.generate_content(prompt)
+    response = model.generate_content(prompt, request_options=google_request_options())
     try:
         # Extract the text content from the 'candidates' attribute
         mitigations = response.candidates[0].content.parts[0].text
@@ -83,13 +85,14 @@ def get_mitigations_google(google_api_key, google_model, prompt):
     return mitigations
 
 # Function to get mitigations from the Mistral model's response.
+@cached_generation("mistral")
 def get_mitigations_mistral(mistral_api_key, mistral_model, prompt):
-    client = Mistral(api_key=mistral_api_key)
+    client = get_mistral_client(mistral_api_key)
 
     response = client.chat.complete(
         model = mistral_model,
         messages=[
-            {"role": "system", "content": "You are a helpful assistant that provides threat mitigation strategies in Markdown format."},
+            {"role": "system", "content": MITIGATIONS_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ]
     )
@@ -100,6 +103,7 @@ def get_mitigations_mistral(mistral_api_key, mistral_model, prompt):
     return mitigations
 
 # Function to get mitigations from Ollama hosted LLM.
+@cached_generation("ollama")
 def get_mitigations_ollama(ollama_model, prompt):
     
     url = "http://localhost:11434/api/chat"
@@ -110,18 +114,192 @@ def get_mitigations_ollama(ollama_model, prompt):
         "messages": [
             {
                 "role": "system", 
-                "content": "You are a helpful assistant that provides threat mitigation strategies in Markdown format."},
+                "content": MITIGATIONS_SYSTEM_PROMPT},
             {
                 "role": "user",
                 "content": prompt
             }
         ]
     }
-    response = requests.post(url, json=data)
+    response = get_http_session().post(url, json=data)
 
     outer_json = response.json()
     
     # Access the 'content' attribute of the 'message' dictionary
     mitigations = outer_json["message"]["content"]
 
-    return mitigations
\ No newline at end of file
+    return mitigations
+# Async variants of the functions above, for running several generations at once from one event loop.
+# Each provider's requests are limited by its semaphore in llm_clients.
+
+@cached_generation("openai")
+async def get_mitigations_async(api_key, model_name, prompt):
+    client = get_async_openai_client(api_key)
+
+    async with provider_limit("openai"):
+        response = await client.chat.completions.create(
+            model = model_name,
+            messages=[
+                {"role": "system", "content": MITIGATIONS_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
+        )
+
+    return response.choices[0].message.content
+
+@cached_generation("azure")
+async def get_mitigations_azure_async(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, prompt):
+    client = get_async_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version)
+
+    async with provider_limit("azure"):
+        response = await client.chat.completions.create(
+            model = azure_deployment_name,
+            messages=[
+                {"role": "system", "content": MITIGATIONS_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
+        )
+
+    return response.choices[0].message.content
+
+@cached_generation("google")
+async def get_mitigations_google_async(google_api_key, google_model, prompt):
+    configure_google(google_api_key)
+    model = genai.GenerativeModel(
+        google_model,
+        system_instruction=MITIGATIONS_SYSTEM_PROMPT,
+    )
+
+    async with provider_limit("google"):
+        response = await model.generate_content_async(prompt, request_options=google_request_options())
+    try:
+        # Extract the text content from the 'candidates' attribute
+        mitigations = response.candidates[0].content.parts[0].text
+        # Replace '\n' with actual newline characters
+        mitigations = mitigations.replace('\\n', '\n')
+    except (IndexError, AttributeError) as e:
+        print(f"Error accessing response content: {str(e)}")
+        print("Raw response:")
+        print(response)
+        return None
+
+    return mitigations
+
+@cached_generation("mistral")
+async def get_mitigations_mistral_async(mistral_api_key, mistral_model, prompt):
+    client = get_async_mistral_client(mistral_api_key)
+
+    async with provider_limit("mistral"):
+        response = await client.chat.complete_async(
+            model = mistral_model,
+            messages=[
+                {"role": "system", "content": MITIGATIONS_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
+        )
+
+    return response.choices[0].message.content
+
+@cached_generation("ollama")
+async def get_mitigations_ollama_async(ollama_model, prompt):
+    url = "http://localhost:11434/api/chat"
+
+    data = {
+        "model": ollama_model,
+        "stream": False,
+        "messages": [
+            {"role": "system", "content": MITIGATIONS_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    }
+
+    async with provider_limit("ollama"):
+        response = await get_async_http_client().post(url, json=data)
+
+    return response.json()["message"]["content"]
+
+# Streaming variants of the functions above, yielding the response text as it is generated.
+# They share their cache entries with the non-streaming functions.
+
+@cached_stream("openai", get_mitigations)
+def get_mitigations_stream(api_key, model_name, prompt):
+    client = get_openai_client(api_key)
+
+    with client.chat.completions.create(
+        model = model_name,
+        messages=[
+            {"role": "system", "content": MITIGATIONS_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        stream=True,
+    ) as stream:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+@cached_stream("azure", get_mitigations_azure)
+def get_mitigations_azure_stream(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, prompt):
+    client = get_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version)
+
+    with client.chat.completions.create(
+        model = azure_deployment_name,
+        messages=[
+            {"role": "system", "content": MITIGATIONS_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        stream=True,
+    ) as stream:
+        for chunk in stream:
+            # Azure sends chunks without choices for its content filter results
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+@cached_stream("google", get_mitigations_google)
+def get_mitigations_google_stream(google_api_key, google_model, prompt):
+    configure_google(google_api_key)
+    model = genai.GenerativeModel(
+        google_model,
+        system_instruction=MITIGATIONS_SYSTEM_PROMPT,
+    )
+    for chunk in model.generate_content(prompt, stream=True, request_options=google_request_options()):
+        if chunk.parts:
+            yield chunk.text.replace('\\n', '\n')
+
+@cached_stream("mistral", get_mitigations_mistral)
+def get_mitigations_mistral_stream(mistral_api_key, mistral_model, prompt):
+    client = get_mistral_client(mistral_api_key)
+
+    stream = client.chat.stream(
+        model = mistral_model,
+        messages=[
+            {"role": "system", "content": MITIGATIONS_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    )
+    for event in stream:
+        if event.data.choices and event.data.choices[0].delta.content:
+            yield event.data.choices[0].delta.content
+
+@cached_stream("ollama", get_mitigations_ollama)
+def get_mitigations_ollama_stream(ollama_model, prompt):
+    url = "http://localhost:11434/api/chat"
+
+    data = {
+        "model": ollama_model,
+        "stream": True,
+        "messages": [
+            {"role": "system", "content": MITIGATIONS_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    }
+
+    # Ollama streams one JSON object per line, the last one has "done" set
+    with get_http_session().post(url, json=data, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                message = json.loads(line)
+                if message.get("message", {}).get("content"):
+                    yield message["message"]["content"]
+                if message.get("done"):
+                    break
@@ -0,0 +1,155 @@
+import asyncio
+import hashlib
+import json
+import time
+
+from dread import create_dread_assessment_prompt
+from llm_clients import DeadlineExceeded, deadline, stage_timeout
+from mitigations import create_mitigations_prompt
+from test_cases import create_test_cases_prompt
+from threat_model import get_similar_threat_model, json_to_markdown, put_similar_threat_model
+
+# A stage of a pipeline. run(**inputs) is a coroutine receiving the output of each dependency by name.
+# params holds everything else the output depends on (prompts, model names) and is part of the memo key.
+# A stage still running timeout seconds after it started is cancelled, its provider requests time out by then too.
+class Stage:
+    def __init__(self, name, run, deps=(), params=None, timeout=None):
+        self.name = name
+        self.run = run
+        self.deps = tuple(deps)
+        self.params = params
+        self.timeout = timeout
+
+# Raised for the stages that could not run because one of their dependencies failed
+class SkippedStage(Exception):
+    pass
+
+# Function to hash a JSON-serializable value
+def digest_of(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+# Function to check that the dependencies of the stages exist and form no cycle
+def check_stages(stages):
+    by_name = {stage.name: stage for stage in stages}
+    visiting, done = set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Pipeline stages have a dependency cycle through '{name}'")
+        if name not in by_name:
+            raise ValueError(f"Pipeline stage '{name}' does not exist")
+        visiting.add(name)
+        for dep in by_name[name].deps:
+            visit(dep)
+        visiting.discard(name)
+        done.add(name)
+
+    for stage in stages:
+        visit(stage.name)
+
+# Function to run the stages of a pipeline, each as soon as all of its dependencies are done.
+# Independent stages run concurrently, so the pipeline takes as long as its critical path.
+# Outputs are memoized in memo by a hash of the stage name, its params and its inputs, so a stage whose
+# dependencies were recomputed but produced the same outputs is not run again. Empty outputs are not memoized.
+# Returns ({name: output}, {name: exception}, {name: seconds}); memoized stages take 0 seconds.
+async def run_pipeline(stages, memo=None):
+    check_stages(stages)
+    loop = asyncio.get_running_loop()
+    done = {stage.name: loop.create_future() for stage in stages}
+    outputs, errors, timings = {}, {}, {}
+
+    async def execute(stage):
+        try:
+            inputs = {}
+            digests = []
+            for dep in stage.deps:
+                try:
+                    inputs[dep], digest = await asyncio.shield(done[dep])
+                except Exception as e:
+                    raise SkippedStage(f"'{dep}' failed") from e
+                digests.append(digest)
+
+            key = digest_of([stage.name, stage.params, digests])
+            if memo is not None and key in memo:
+                output = memo[key]
+                timings[stage.name] = 0.0
+            else:
+                started = time.monotonic()
+                if stage.timeout is None:
+                    output = await stage.run(**inputs)
+                else:
+                    with deadline(stage.timeout):
+                        try:
+                            output = await asyncio.wait_for(stage.run(**inputs), stage.timeout)
+                        except TimeoutError as e:
+                            raise DeadlineExceeded(f"'{stage.name}' did not finish within {stage.timeout:.0f} seconds") from e
+                timings[stage.name] = time.monotonic() - started
+                # Empty outputs are failed generations, the next run tries again
+                if memo is not None and output:
+                    memo[key] = output
+
+            outputs[stage.name] = output
+            done[stage.name].set_result((output, digest_of(output)))
+        except Exception as e:
+            errors[stage.name] = e
+            done[stage.name].set_exception(e)
+            # Mark the exception as retrieved, dependents see it through their own await
+            done[stage.name].exception()
+
+    await asyncio.gather(*(execute(stage) for stage in stages))
+    return outputs, errors, timings
+
+# Function to create the stages of a full assessment: ingestion, then the threat model, then the attack
+# tree, mitigations, DREAD assessment and test cases. generators maps each stage to its async get_* function
+# taking the prompt; stages without a generator (e.g. attack trees on Google) are left out.
+# The attack tree is built from the application description alone, so it does not wait for the threat model.
+# With reuse_similar, the threat model generated for a near-identical description is reused, and flagged with
+# its similarity under "reused_similarity". reuse_similar follows the cache toggle the generators were given, so it is
+# part of the memo key of every generating stage. A threat model the model failed to produce is an error of its stage.
+# Each generating stage is cancelled after timeout seconds.
+def create_assessment_stages(generators, app_input, threat_model_prompt, attack_tree_prompt, model_key, reuse_similar=True, timeout=None):
+    timeout = stage_timeout() if timeout is None else timeout
+
+    async def ingestion():
+        return app_input
+
+    async def threat_model(ingestion):
+        if reuse_similar:
+            similarity, model_output = get_similar_threat_model(model_key, threat_model_prompt, app_input)
+            if model_output:
+                return dict(model_output, reused_similarity=similarity)
+        model_output = await generators["threat_model"](threat_model_prompt)
+        if not model_output:
+            # The generators return None when the model output could not be parsed
+            raise ValueError("The model did not return a valid threat model")
+        put_similar_threat_model(model_key, threat_model_prompt, app_input, model_output)
+        return model_output
+
+    async def attack_tree(ingestion):
+        return await generators["attack_tree"](attack_tree_prompt)
+
+    def threats(threat_model):
+        if not threat_model or not threat_model.get("threat_model"):
+            raise ValueError("The threat model is empty")
+        return threat_model["threat_model"]
+
+    async def mitigations(threat_model):
+        return await generators["mitigations"](create_mitigations_prompt(json_to_markdown(threats(threat_model), [])))
+
+    async def dread(threat_model):
+        return await generators["dread"](create_dread_assessment_prompt(threats(threat_model)))
+
+    async def test_cases(threat_model):
+        return await generators["test_cases"](create_test_cases_prompt(json_to_markdown(threats(threat_model), [])))
+
+    stages = [
+        Stage("ingestion", ingestion, params=app_input),
+        Stage("threat_model", threat_model, ["ingestion"], {"prompt": threat_model_prompt, "model": model_key, "reuse_similar": reuse_similar}, timeout),
+        Stage("attack_tree", attack_tree, ["ingestion"], {"prompt": attack_tree_prompt, "model": model_key, "use_cache": reuse_similar}, timeout),
+        Stage("mitigations", mitigations, ["threat_model"], {"model": model_key, "use_cache": reuse_similar}, timeout),
+        Stage("dread", dread, ["threat_model"], {"model": model_key, "use_cache": reuse_similar}, timeout),
+        Stage("test_cases", test_cases, ["threat_model"], {"model": model_key, "use_cache": reuse_similar}, timeout),
+    ]
+    return [stage for stage in stages if stage.name == "ingestion" or stage.name in generators]
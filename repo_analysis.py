@@ -0,0 +1,697 @@
+import base64
+import mmap
+import os
+import re
+import subprocess
+import tarfile
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import islice
+
+import requests
+
+from file_selection import MINIFIED_SAMPLE_SIZE, filter_files, looks_minified, rank_files, skip_reason
+from github_client import get_github_client
+from services import find_service_roots, group_by_service, service_label
+from summarizers import SUMMARIZER_VERSION, summarize_file
+from summary_cache import git_blob_sha
+
+# File extensions that are summarized as part of the repository analysis
+SOURCE_EXTENSIONS = ('.py', '.js', '.ts', '.html', '.css', '.java', '.go', '.rb')
+
+# Default number of concurrent blob downloads, can be overridden with GITHUB_MAX_WORKERS
+DEFAULT_MAX_WORKERS = 8
+
+# Default size of the code summary in tokens, adjust this based on your model's token limit
+DEFAULT_TOKEN_BUDGET = 25000
+
+# Rough number of characters per token used to estimate the size of the summaries
+CHARS_PER_TOKEN = 4
+
+# Batching limits used by analyze_github_repo_graphql
+DEFAULT_GRAPHQL_BATCH_SIZE = 25
+GRAPHQL_MIN_BATCH_SIZE = 5
+GRAPHQL_MAX_BATCH_SIZE = 100
+GRAPHQL_BATCH_BYTES = 1024 * 1024
+GRAPHQL_LOW_RATE_LIMIT = 200
+GRAPHQL_TIMEOUT = 60
+
+# Entry of a recursive git tree listing, size is None for directories
+TreeEntry = namedtuple("TreeEntry", ["path", "type", "sha", "size"])
+
+# Function to resolve the configured number of concurrent downloads
+def get_max_workers(max_workers=None):
+    if max_workers is None:
+        max_workers = int(os.getenv('GITHUB_MAX_WORKERS', DEFAULT_MAX_WORKERS))
+    return max(1, max_workers)
+
+# Function to fetch items concurrently while yielding the results in their original order.
+# At most max_workers * 2 requests are queued ahead of the consumer, so stopping early
+# (e.g. once the token budget is used up) does not download the rest of the repository.
+def iter_fetched_in_order(fetch, items, max_workers):
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque((item, executor.submit(fetch, item)) for item in islice(items, max_workers * 2))
+        try:
+            while pending:
+                item, future = pending.popleft()
+                result = future.result()
+                for next_item in islice(items, 1):
+                    pending.append((next_item, executor.submit(fetch, next_item)))
+                yield item, result
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+def analyze_github_repo(repo_url, github_api_key, max_workers=None, token_budget=DEFAULT_TOKEN_BUDGET, cache=None, exclude_globs=(), describe=None):
+    def iter_fetched(client, full_name, ref, files, lookup, summarize):
+        def fetch(file):
+            summary = lookup(file)
+            if summary is not None:
+                return summary
+            return summarize(file, lambda: load_github_file(client, full_name, file))
+
+        return iter_fetched_in_order(fetch, files, get_max_workers(max_workers))
+
+    return analyze_github_tree(repo_url, github_api_key, iter_fetched, token_budget, cache, exclude_globs, describe)
+
+# Function to analyze a repository through the GitHub GraphQL API, fetching dozens of blobs per request.
+# graphql_url defaults to the GraphQL endpoint next to the configured REST API.
+def analyze_github_repo_graphql(repo_url, github_api_key, graphql_url=None, token_budget=DEFAULT_TOKEN_BUDGET, cache=None, exclude_globs=(), describe=None):
+    def iter_fetched(client, full_name, ref, files, lookup, summarize):
+        owner, name = full_name.split('/')
+        return iter_graphql_batches(client, graphql_url or f"{client.api_url}/graphql", owner, name, ref, files, lookup, summarize)
+
+    return analyze_github_tree(repo_url, github_api_key, iter_fetched, token_budget, cache, exclude_globs, describe)
+
+# Function to select, fetch and summarize the files of a GitHub repository tree.
+# iter_fetched(client, full_name, ref, files, lookup, summarize) yields (file, summary) in the order of files, where
+# lookup(file) returns an already known summary or None and summarize(file, load) summarizes a fetched file.
+# describe(repo_url, summaries, token_budget) builds the system description, summarize_repository by default.
+def analyze_github_tree(repo_url, github_api_key, iter_fetched, token_budget=DEFAULT_TOKEN_BUDGET, cache=None, exclude_globs=(), describe=None):
+    # Extract owner and repo name from URL
+    parts = repo_url.rstrip('/').split('/')
+    owner = parts[-2]
+    repo_name = parts[-1]
+
+    # Requests go through the shared client, which paces them to the rate limit and revalidates
+    # the repository and tree with conditional requests
+    client = get_github_client(github_api_key)
+    full_name = f"{owner}/{repo_name}"
+
+    # Get the default branch
+    default_branch = client.get_json(f"/repos/{full_name}")["default_branch"]
+
+    # Get the tree of the default branch
+    tree = client.get_json(f"/repos/{full_name}/git/trees/{default_branch}", params={"recursive": "1"})
+    if tree.get("truncated"):
+        print(f"The tree of {full_name} is too large for a single request and was truncated")
+
+    # Select the README and the source files to analyze, most security-relevant first.
+    # Vendored, generated and oversized files are dropped using the tree metadata alone.
+    selected = rank_files(
+        filter_files(
+            [
+                file for file in (TreeEntry(entry["path"], entry["type"], entry["sha"], entry.get("size")) for entry in tree["tree"])
+                if file.path.lower() == 'readme.md'
+                or (file.type == "blob" and file.path.endswith(SOURCE_EXTENSIONS))
+            ],
+            key=lambda file: (file.path, file.size),
+            exclude_globs=exclude_globs,
+        ),
+        key=lambda file: (file.path, file.size),
+    )
+
+    # Reuse the summaries of the last analysed tree, only added or modified blobs are fetched
+    snapshot_key = f"{owner}/{repo_name}@{default_branch}:{SUMMARIZER_VERSION}"
+    snapshot = cache.get_snapshot(snapshot_key) if cache is not None else None
+    previous_tree_sha, previous_entries = snapshot or (None, {})
+    if previous_tree_sha is not None:
+        added, modified, deleted = diff_tree_entries(previous_entries, {file.path: file.sha for file in selected})
+        print(f"Incremental analysis of {owner}/{repo_name}: {len(added)} added, {len(modified)} modified, {len(deleted)} deleted")
+
+    def lookup(file):
+        previous = previous_entries.get(file.path)
+        if previous is not None and previous[0] == file.sha:
+            return previous[1]
+        # Blobs with a cached summary are not downloaded at all
+        if cache is not None and file.path.lower() != 'readme.md':
+            return cache.get(file.sha, SUMMARIZER_VERSION)
+        return None
+
+    def summarize(file, load):
+        return summarize_blob(file.path, file.sha, load, cache)
+
+    entries = {}
+
+    def iter_summaries():
+        for file, summary in iter_fetched(client, full_name, default_branch, selected, lookup, summarize):
+            entries[file.path] = [file.sha, summary]
+            yield file.path, summary
+
+    system_description = (describe or summarize_repository)(repo_url, iter_summaries(), token_budget)
+
+    if cache is not None:
+        cache.put_snapshot(snapshot_key, tree["sha"], entries)
+
+    return system_description
+
+# Function to download and decode one file through the REST blobs API, returns None for minified code.
+# Blobs are immutable, so they are not kept in the response store.
+def load_github_file(client, full_name, file):
+    content = client.get_json(f"/repos/{full_name}/git/blobs/{file.sha}", conditional=False)["content"]
+    # Decode only the head of the blob to rule out minified code before decoding all of it
+    head = content[:MINIFIED_SAMPLE_SIZE * 2].replace("\n", "")
+    head = base64.b64decode(head[:len(head) // 4 * 4]).decode(errors="ignore")[:MINIFIED_SAMPLE_SIZE]
+    if looks_minified(file.path, head):
+        return None
+    return base64.b64decode(content).decode()
+
+# Function to fetch files in GraphQL batches, yielding (file, summary) in the order of files.
+# Known summaries are yielded without a request. The batch size grows while responses stay small or the
+# rate limit runs low (fewer, larger requests), and shrinks when responses get large or the server times out.
+def iter_graphql_batches(client, graphql_url, owner, name, ref, files, lookup, summarize):
+    batch_size = DEFAULT_GRAPHQL_BATCH_SIZE
+    queue = deque(files)
+
+    while queue:
+        group = []
+        known = {}
+        misses = []
+        batch_bytes = 0
+        while queue and len(misses) < batch_size:
+            file = queue[0]
+            if misses and batch_bytes + (file.size or 0) > GRAPHQL_BATCH_BYTES:
+                break
+            queue.popleft()
+            group.append(file)
+            summary = lookup(file)
+            if summary is None:
+                misses.append(file)
+                batch_bytes += file.size or 0
+            else:
+                known[file.path] = summary
+
+        try:
+            texts, remaining, response_bytes = fetch_graphql_blobs(client, graphql_url, owner, name, [f"{ref}:{file.path}" for file in misses]) if misses else ([], None, 0)
+        except (requests.exceptions.Timeout, requests.exceptions.HTTPError) as e:
+            if batch_size <= GRAPHQL_MIN_BATCH_SIZE:
+                raise
+            print(f"GraphQL batch of {len(misses)} files failed ({e}), retrying with smaller batches")
+            batch_size = max(GRAPHQL_MIN_BATCH_SIZE, batch_size // 2)
+            queue.extendleft(reversed(group))
+            continue
+
+        if response_bytes > GRAPHQL_BATCH_BYTES * 2:
+            batch_size = max(GRAPHQL_MIN_BATCH_SIZE, batch_size // 2)
+        elif (remaining is not None and remaining < GRAPHQL_LOW_RATE_LIMIT) or response_bytes < GRAPHQL_BATCH_BYTES // 2:
+            batch_size = min(GRAPHQL_MAX_BATCH_SIZE, batch_size * 2)
+
+        fetched = dict(zip((file.path for file in misses), texts))
+        for file in group:
+            if file.path in known:
+                yield file, known[file.path]
+            else:
+                text = fetched[file.path]
+                yield file, summarize(file, lambda: None if text is None or looks_minified(file.path, text[:MINIFIED_SAMPLE_SIZE]) else text)
+
+# Function to fetch the text of several blobs with one GraphQL query.
+# Returns the texts (None for binary or truncated blobs), the remaining rate limit and the response size.
+def fetch_graphql_blobs(client, graphql_url, owner, name, expressions):
+    variables = {"owner": owner, "name": name}
+    declarations = ["$owner: String!", "$name: String!"]
+    fields = []
+    for i, expression in enumerate(expressions):
+        variables[f"e{i}"] = expression
+        declarations.append(f"$e{i}: String!")
+        fields.append(f"f{i}: object(expression: $e{i}) {{ ... on Blob {{ text isBinary isTruncated }} }}")
+
+    query = (
+        f"query({', '.join(declarations)}) {{ "
+        "rateLimit { remaining } "
+        f"repository(owner: $owner, name: $name) {{ {' '.join(fields)} }} }}"
+    )
+
+    response = client.request("POST", graphql_url, resource="graphql", json={"query": query, "variables": variables}, timeout=GRAPHQL_TIMEOUT)
+    response.raise_for_status()
+    result = response.json()
+    if not result.get("data"):
+        raise RuntimeError(f"GraphQL query failed: {result.get('errors')}")
+
+    repository = result["data"]["repository"]
+    texts = []
+    for i in range(len(expressions)):
+        blob = repository.get(f"f{i}") or {}
+        texts.append(None if blob.get("isBinary") or blob.get("isTruncated") else blob.get("text"))
+
+    remaining = (result["data"].get("rateLimit") or {}).get("remaining")
+    return texts, remaining, len(response.content)
+
+# Function to diff the last snapshot ({path: [blob_sha, summary]}) against the current {path: blob_sha} mapping
+def diff_tree_entries(previous_entries, current_entries):
+    added = [path for path in current_entries if path not in previous_entries]
+    modified = [
+        path for path, blob_sha in current_entries.items()
+        if path in previous_entries and previous_entries[path][0] != blob_sha
+    ]
+    deleted = [path for path in previous_entries if path not in current_entries]
+    return added, modified, deleted
+
+# Function to analyze a repository from a single tarball download instead of one API call per file.
+# archive_url can point at any tarball (e.g. a locally served file); by default GitHub's archive link is used.
+# Only a top-level directory named like GitHub's wrapper of this repository is stripped from the paths of the archive.
+# The selected files are read into memory so they can be ranked before anything is summarized.
+# by_service=True returns {service root: system description} for monorepos, see summarize_services.
+def analyze_github_repo_archive(repo_url, github_api_key, archive_url=None, token_budget=DEFAULT_TOKEN_BUDGET, cache=None, exclude_globs=(), by_service=False, describe=None):
+    if archive_url is None:
+        parts = repo_url.rstrip('/').split('/')
+        client = get_github_client(github_api_key)
+        full_name = f"{parts[-2]}/{parts[-1]}"
+        default_branch = client.get_json(f"/repos/{full_name}")["default_branch"]
+        response = client.request("GET", f"/repos/{full_name}/tarball/{default_branch}", stream=True)
+    else:
+        response = requests.get(archive_url, stream=True)
+
+    with response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        all_paths = []
+        files = rank_files(list(iter_archive_files(response.raw, exclude_globs, all_paths, github_archive_wrapper(repo_url))), key=lambda file: (file[0], len(file[1].encode())))
+
+    if by_service:
+        return summarize_services(repo_url, all_paths, files, token_budget, cache, exclude_globs, describe=describe)
+    return (describe or summarize_repository)(repo_url, summarize_files(files, cache), token_budget)
+
+# Function to match the top-level directory GitHub wraps the tarball of a repository in, "owner-repo-sha"
+def github_archive_wrapper(repo_url):
+    parts = repo_url.rstrip('/').split('/')
+    return re.compile(re.escape(f"{parts[-2]}-{parts[-1]}-") + r"[0-9a-f]{7,40}", re.IGNORECASE)
+
+# Function to stream the README and source files out of a tar archive without writing them to disk.
+# A top-level directory matching the wrapper pattern (e.g. GitHub's "owner-repo-sha/") is stripped from the paths,
+# as is a leading "./"; any other directory is part of the path.
+# Skipped files are never read out of the archive and minified files are dropped after a small head sample.
+# The paths of all files in the archive are appended to all_paths when it is given.
+def iter_archive_files(fileobj, exclude_globs=(), all_paths=None, wrapper=None):
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            path = member.name
+            top, _, rest = path.partition('/')
+            if rest and (top == '.' or (wrapper is not None and wrapper.fullmatch(top))):
+                path = rest
+            if all_paths is not None:
+                all_paths.append(path)
+            if not (path.lower() == 'readme.md' or path.endswith(SOURCE_EXTENSIONS)):
+                continue
+            if skip_reason(path, member.size, exclude_globs) is not None:
+                continue
+            data = archive.extractfile(member)
+            head = data.read(MINIFIED_SAMPLE_SIZE)
+            if looks_minified(path, head.decode(errors="ignore")):
+                continue
+            yield path, (head + data.read()).decode()
+
+# Function to analyze a repository that is already checked out locally, without any network access.
+# Produces the same system description as the GitHub API path; repo_url only changes the header line.
+# by_service=True returns {service root: system description} for monorepos, see summarize_services.
+def analyze_local_repo(repo_path, repo_url=None, token_budget=DEFAULT_TOKEN_BUDGET, cache=None, exclude_globs=(), by_service=False, describe=None):
+    repo_url = repo_url or repo_path
+
+    if is_bare_git_repo(repo_path):
+        # Stream the tree of HEAD through the archive reader, the prefix stands in for GitHub's top-level directory
+        process = subprocess.Popen(
+            ["git", "--git-dir", repo_path, "archive", "--format=tar", "--prefix=repo/", "HEAD"],
+            stdout=subprocess.PIPE,
+        )
+        all_paths = []
+        try:
+            files = rank_files(list(iter_archive_files(process.stdout, exclude_globs, all_paths, re.compile("repo"))), key=lambda file: (file[0], len(file[1].encode())))
+        finally:
+            process.stdout.close()
+            process.wait()
+        if by_service:
+            return summarize_services(repo_url, all_paths, files, token_budget, cache, exclude_globs, describe=describe)
+        return (describe or summarize_repository)(repo_url, summarize_files(files, cache), token_budget)
+
+    # Sorting the relative paths reproduces the order of a recursive git tree listing before ranking
+    local_paths = sorted(iter_local_paths(repo_path))
+    paths = rank_files(filter_files([
+        (path, size) for path, size in local_paths
+        if path.lower() == 'readme.md' or path.endswith(SOURCE_EXTENSIONS)
+    ], exclude_globs=exclude_globs))
+    files = ((path, read_local_source(os.path.join(repo_path, path), path)) for path, _ in paths)
+
+    if by_service:
+        return summarize_services(repo_url, [path for path, _ in local_paths], files, token_budget, cache, exclude_globs, describe=describe)
+    return (describe or summarize_repository)(repo_url, summarize_files(files, cache), token_budget)
+
+# Function to check whether a path is a bare git repository rather than a working tree
+def is_bare_git_repo(repo_path):
+    return (
+        not os.path.exists(os.path.join(repo_path, '.git'))
+        and os.path.isfile(os.path.join(repo_path, 'HEAD'))
+        and os.path.isdir(os.path.join(repo_path, 'objects'))
+    )
+
+# Function to walk a working tree with os.scandir, yielding the relative POSIX path and size of files not excluded by .gitignore
+def iter_local_paths(repo_path, relative_dir="", ignore_rules=()):
+    directory = os.path.join(repo_path, relative_dir)
+    ignore_rules = list(ignore_rules) + load_gitignore(directory, relative_dir)
+
+    with os.scandir(directory) as entries:
+        entries = list(entries)
+
+    for entry in entries:
+        if entry.name == '.git' or entry.is_symlink():
+            continue
+        path = f"{relative_dir}{entry.name}"
+        is_dir = entry.is_dir()
+        if is_ignored(path, is_dir, ignore_rules):
+            continue
+        if is_dir:
+            yield from iter_local_paths(repo_path, path + '/', ignore_rules)
+        elif entry.is_file():
+            yield path, entry.stat().st_size
+
+# Function to read a source file through a read-only memory map, returns None for minified code
+# which is detected from the head of the mapping before the whole file is read
+def read_local_source(file_path, path):
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if looks_minified(path, mapped[:MINIFIED_SAMPLE_SIZE].decode(errors="ignore")):
+                return None
+            return mapped[:].decode()
+
+# Function to parse the .gitignore of a directory into (base_dir, regex, negate, dir_only) rules
+def load_gitignore(directory, relative_dir):
+    gitignore_path = os.path.join(directory, '.gitignore')
+    if not os.path.isfile(gitignore_path):
+        return []
+
+    rules = []
+    with open(gitignore_path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            pattern = line.rstrip('\n').rstrip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            negate = pattern.startswith('!')
+            if negate:
+                pattern = pattern[1:]
+            pattern = pattern.replace('\\#', '#').replace('\\!', '!')
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            # Patterns without a slash match at any depth, the others are relative to the .gitignore
+            if '/' not in pattern:
+                pattern = '**/' + pattern
+            rules.append((relative_dir, re.compile(gitignore_pattern_to_regex(pattern.lstrip('/'))), negate, dir_only))
+    return rules
+
+# Function to translate a gitignore glob into a regular expression over relative paths
+def gitignore_pattern_to_regex(pattern):
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('/**', i) and i + 3 == len(pattern):
+            regex += '/.*'
+            i += 3
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 1:]:
+            end = pattern.index(']', i + 1)
+            regex += '[' + pattern[i + 1:end].replace('!', '^', 1) + ']'
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex + r'\Z'
+
+# Function to apply gitignore rules, the last matching rule wins
+def is_ignored(path, is_dir, ignore_rules):
+    ignored = False
+    for base_dir, regex, negate, dir_only in ignore_rules:
+        if dir_only and not is_dir:
+            continue
+        if regex.match(path[len(base_dir):]):
+            ignored = not negate
+    return ignored
+
+# Function to summarize one file, reusing the cached summary of the blob when there is one.
+# load is only called on a cache miss; the README content is returned as-is rather than summarized.
+# An empty summary means the file was skipped.
+def summarize_blob(path, blob_sha, load, cache=None):
+    if path.lower() == 'readme.md':
+        return load()
+
+    if cache is not None and blob_sha:
+        summary = cache.get(blob_sha, SUMMARIZER_VERSION)
+        if summary is not None:
+            return summary
+
+    # load returns None for files that turn out to be minified, the empty summary is cached so they are not fetched again
+    content = load()
+    summary = summarize_file(path, content) if content is not None else ""
+    if cache is not None and blob_sha:
+        cache.put(blob_sha, SUMMARIZER_VERSION, summary)
+    return summary
+
+# Function to summarize (path, content) pairs whose content has already been read
+def summarize_files(files, cache=None):
+    for path, content in files:
+        if content is None:
+            continue
+        blob_sha = git_blob_sha(content.encode()) if cache is not None else None
+        yield path, summarize_blob(path, blob_sha, lambda: content, cache)
+
+# Function to summarize (path, content) pairs in a worker process, returns the summaries in order
+def summarize_sources(files):
+    return [summarize_file(path, content) for path, content in files]
+
+# Function to summarize each service of a monorepo separately, returns {service root: system description}.
+# Service roots are detected from the manifests among all_paths, and each service gets the whole token budget.
+# Files without a cached summary are summarized in parallel worker processes, one task per service.
+def summarize_services(repo_url, all_paths, files, token_budget=DEFAULT_TOKEN_BUDGET, cache=None, exclude_globs=(), max_processes=None, describe=None):
+    groups = group_by_service(((path, content) for path, content in files if content is not None), find_service_roots(all_paths, exclude_globs))
+
+    summaries = {}
+    misses = {}
+    for root, group in groups.items():
+        for path, content in group:
+            if path.lower() == 'readme.md':
+                summaries[path] = content
+                continue
+            blob_sha = git_blob_sha(content.encode()) if cache is not None else None
+            summary = cache.get(blob_sha, SUMMARIZER_VERSION) if cache is not None else None
+            if summary is not None:
+                summaries[path] = summary
+            else:
+                misses.setdefault(root, []).append((path, content, blob_sha))
+
+    if len(misses) == 1:
+        # A single service is not worth the start-up cost of a worker process
+        results = [summarize_sources([(path, content) for path, content, _ in group]) for group in misses.values()]
+    elif misses:
+        with ProcessPoolExecutor(max_workers=min(len(misses), max_processes or os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(summarize_sources, [(path, content) for path, content, _ in group]) for group in misses.values()]
+            results = [future.result() for future in futures]
+    else:
+        results = []
+
+    for group, group_summaries in zip(misses.values(), results):
+        for (path, _, blob_sha), summary in zip(group, group_summaries):
+            summaries[path] = summary
+            if cache is not None:
+                cache.put(blob_sha, SUMMARIZER_VERSION, summary)
+
+    return {
+        root: (describe or summarize_repository)(
+            repo_url if not root else f"{repo_url} (service: {service_label(root)})",
+            ((path, summaries[path]) for path, _ in group),
+            token_budget,
+        )
+        for root, group in groups.items()
+    }
+
+# Function to merge per-service system descriptions into one that fits the token budget.
+# Each service keeps whole lines up to an equal share of the budget.
+def merge_service_descriptions(descriptions, token_budget=DEFAULT_TOKEN_BUDGET):
+    share = token_budget * CHARS_PER_TOKEN // max(1, len(descriptions))
+    merged = []
+    for root, description in descriptions.items():
+        lines = []
+        total_chars = 0
+        for line in description.splitlines():
+            total_chars += len(line) + 1
+            if total_chars > share:
+                lines.append("...(truncated to fit the token budget)")
+                break
+            lines.append(line)
+        merged.append(f"## Service: {service_label(root)}\n\n" + "\n".join(lines))
+    return "\n\n".join(merged)
+
+# Function to collect (path, summary) pairs in order until the token budget is used up
+def summarize_repository(repo_url, summaries, token_budget=DEFAULT_TOKEN_BUDGET):
+    file_summaries = defaultdict(list)
+    total_chars = 0
+    readme_content = ""
+
+    for path, summary in summaries:
+        if path.lower() == 'readme.md':
+            readme_content = summary
+            continue
+        if not summary:
+            continue
+
+        file_summaries[path.split('.')[-1]].append(summary)
+
+        total_chars += len(summary)
+        if total_chars / CHARS_PER_TOKEN > token_budget:
+            break
+
+    return build_system_description(repo_url, readme_content, file_summaries)
+
+# Function to compile the analysis into a system description
+def build_system_description(repo_url, readme_content, file_summaries):
+    system_description = f"Repository: {repo_url}\n\n"
+
+    if readme_content:
+        system_description += "README.md Content:\n"
+        # Truncate README if it's too long
+        if len(readme_content) > 5000:
+            system_description += readme_content[:5000] + "...\n(README truncated due to length)\n\n"
+        else:
+            system_description += readme_content + "\n\n"
+
+    for file_type, summaries in file_summaries.items():
+        system_description += f"{file_type.upper()} Files:\n"
+        for summary in summaries:
+            system_description += summary + "\n"
+        system_description += "\n"
+
+    return system_description
+
+
+if __name__ == "__main__":
+    import io
+    import json
+    import tempfile
+    import threading
+    from functools import partial
+    from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+    def build_archive(path, names):
+        with tarfile.open(path, "w:gz") as archive:
+            for name in names:
+                data = f"# {name}\nimport os\n".encode()
+                member = tarfile.TarInfo(name)
+                member.size = len(data)
+                archive.addfile(member, io.BytesIO(data))
+
+    class QuietHandler(SimpleHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+    def list_paths(repo_url, summaries, token_budget):
+        return sorted(path for path, _ in summaries)
+
+    with tempfile.TemporaryDirectory() as directory:
+        archives = {
+            # GitHub wraps the tree in "owner-repo-sha/"
+            "github.tar.gz": (["octo-app-0a1b2c3/README.md", "octo-app-0a1b2c3/app/main.py"], ["README.md", "app/main.py"]),
+            # A repository whose files all sit under one directory keeps it
+            "src.tar.gz": (["src/main.py", "src/util.py"], ["src/main.py", "src/util.py"]),
+            # A wrapper named after another repository is not stripped
+            "other.tar.gz": (["octo-lib-0a1b2c3/main.py"], ["octo-lib-0a1b2c3/main.py"]),
+            "flat.tar.gz": (["./README.md", "./main.py"], ["README.md", "main.py"]),
+        }
+        for file_name, (names, _) in archives.items():
+            build_archive(os.path.join(directory, file_name), names)
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), partial(QuietHandler, directory=directory))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        for file_name, (_, expected) in archives.items():
+            archive_url = f"http://127.0.0.1:{server.server_port}/{file_name}"
+            paths = analyze_github_repo_archive("https://github.com/octo/app", None, archive_url=archive_url, describe=list_paths)
+            assert paths == expected, f"{file_name}: {paths} != {expected}"
+            print(f"{file_name}: {paths}")
+
+        server.shutdown()
+
+    # Stub of the GitHub REST and GraphQL APIs: a tree of 60 files fetched in several GraphQL batches.
+    # The first GraphQL request fails and is retried with a smaller batch, "bin/" blobs are binary,
+    # and fail_with_errors makes every query answer with GraphQL errors instead of data.
+    tree_paths = ["README.md", "bin/tool.py"] + [f"pkg/module{i:02}.py" for i in range(58)]
+    batches = []
+    fail_with_errors = False
+
+    class GitHubStub(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == "/repos/octo/app":
+                self.reply(200, {"default_branch": "main"})
+            elif self.path.startswith("/repos/octo/app/git/trees/main"):
+                self.reply(200, {"sha": "tree", "tree": [{"path": path, "type": "blob", "sha": f"{i:040x}", "size": 100} for i, path in enumerate(tree_paths)]})
+            else:
+                self.reply(404, {"message": "Not Found"})
+
+        def do_POST(self):
+            variables = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["variables"]
+            expressions = {key: value for key, value in variables.items() if key.startswith("e")}
+            batches.append(len(expressions))
+            if len(batches) == 1:
+                self.reply(502, {"message": "Bad Gateway"})
+            elif fail_with_errors:
+                self.reply(200, {"data": None, "errors": [{"message": "Something went wrong"}]})
+            else:
+                repository = {}
+                for key, expression in expressions.items():
+                    path = expression.split(":", 1)[1]
+                    binary = path.startswith("bin/")
+                    repository["f" + key[1:]] = {"text": None if binary else f"import os\n# {path}\n", "isBinary": binary, "isTruncated": False}
+                self.reply(200, {"data": {"rateLimit": {"remaining": 4000}, "repository": repository}})
+
+    with tempfile.TemporaryDirectory() as directory:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), GitHubStub)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        os.environ["GITHUB_API_URL"] = f"http://127.0.0.1:{server.server_port}"
+        os.environ["GITHUB_RESPONSE_CACHE_PATH"] = os.path.join(directory, "responses.sqlite")
+
+        summaries = analyze_github_repo_graphql("https://github.com/octo/app", None, describe=lambda repo_url, summaries, token_budget: list(summaries))
+        assert batches[:2] == [DEFAULT_GRAPHQL_BATCH_SIZE, DEFAULT_GRAPHQL_BATCH_SIZE // 2], f"the failed batch was not retried smaller: {batches}"
+        assert sum(batches[1:]) == len(tree_paths), f"{sum(batches[1:])} blobs fetched for {len(tree_paths)} files"
+        assert sorted(path for path, _ in summaries) == sorted(tree_paths), "files are missing from the summaries"
+        assert all(summary for path, summary in summaries if not path.startswith("bin/")), "a text blob was not summarized"
+        assert dict(summaries)["bin/tool.py"] == "", "a binary blob was summarized"
+        print(f"GraphQL batches: {batches}")
+
+        batches.clear()
+        fail_with_errors = True
+        try:
+            analyze_github_repo_graphql("https://github.com/octo/app", None, describe=lambda repo_url, summaries, token_budget: list(summaries))
+        except RuntimeError as e:
+            print(f"GraphQL errors: {e}")
+        else:
+            raise AssertionError("GraphQL errors were not raised")
+
+        server.shutdown()
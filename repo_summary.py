@@ -0,0 +1,229 @@
+import hashlib
+import posixpath
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import google.generativeai as genai
+
+from llm_cache import cached_generation
+from llm_clients import configure_google, get_azure_openai_client, get_http_session, get_mistral_client, get_openai_client, google_request_options
+from repo_analysis import CHARS_PER_TOKEN, DEFAULT_TOKEN_BUDGET, build_system_description, summarize_repository
+
+# Bump when the prompts change so cached directory summaries are not reused
+MAP_REDUCE_VERSION = "1"
+
+# Largest input sent in one summarization call, larger directories are summarized in chunks first
+MAX_CHUNK_CHARS = 24000
+
+# Directories with less input than this are passed to their parent as-is instead of being summarized
+MIN_DIRECTORY_CHARS = 4000
+
+# Length of each directory summary and of the final architecture summary
+DIRECTORY_SUMMARY_WORDS = 250
+ARCHITECTURE_SUMMARY_WORDS = 1500
+
+# Default number of concurrent summarization calls
+DEFAULT_MAX_WORKERS = 4
+
+SYSTEM_PROMPT = "You are a senior software architect who summarizes source code for security reviews."
+
+# Function to create a prompt to summarize one directory from the summaries of its files and subdirectories
+def create_directory_summary_prompt(directory, parts):
+    contents = "\n\n".join(parts)
+    prompt = f"""
+Summarize the directory "{directory}" of a software repository for a STRIDE threat model. The input below contains static analysis summaries of its files and summaries of its subdirectories.
+
+In at most {DIRECTORY_SUMMARY_WORDS} words, describe the purpose of the directory and its main components, and keep every security-relevant detail: entry points and routes, authentication and authorization, data stores and queries, external services, secrets and cryptography, and command execution. Name the files and functions involved.
+
+Respond with plain text only, without any preamble.
+
+DIRECTORY CONTENTS:
+{contents}
+"""
+    return prompt
+
+# Function to create a prompt to reduce the directory summaries into an architecture summary
+def create_architecture_summary_prompt(readme_content, parts):
+    contents = "\n\n".join(parts)
+    prompt = f"""
+Write an architecture summary of a software repository that will be used as the application description of a STRIDE threat model. The input below contains the README and summaries of the top-level directories of the repository.
+
+In at most {ARCHITECTURE_SUMMARY_WORDS} words, describe the components of the system, how data flows between them, the trust boundaries, the entry points exposed to users and other systems, authentication and authorization, data stores, external integrations, and any security-relevant observations.
+
+Respond with plain text only, without any preamble.
+
+README:
+{readme_content[:5000]}
+
+REPOSITORY CONTENTS:
+{contents}
+"""
+    return prompt
+
+# Function to summarize a large repository with the LLM instead of truncating its file summaries.
+# Directories are summarized bottom-up (map), each level concurrently with a bounded pool, and the top-level
+# summaries are reduced into a compact architecture summary. complete(prompt) returns the text of one LLM call.
+# Directory summaries are cached by a hash of the directory content, so re-runs only redo changed subtrees.
+# Repositories whose file summaries already fit the token budget are described as usual without any LLM call.
+def summarize_repository_map_reduce(repo_url, summaries, complete, token_budget=DEFAULT_TOKEN_BUDGET, cache=None, cache_namespace="", max_workers=DEFAULT_MAX_WORKERS):
+    summaries = [(path, summary) for path, summary in summaries if summary]
+    if sum(len(summary) for _, summary in summaries) / CHARS_PER_TOKEN <= token_budget:
+        return summarize_repository(repo_url, summaries, token_budget)
+
+    readme_content = ""
+    files_by_directory = defaultdict(list)
+    for path, summary in summaries:
+        if path.lower() == 'readme.md':
+            readme_content = summary
+        else:
+            files_by_directory[posixpath.dirname(path)].append(summary)
+
+    # Every ancestor of a directory with files takes part, down to the repository root ("")
+    children = defaultdict(list)
+    levels = defaultdict(list)
+    seen = set()
+    for directory in files_by_directory:
+        while directory not in seen:
+            seen.add(directory)
+            levels[directory.count('/') + 1 if directory else 0].append(directory)
+            if not directory:
+                break
+            children[posixpath.dirname(directory)].append(directory)
+            directory = posixpath.dirname(directory)
+
+    version = f"map-reduce:{MAP_REDUCE_VERSION}:{cache_namespace}"
+    digests = {}
+    texts = {}
+
+    def reduce_directory(directory):
+        parts = list(files_by_directory[directory])
+        parts += [texts[child] for child in sorted(children[directory]) if texts[child]]
+
+        digest = hashlib.sha256("\0".join(
+            [directory, readme_content if not directory else ""]
+            + files_by_directory[directory]
+            + [digests[child] for child in sorted(children[directory])]
+        ).encode()).hexdigest()
+
+        if directory and sum(len(part) for part in parts) < MIN_DIRECTORY_CHARS:
+            return digest, "\n".join(parts)
+
+        if cache is not None:
+            text = cache.get(digest, version)
+            if text is not None:
+                return digest, text
+
+        # Inputs that do not fit one call are summarized in chunks until they do. Oversized parts get a chunk of
+        # their own, and if the summaries still do not shrink the input, every part is cut to an equal share of a call.
+        size = sum(len(part) for part in parts)
+        while size > MAX_CHUNK_CHARS:
+            chunks = chunk_parts(parts)
+            parts = [complete(create_directory_summary_prompt(directory or "/", chunk)) for chunk in chunks]
+            if sum(len(part) for part in parts) >= size:
+                share = MAX_CHUNK_CHARS // len(parts)
+                print(f"Summaries of {directory or '/'} did not shrink, truncating {len(parts)} parts to {share} characters each")
+                parts = [part[:share] for part in parts]
+                break
+            size = sum(len(part) for part in parts)
+
+        if directory:
+            text = f"Directory {directory}:\n" + complete(create_directory_summary_prompt(directory, parts))
+        else:
+            text = complete(create_architecture_summary_prompt(readme_content, parts))
+
+        if cache is not None:
+            cache.put(digest, version, text)
+        return digest, text
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for depth in sorted(levels, reverse=True):
+            for directory, (digest, text) in zip(levels[depth], executor.map(reduce_directory, levels[depth])):
+                digests[directory] = digest
+                texts[directory] = text
+
+    return build_system_description(repo_url, readme_content, {}) + "Architecture Summary:\n" + texts[""] + "\n"
+
+# Function to split parts into chunks of at most MAX_CHUNK_CHARS, a part that is too long on its own is cut
+def chunk_parts(parts):
+    chunks = [[]]
+    size = 0
+    for part in parts:
+        part = part[:MAX_CHUNK_CHARS]
+        if chunks[-1] and size + len(part) > MAX_CHUNK_CHARS:
+            chunks.append([])
+            size = 0
+        chunks[-1].append(part)
+        size += len(part)
+    return chunks
+
+
+# Function to get a directory summary from the GPT response.
+@cached_generation("openai")
+def get_directory_summary(api_key, model_name, prompt):
+    client = get_openai_client(api_key)
+
+    response = client.chat.completions.create(
+        model = model_name,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    )
+
+    return response.choices[0].message.content
+
+# Function to get a directory summary from the Azure OpenAI response.
+@cached_generation("azure")
+def get_directory_summary_azure(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, prompt):
+    client = get_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version)
+
+    response = client.chat.completions.create(
+        model = azure_deployment_name,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    )
+
+    return response.choices[0].message.content
+
+# Function to get a directory summary from the Google model's response.
+@cached_generation("google")
+def get_directory_summary_google(google_api_key, google_model, prompt):
+    configure_google(google_api_key)
+    model = genai.GenerativeModel(google_model, system_instruction=SYSTEM_PROMPT)
+    response = model.generate_content(prompt, request_options=google_request_options())
+
+    return response.candidates[0].content.parts[0].text
+
+# Function to get a directory summary from the Mistral model's response.
+@cached_generation("mistral")
+def get_directory_summary_mistral(mistral_api_key, mistral_model, prompt):
+    client = get_mistral_client(mistral_api_key)
+
+    response = client.chat.complete(
+        model = mistral_model,
+        messages=[
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    )
+
+    return response.choices[0].message.content
+
+# Function to get a directory summary from Ollama hosted LLM.
+@cached_generation("ollama")
+def get_directory_summary_ollama(ollama_model, prompt):
+    url = "http://localhost:11434/api/chat"
+
+    data = {
+        "model": ollama_model,
+        "stream": False,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    }
+    response = get_http_session().post(url, json=data)
+
+    return response.json()["message"]["content"]
@@ -0,0 +1,37 @@
+import posixpath
+
+from file_selection import skip_reason
+
+# Manifest files that mark the root directory of a service in a monorepo
+SERVICE_MANIFESTS = {
+    'package.json', 'go.mod', 'pyproject.toml', 'setup.py', 'requirements.txt', 'Pipfile', 'pom.xml',
+    'build.gradle', 'build.gradle.kts', 'Gemfile', 'Cargo.toml', 'composer.json', 'Dockerfile',
+}
+
+# Function to find the service roots of a repository from the paths of all its files.
+# Manifests inside vendored or excluded directories do not count, "" is the repository root.
+def find_service_roots(paths, exclude_globs=()):
+    return sorted({
+        posixpath.dirname(path) for path in paths
+        if posixpath.basename(path) in SERVICE_MANIFESTS and skip_reason(path, exclude_globs=exclude_globs) is None
+    })
+
+# Function to find the service a file belongs to, the innermost service root containing it
+def service_of(path, roots):
+    service = ""
+    for root in roots:
+        if root and path.startswith(root + "/") and len(root) > len(service):
+            service = root
+    return service
+
+# Function to group (path, content) pairs by service, keeping their order within each service.
+# Files outside every service root, including the repository README, belong to the root ("").
+def group_by_service(files, roots):
+    groups = {}
+    for path, content in files:
+        groups.setdefault(service_of(path, roots), []).append((path, content))
+    return groups
+
+# Function to name a service root for display
+def service_label(root):
+    return root or "(repository root)"
@@ -0,0 +1,302 @@
+import ast
+import os
+import re
+
+# Version of the file summaries, bump this whenever a summarizer changes so cached summaries are not reused
+SUMMARIZER_VERSION = "3"
+
+# Maximum number of imports, classes and functions listed per file
+MAX_ITEMS = 5
+
+# Maximum number of framework entry points listed per file
+MAX_ENTRY_POINTS = 10
+
+# Maximum number of lines listed per security signal category
+MAX_SIGNALS = 5
+
+# Maximum length of a matched line quoted in a summary, keeps minified bundles from flooding the prompt
+MAX_SIGNAL_LENGTH = 160
+
+# Section titles of the structural and security signal categories, in the order they are listed
+SIGNAL_TITLES = {
+    'imports': "Imports",
+    'functions': "Functions",
+    'routes': "HTTP routes",
+    'auth': "Authentication / authorization",
+    'sql': "SQL / ORM calls",
+    'crypto': "Cryptography",
+    'exec': "Subprocess / code execution",
+    'secrets': "Secret-like literals",
+}
+
+# Signals shared by every language
+COMMON_SIGNAL_PATTERNS = {
+    'sql': r"(?i:\b(?:select\s+[\w*,. ]{1,200}?\s+from|insert\s+into|update\s+\w+\s+set|delete\s+from)\s+\w+)",
+    'secrets': (
+        r"(?i:(?:secret|passw(?:or)?d|api[_-]?key|access[_-]?key|auth[_-]?token|private[_-]?key)[\w-]{0,40}['\"]?\s*[:=]\s*['\"][^'\"\s]{8,200}['\"])"
+        r"|\bAKIA[0-9A-Z]{16}\b|-----BEGIN [A-Z ]{0,40}PRIVATE KEY-----"
+    ),
+}
+
+# Per-language patterns, each table is compiled into a single alternation so a file is scanned once
+LANGUAGE_SIGNAL_PATTERNS = {
+    'python': {
+        'exec': r"\b(?:subprocess\.(?:run|call|Popen|check_output|check_call)|os\.(?:system|popen|exec\w*)|eval|exec|pickle\.loads?|yaml\.load|marshal\.loads)\s*\(",
+        'crypto': r"\b(?:hashlib\.\w+|hmac\.new|Fernet|AES\.new|bcrypt\.\w+|jwt\.(?:encode|decode)|ssl\.\w+|random\.(?:random|randint|choice))\s*\(",
+        'sql': r"\b(?:cursor|conn|connection|session|db|engine)\.(?:execute|executemany|executescript|query)\s*\(|\.raw\s*\(|\.extra\s*\(",
+    },
+    'javascript': {
+        'imports': r"^[ \t]*import\s[^\n;]{0,200}?from\s*['\"][^'\"\n]{1,200}['\"]|\brequire\s*\(\s*['\"][^'\"\n]{1,200}['\"]\s*\)",
+        'routes': r"\b(?:app|router|server|fastify|api)\.(?:get|post|put|patch|delete|all|use|route)\s*\(\s*['\"`][^'\"`\n]{0,200}['\"`]|@(?:Get|Post|Put|Patch|Delete|All|Controller)\s*\([^)]{0,200}\)",
+        'auth': r"\b(?:passport\.authenticate|jwt\.(?:verify|sign|decode)|isAuthenticated|requireAuth|ensureLoggedIn|authMiddleware|authenticate|bcrypt\.(?:compare|hash))\b|@UseGuards\s*\([^)]{0,200}\)",
+        'exec': r"\b(?:child_process|execSync|execFileSync|spawnSync|spawn|execFile|exec|eval)\s*\(|\bnew\s+Function\s*\(|\.innerHTML\s*=|dangerouslySetInnerHTML",
+        'crypto': r"\bcrypto\.(?:createHash|createHmac|createCipheriv|createDecipheriv|createSign|randomBytes|subtle\.\w+)\s*\(|\bMath\.random\s*\(",
+        'sql': r"\.(?:query|raw|\$queryRaw|\$executeRaw|createQueryBuilder|sequelize\.query)\s*\(",
+        'functions': r"\bfunction\s*\*?\s*\w+\s*\([^)]{0,200}\)|\b(?:const|let|var)\s+\w+\s*=\s*(?:async\s*)?(?:\([^)]{0,200}\)|\w+)\s*=>",
+    },
+    'java': {
+        'imports': r"^[ \t]*import\s+(?:static\s+)?[\w.*]+;",
+        'routes': r"@(?:Get|Post|Put|Patch|Delete|Request)Mapping\b(?:\([^)]{0,200}\))?|@Path\s*\([^)]{0,200}\)|@WebServlet\s*\([^)]{0,200}\)",
+        'auth': r"@(?:PreAuthorize|PostAuthorize|Secured|RolesAllowed|PermitAll|DenyAll)\b(?:\([^)]{0,200}\))?|\b(?:SecurityFilterChain|HttpSecurity|AuthenticationManager|JwtDecoder|PasswordEncoder)\b",
+        'exec': r"\bRuntime\.getRuntime\(\)\.exec\s*\(|\bnew\s+ProcessBuilder\s*\(|\bScriptEngineManager\b|\bObjectInputStream\b",
+        'crypto': r"\b(?:MessageDigest|Cipher|KeyGenerator|KeyPairGenerator|Mac|SecretKeyFactory|SSLContext)\.getInstance\s*\([^)]{0,200}\)|\bnew\s+(?:Secure)?Random\s*\(",
+        'sql': r"\b(?:createQuery|createNativeQuery|prepareStatement|createStatement|executeQuery|executeUpdate)\s*\(|\bjdbcTemplate\.\w+\s*\(|@Query\s*\([^)]{0,200}\)",
+        'functions': r"^[ \t]*(?:public|protected|private)\s+(?:static\s+|final\s+|synchronized\s+|abstract\s+)*[\w<>\[\], ?]{1,120}?\s+\w+\s*\([^)]{0,200}\)",
+    },
+    'go': {
+        'imports': r"^[ \t]*(?:import\s+)?(?:[\w.]+\s+)?\"[\w.\-/]+\"[ \t]*$",
+        'routes': r"\.(?:HandleFunc|Handle|GET|POST|PUT|PATCH|DELETE|Any|Group)\s*\(\s*\"[^\"\n]{0,200}\"",
+        'auth': r"\bjwt\.Parse\w*\s*\(|\.BasicAuth\s*\(|\boauth2\.\w+|\bbcrypt\.\w+\s*\(|\bcasbin\.\w+",
+        'exec': r"\bexec\.Command(?:Context)?\s*\(|\bsyscall\.Exec\s*\(|\btemplate\.HTML\s*\(",
+        'crypto': r"\b(?:md5|sha1|sha256|sha512|des|rc4|aes|hmac|rsa|ecdsa)\.(?:New\w*|Sum\w*|Sign\w*|Encrypt\w*)\s*\(|\bInsecureSkipVerify\b|\brand\.(?:Intn|Int|Read)\s*\(",
+        'sql': r"\b(?:db|tx|conn|stmt)\.(?:Query|QueryRow|Exec|Prepare)(?:Context)?\s*\(|\.Raw\s*\(",
+        'functions': r"^func\s+(?:\([^)]{0,200}\)\s*)?\w+\s*\([^)]{0,200}\)",
+    },
+    'ruby': {
+        'imports': r"^[ \t]*require(?:_relative)?\s+['\"][^'\"\n]{1,200}['\"]",
+        'routes': r"^[ \t]*(?:get|post|put|patch|delete|resources?|match|root)\s+['\":][^\n]*",
+        'auth': r"\bbefore_action\s+:(?:authenticate|authorize|require_login)\w*|\bauthenticate_user!|\bhas_secure_password\b|\bauthorize!?\s*\(|\bdevise\s+:|\bprotect_from_forgery\b|\bskip_before_action\s+:verify_authenticity_token",
+        'exec': r"\b(?:system|exec|spawn|IO\.popen|Open3\.\w+|eval|instance_eval|class_eval|Marshal\.load|YAML\.load)\s*\(|%x\{|`[^`\n]{1,200}`",
+        'crypto': r"\bOpenSSL::\w+(?:::\w+)*|\bDigest::(?:MD5|SHA1|SHA256|SHA512)\b|\bSecureRandom\.\w+|\bBCrypt::\w+|\brand\s*\(",
+        'sql': r"\b(?:find_by_sql|execute|exec_query|select_all)\s*\(|\.where\s*\(\s*\"[^\"\n]{0,200}#\{",
+        'functions': r"^[ \t]*def\s+(?:self\.)?[\w?!=]+(?:\([^)]{0,200}\))?",
+    },
+}
+
+# File extensions handled by each language table
+SIGNAL_LANGUAGES = {
+    '.py': 'python',
+    '.js': 'javascript',
+    '.jsx': 'javascript',
+    '.ts': 'javascript',
+    '.tsx': 'javascript',
+    '.mjs': 'javascript',
+    '.java': 'java',
+    '.go': 'go',
+    '.rb': 'ruby',
+}
+
+# Function to compile the category patterns of a language into a single alternation of named groups
+def compile_signal_pattern(patterns):
+    patterns = {**patterns, **{category: f"{patterns[category]}|{pattern}" if category in patterns else pattern
+                               for category, pattern in COMMON_SIGNAL_PATTERNS.items()}}
+    return re.compile(
+        "|".join(f"(?P<{category}>{patterns[category]})" for category in SIGNAL_TITLES if category in patterns),
+        re.MULTILINE,
+    )
+
+SIGNAL_PATTERNS = {language: compile_signal_pattern(patterns) for language, patterns in LANGUAGE_SIGNAL_PATTERNS.items()}
+
+# Decorator names that expose a function as an HTTP, RPC or CLI entry point
+ROUTE_DECORATORS = {
+    'route', 'get', 'post', 'put', 'patch', 'delete', 'head', 'options', 'websocket',
+    'api_route', 'api_view', 'action', 'command', 'task', 'shared_task', 'receiver',
+}
+
+# Decorator names that enforce authentication or authorization
+AUTH_DECORATORS = {
+    'login_required', 'permission_required', 'user_passes_test', 'staff_member_required',
+    'jwt_required', 'requires_auth', 'auth_required', 'roles_required', 'roles_accepted',
+    'permission_classes', 'authentication_classes', 'csrf_exempt',
+}
+
+# Function to summarize a file, Python files are parsed with the ast module, other languages with a signal
+# table get a single-pass signal scan and everything else uses the original regexes
+def summarize_file(file_path, content):
+    if file_path.endswith('.py'):
+        return summarize_python_file(file_path, content)
+    language = SIGNAL_LANGUAGES.get(os.path.splitext(file_path)[1])
+    if language is not None:
+        return f"File: {file_path}\n" + format_signals(extract_signals(content, language))
+    return summarize_file_regex(file_path, content)
+
+# Function to collect the security signals of a file in one linear scan, returns {category: [line, ...]}
+def extract_signals(content, language):
+    signals = {category: [] for category in SIGNAL_TITLES}
+    last_lines = {}
+    line_number = 1
+    position = 0
+    for match in SIGNAL_PATTERNS[language].finditer(content):
+        category = match.lastgroup
+        if len(signals[category]) >= MAX_SIGNALS:
+            if all(len(lines) >= MAX_SIGNALS for lines in signals.values()):
+                break
+            continue
+        line_number += content.count("\n", position, match.start())
+        position = match.start()
+        # List each line once per category even when several patterns match it
+        if last_lines.get(category) == line_number:
+            continue
+        last_lines[category] = line_number
+        if category == 'secrets':
+            # Never copy the secret itself into the prompt
+            literal = match.group()
+            if literal.startswith("AKIA"):
+                text = "AWS access key ID <redacted>"
+            elif literal.startswith("-----BEGIN"):
+                text = "Private key block <redacted>"
+            else:
+                # The pattern starts at the keyword, so walk back to the start of the identifier
+                name_start = match.start()
+                while name_start > 0 and (content[name_start - 1].isalnum() or content[name_start - 1] in "_-"):
+                    name_start -= 1
+                name = content[name_start:match.start()] + re.split(r"['\"]?\s*[:=]", literal, maxsplit=1)[0]
+                text = name + " = <redacted>"
+        else:
+            line_start = content.rfind("\n", 0, match.start()) + 1
+            line_end = content.find("\n", match.end())
+            line_end = len(content) if line_end == -1 else line_end
+            text = content[max(line_start, match.start() - 40):min(line_end, match.end() + 80)].strip()
+        signals[category].append(f"L{line_number}: {text[:MAX_SIGNAL_LENGTH]}")
+    return signals
+
+def format_signals(signals):
+    return "".join(
+        f"{SIGNAL_TITLES[category]}:\n" + "\n".join(lines) + "\n"
+        for category, lines in signals.items() if lines
+    )
+
+# Function to summarize a Python file from a single parse, falling back to regexes on syntax errors
+def summarize_python_file(file_path, content):
+    try:
+        tree = ast.parse(content, filename=file_path)
+    except (SyntaxError, ValueError):
+        return summarize_file_regex(file_path, content)
+
+    imports = []
+    classes = []
+    functions = []
+    entry_points = []
+
+    def visit(body, prefix=""):
+        for node in body:
+            if isinstance(node, ast.Import):
+                imports.append("import " + ", ".join(format_alias(alias) for alias in node.names))
+            elif isinstance(node, ast.ImportFrom):
+                module = "." * node.level + (node.module or "")
+                imports.append(f"from {module} import " + ", ".join(format_alias(alias) for alias in node.names))
+            elif isinstance(node, ast.ClassDef):
+                bases = ", ".join(ast.unparse(base) for base in node.bases + node.keywords)
+                classes.append(format_decorators(node) + f"class {node.name}" + (f"({bases})" if bases else "") + ":")
+                visit(node.body, prefix=f"{node.name}.")
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                signature = format_decorators(node) + format_signature(node, prefix)
+                functions.append(signature)
+                if any(decorator_name(decorator) in ROUTE_DECORATORS | AUTH_DECORATORS for decorator in node.decorator_list):
+                    entry_points.append(signature)
+            elif isinstance(node, ast.If) and is_main_guard(node):
+                entry_points.append('if __name__ == "__main__":')
+
+    visit(tree.body)
+
+    summary = f"File: {file_path}\n"
+    if imports:
+        summary += "Imports:\n" + "\n".join(imports[:MAX_ITEMS]) + "\n"
+    if entry_points:
+        summary += "Entry points:\n" + "\n".join(entry_points[:MAX_ENTRY_POINTS]) + "\n"
+    if functions:
+        summary += "Functions:\n" + "\n".join(functions[:MAX_ITEMS]) + "\n"
+    if classes:
+        summary += "Classes:\n" + "\n".join(classes[:MAX_ITEMS]) + "\n"
+
+    signals = extract_signals(content, 'python')
+    summary += format_signals({category: signals[category] for category in ('sql', 'crypto', 'exec', 'secrets')})
+
+    return summary
+
+def format_alias(alias):
+    return f"{alias.name} as {alias.asname}" if alias.asname else alias.name
+
+def format_decorators(node):
+    return "".join(f"@{ast.unparse(decorator)}\n" for decorator in node.decorator_list)
+
+def format_signature(node, prefix=""):
+    keyword = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+    returns = f" -> {ast.unparse(node.returns)}" if node.returns else ""
+    return f"{keyword} {prefix}{node.name}({ast.unparse(node.args)}){returns}:"
+
+# Function to get the last name of a decorator, e.g. "route" for @app.route("/login")
+def decorator_name(decorator):
+    if isinstance(decorator, ast.Call):
+        decorator = decorator.func
+    if isinstance(decorator, ast.Attribute):
+        return decorator.attr
+    if isinstance(decorator, ast.Name):
+        return decorator.id
+    return ""
+
+def is_main_guard(node):
+    test = node.test
+    return (
+        isinstance(test, ast.Compare)
+        and isinstance(test.left, ast.Name)
+        and test.left.id == "__name__"
+        and any(isinstance(comparator, ast.Constant) and comparator.value == "__main__" for comparator in test.comparators)
+    )
+
+def summarize_file_regex(file_path, content):
+    # Extract important parts of the file
+    imports = re.findall(r'^import .*|^from .* import .*', content, re.MULTILINE)
+    functions = re.findall(r'def .*\(.*\):', content)
+    classes = re.findall(r'class .*:', content)
+
+    summary = f"File: {file_path}\n"
+    if imports:
+        summary += "Imports:\n" + "\n".join(imports[:5]) + "\n"  # Limit to first 5 imports
+    if functions:
+        summary += "Functions:\n" + "\n".join(functions[:5]) + "\n"  # Limit to first 5 functions
+    if classes:
+        summary += "Classes:\n" + "\n".join(classes[:5]) + "\n"  # Limit to first 5 classes
+
+    return summary
+
+# Benchmark of the ast summarizer against the regex summarizer: python summarizers.py [file.py ...]
+if __name__ == "__main__":
+    import sys
+    import timeit
+
+    if len(sys.argv) > 1:
+        samples = [(path, open(path, encoding="utf-8").read()) for path in sys.argv[1:]]
+    else:
+        block = (
+            "import os\nfrom flask import Flask, request\n\napp = Flask(__name__)\n\n"
+            "@app.route('/login/<int:user_id>',\n           methods=['POST'])\n@login_required\n"
+            "def login(user_id,\n          remember=False):\n    return request.form['password']\n\n"
+            "class Handler(Base):\n    def handle(self, event):\n        return event\n\n"
+        )
+        samples = [("generated.py", block * 2000)]
+
+    for path, content in samples:
+        runs = 5
+        regex_time = timeit.timeit(lambda: summarize_file_regex(path, content), number=runs) / runs
+        ast_time = timeit.timeit(lambda: summarize_python_file(path, content), number=runs) / runs
+        print(f"{path}: {len(content) / 1024:.0f} KiB, regex {regex_time * 1000:.1f} ms, ast {ast_time * 1000:.1f} ms")
+
+    # Untrusted files packed with keywords must not make the signal scan quadratic: doubling the input should about
+    # double the time
+    times = []
+    for size in (64 * 1024, 128 * 1024):
+        content = "password" * (size // len("password"))
+        times.append(timeit.timeit(lambda: extract_signals(content, 'python'), number=1))
+        print(f"keyword-dense input: {size // 1024} KiB, signals {times[-1] * 1000:.1f} ms")
+    assert times[1] < max(times[0], 0.01) * 4, "signal scan time grows faster than the input"
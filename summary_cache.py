@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Default location and size of the on-disk summary cache, can be overridden with
+# SUMMARY_CACHE_PATH and SUMMARY_CACHE_MAX_MB
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "genai4dso", "summaries.sqlite")
+DEFAULT_CACHE_MAX_MB = 64
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+# Function to compute the git blob SHA of file content, matching the SHA in git tree entries
+def git_blob_sha(data):
+    return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+# Function to get the summary cache shared by all sessions
+def get_summary_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = SummaryCache(
+                os.getenv("SUMMARY_CACHE_PATH", DEFAULT_CACHE_PATH),
+                int(os.getenv("SUMMARY_CACHE_MAX_MB", DEFAULT_CACHE_MAX_MB)) * 1024 * 1024,
+            )
+        return _default_cache
+
+# Content-addressed cache of file summaries keyed by blob SHA and summarizer version.
+# Entries are evicted least recently used first once the stored summaries exceed max_bytes.
+# It also keeps a snapshot of the last analysis of each repository for incremental re-analysis.
+class SummaryCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_CACHE_MAX_MB * 1024 * 1024):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            " blob_sha TEXT NOT NULL,"
+            " version TEXT NOT NULL,"
+            " summary TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (blob_sha, version))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS summaries_last_used ON summaries (last_used)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS repo_snapshots ("
+            " repo_key TEXT PRIMARY KEY,"
+            " tree_sha TEXT NOT NULL,"
+            " entries TEXT NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get(self, blob_sha, version):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary FROM summaries WHERE blob_sha = ? AND version = ?",
+                (blob_sha, str(version)),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE summaries SET last_used = ? WHERE blob_sha = ? AND version = ?",
+                (time.time(), blob_sha, str(version)),
+            )
+            self._conn.commit()
+            return row[0]
+
+    def put(self, blob_sha, version, summary):
+        size = len(summary.encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO summaries (blob_sha, version, summary, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                (blob_sha, str(version), summary, size, time.time()),
+            )
+            self._evict()
+            self._conn.commit()
+
+    # Returns (tree_sha, {path: [blob_sha, summary]}) of the last analysis of a repository
+    def get_snapshot(self, repo_key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT tree_sha, entries FROM repo_snapshots WHERE repo_key = ?",
+                (repo_key,),
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def put_snapshot(self, repo_key, tree_sha, entries):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO repo_snapshots (repo_key, tree_sha, entries) VALUES (?, ?, ?)",
+                (repo_key, tree_sha, json.dumps(entries)),
+            )
+            self._conn.commit()
+
+    # Drop the least recently used entries until the cache fits in max_bytes
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM summaries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for blob_sha, version, size in self._conn.execute(
+            "SELECT blob_sha, version, size FROM summaries ORDER BY last_used ASC"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append((blob_sha, version))
+            total -= size
+        self._conn.executemany("DELETE FROM summaries WHERE blob_sha = ? AND version = ?", evicted)
@@ -1,22 +1,36 @@
 import json
 import requests
-from mistralai import Mistral, UserMessage
-from openai import OpenAI, AzureOpenAI
+from mistralai import UserMessage
 import streamlit as st
 
 import google.generativeai as genai
 
+from llm_clients import configure_google, get_async_azure_openai_client, get_async_http_client, get_async_mistral_client, get_async_openai_client, get_azure_openai_client, get_http_session, get_mistral_client, get_openai_client, google_request_options, provider_limit
+from llm_cache import cache_key, cached_generation, cached_stream, get_llm_cache
+from json_stream import parse_json_response
+
+# System prompt of the OpenAI and Azure OpenAI requests, shared by the sync, async and streaming variants so that they
+# share cache entries
+THREAT_MODEL_SYSTEM_PROMPT = "You are a helpful assistant designed to output JSON."
+
+# Title and table header of the Markdown threat model
+THREAT_MODEL_MARKDOWN_HEADER = (
+    "## Threat Model\n\n"
+    "| Threat Type | Scenario | Potential Impact |\n"
+    "|-------------|----------|------------------|\n"
+)
+
+# Function to convert one threat to a row of the Markdown threat model table, rows can be appended as threats are streamed
+def threat_markdown_row(threat):
+    return f"| {threat['Threat Type']} | {threat['Scenario']} | {threat['Potential Impact']} |\n"
+
 # Function to convert JSON to Markdown for display.
 def json_to_markdown(threat_model, improvement_suggestions):
-    markdown_output = "## Threat Model\n\n"
-
-    # Start the markdown table with headers
-    markdown_output += "| Threat Type | Scenario | Potential Impact |\n"
-    markdown_output += "|-------------|----------|------------------|\n"
+    markdown_output = THREAT_MODEL_MARKDOWN_HEADER
 
     # Fill the table rows with the threat model data
     for threat in threat_model:
-        markdown_output += f"| {threat['Threat Type']} | {threat['Scenario']} | {threat['Potential Impact']} |\n"
+        markdown_output += threat_markdown_row(threat)
 
     markdown_output += "\n\n## Improvement Suggestions\n\n"
     for suggestion in improvement_suggestions:
@@ -24,10 +38,38 @@ def json_to_markdown(threat_model, improvement_suggestions):
 
     return markdown_output
 
-# Function to create a prompt for generating a threat model
-def create_threat_model_prompt(app_type, authentication, internet_facing, sensitive_data, app_input,selected_data_classes,deployment_infra,data_storage_location):
+# Queries used to retrieve the code most relevant to each STRIDE category from the code index
+STRIDE_QUERIES = {
+    "Spoofing": "authentication login logout password credential token jwt session cookie oauth saml sso identity verify signature",
+    "Tampering": "input validation sanitize sql query insert update request body form upload deserialize integrity csrf",
+    "Repudiation": "audit log logging logger event record history trace timestamp",
+    "Information Disclosure": "secret key api token password encrypt decrypt crypto hash tls config env error exception debug response",
+    "Denial of Service": "rate limit timeout retry queue thread pool upload size limit loop cache memory",
+    "Elevation of Privilege": "admin role permission authorize access control acl rbac policy guard privilege exec system subprocess shell eval",
+}
+
+# Number of code chunks retrieved for each STRIDE category
+STRIDE_TOP_K = 4
+
+# Function to retrieve the indexed code most relevant to each STRIDE category, each chunk is shown once
+def retrieve_stride_context(code_index, top_k=STRIDE_TOP_K):
+    sections = []
+    seen = set()
+    for category, query in STRIDE_QUERIES.items():
+        chunks = [(path, text) for _, path, text in code_index.search(query, top_k) if (path, text) not in seen]
+        if chunks:
+            seen.update(chunks)
+            sections.append(f"### {category}\n" + "".join(text + "\n\n" for _, text in chunks))
+    return "\n".join(sections)
+
+# Function to create a prompt for generating a threat model.
+# When a code index of the repository is given, the code most relevant to each STRIDE category is added to the prompt.
+def create_threat_model_prompt(app_type, authentication, internet_facing, sensitive_data, app_input,selected_data_classes,deployment_infra,data_storage_location, code_index=None):
     # Convert the selected data classes to a comma-separated string
     data_classes_str = ", ".join(selected_data_classes) if selected_data_classes else "None"
+    relevant_code = ""
+    if code_index is not None and len(code_index):
+        relevant_code = "\nRELEVANT CODE BY STRIDE CATEGORY:\n" + retrieve_stride_context(code_index)
     prompt = f"""
 Act as a cyber security expert with more than 20 years experience of using the STRIDE threat modelling methodology to produce comprehensive threat models for a wide range of applications. Your task is to analyze the provided code summary, README content, and application description to produce a list of specific threats for the application.
 
@@ -46,6 +88,7 @@ SENSITIVE DATA: {sensitive_data}
 DATA CLASSES: {data_classes_str}
 CODE SUMMARY, README CONTENT, AND APPLICATION DESCRIPTION:
 {app_input}
+{relevant_code}
 
 Example of expected JSON response format:
 
@@ -78,6 +121,22 @@ Example of expected JSON response format:
 """
     return prompt
 
+# Function to compute the namespace of near-duplicate threat model lookups: the model and every part of the
+# prompt except the application description, which is the only input allowed to differ
+def similar_threat_model_namespace(model_key, threat_model_prompt, app_input):
+    return cache_key("threat_model", model_key, None, threat_model_prompt.replace(app_input, "", 1))
+
+# Function to find a threat model generated for a near-identical application description with the same other inputs.
+# Returns (similarity, model_output), model_output is None when no earlier description is similar enough.
+def get_similar_threat_model(model_key, threat_model_prompt, app_input, threshold=None):
+    namespace = similar_threat_model_namespace(model_key, threat_model_prompt, app_input)
+    return get_llm_cache().get_similar(namespace, app_input, threshold)
+
+def put_similar_threat_model(model_key, threat_model_prompt, app_input, model_output):
+    if model_output and model_output.get("threat_model"):
+        namespace = similar_threat_model_namespace(model_key, threat_model_prompt, app_input)
+        get_llm_cache().put_similar(namespace, app_input, model_output)
+
 def create_image_analysis_prompt():
     prompt = """
     You are a Senior Solution Architect tasked with explaining the following architecture diagram to
@@ -130,7 +189,7 @@ def get_image_analysis(api_key, model_name, prompt, base64_image):
         "max_tokens": 4000
     }
 
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
+    response = get_http_session().post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
 
     # Log the response for debugging
     try:
@@ -147,14 +206,15 @@ def get_image_analysis(api_key, model_name, prompt, base64_image):
 
 
 # Function to get threat model from the GPT response.
+@cached_generation("openai")
 def get_threat_model(api_key, model_name, prompt):
-    client = OpenAI(api_key=api_key)
+    client = get_openai_client(api_key)
 
     response = client.chat.completions.create(
         model=model_name,
         response_format={"type": "json_object"},
         messages=[
-            {"role": "system", "content": "You are a helpful assistant designed to output JSON."},
+            {"role": "system", "content": THREAT_MODEL_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ],
         max_tokens=4000,
@@ -167,18 +227,15 @@ def get_threat_model(api_key, model_name, prompt):
 
 
 # Function to get threat model from the Azure OpenAI response.
+@cached_generation("azure")
 def get_threat_model_azure(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, prompt):
-    client = AzureOpenAI(
-        azure_endpoint = azure_api_endpoint,
-        api_key = azure_api_key,
-        api_version = azure_api_version,
-    )
+    client = get_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version)
 
     response = client.chat.completions.create(
         model = azure_deployment_name,
         response_format={"type": "json_object"},
         messages=[
-            {"role": "system", "content": "You are a helpful assistant designed to output JSON."},
+            {"role": "system", "content": THREAT_MODEL_SYSTEM_PROMPT},
             {"role": "user", "content": prompt}
         ]
     )
@@ -190,8 +247,9 @@ def get_threat_model_azure(azure_api_endpoint, azure_api_key, azure_api_version,
 
 
 # Function to get threat model from the Google response.
+@cached_generation("google")
 def get_threat_model_google(google_api_key, google_model, prompt):
-    genai.configure(api_key=google_api_key)
+    configure_google(google_api_key)
     model = genai.GenerativeModel(
         google_model,
         generation_config={"response_mime_type": "application/json"})
@@ -199,7 +257,8 @@ def get_threat_model_google(google_api_key, google_model, prompt):
         prompt,
         safety_settings={
             'DANGEROUS': 'block_only_high' # Set safety filter to allow generation of threat models
-        })
+        },
+        request_options=google_request_options())
     try:
         # Access the JSON content from the 'parts' attribute of the 'content' object
         response_content = json.loads(response.candidates[0].content.parts[0].text)
@@ -212,8 +271,9 @@ def get_threat_model_google(google_api_key, google_model, prompt):
     return response_content
 
 # Function to get threat model from the Mistral response.
+@cached_generation("mistral")
 def get_threat_model_mistral(mistral_api_key, mistral_model, prompt):
-    client = Mistral(api_key=mistral_api_key)
+    client = get_mistral_client(mistral_api_key)
 
     response = client.chat.complete(
         model = mistral_model,
@@ -229,6 +289,7 @@ def get_threat_model_mistral(mistral_api_key, mistral_model, prompt):
     return response_content
 
 # Function to get threat model from Ollama hosted LLM.
+@cached_generation("ollama")
 def get_threat_model_ollama(ollama_model, prompt):
 
     url = "http://localhost:11434/api/generate"
@@ -240,10 +301,209 @@ def get_threat_model_ollama(ollama_model, prompt):
         "stream": False
     }
 
-    response = requests.post(url, json=data)
+    response = get_http_session().post(url, json=data)
 
     outer_json = response.json()
 
     inner_json = json.loads(outer_json['response'])
 
     return inner_json
+
+# Async variants of the functions above, for running several generations at once from one event loop.
+# Each provider's requests are limited by its semaphore in llm_clients.
+
+@cached_generation("openai")
+async def get_threat_model_async(api_key, model_name, prompt):
+    client = get_async_openai_client(api_key)
+
+    async with provider_limit("openai"):
+        response = await client.chat.completions.create(
+            model=model_name,
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": THREAT_MODEL_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=4000,
+        )
+
+    # Convert the JSON string in the 'content' field to a Python dictionary
+    response_content = json.loads(response.choices[0].message.content)
+
+    return response_content
+
+@cached_generation("azure")
+async def get_threat_model_azure_async(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, prompt):
+    client = get_async_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version)
+
+    async with provider_limit("azure"):
+        response = await client.chat.completions.create(
+            model = azure_deployment_name,
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": THREAT_MODEL_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
+        )
+
+    # Convert the JSON string in the 'content' field to a Python dictionary
+    response_content = json.loads(response.choices[0].message.content)
+
+    return response_content
+
+@cached_generation("google")
+async def get_threat_model_google_async(google_api_key, google_model, prompt):
+    configure_google(google_api_key)
+    model = genai.GenerativeModel(
+        google_model,
+        generation_config={"response_mime_type": "application/json"})
+
+    async with provider_limit("google"):
+        response = await model.generate_content_async(
+            prompt,
+            safety_settings={
+                'DANGEROUS': 'block_only_high' # Set safety filter to allow generation of threat models
+            },
+            request_options=google_request_options())
+    try:
+        # Access the JSON content from the 'parts' attribute of the 'content' object
+        response_content = json.loads(response.candidates[0].content.parts[0].text)
+    except json.JSONDecodeError as e:
+        print(f"Error decoding JSON: {str(e)}")
+        print("Raw JSON string:")
+        print(response.candidates[0].content.parts[0].text)
+        return None
+
+    return response_content
+
+@cached_generation("mistral")
+async def get_threat_model_mistral_async(mistral_api_key, mistral_model, prompt):
+    client = get_async_mistral_client(mistral_api_key)
+
+    async with provider_limit("mistral"):
+        response = await client.chat.complete_async(
+            model = mistral_model,
+            response_format={"type": "json_object"},
+            messages=[
+                UserMessage(content=prompt)
+            ]
+        )
+
+    # Convert the JSON string in the 'content' field to a Python dictionary
+    response_content = json.loads(response.choices[0].message.content)
+
+    return response_content
+
+@cached_generation("ollama")
+async def get_threat_model_ollama_async(ollama_model, prompt):
+    url = "http://localhost:11434/api/generate"
+
+    data = {
+        "model": ollama_model,
+        "prompt": prompt,
+        "format": "json",
+        "stream": False
+    }
+
+    async with provider_limit("ollama"):
+        response = await get_async_http_client().post(url, json=data)
+
+    outer_json = response.json()
+
+    inner_json = json.loads(outer_json['response'])
+
+    return inner_json
+
+# Streaming variants of the functions above, yielding the JSON response text as it is generated so that
+# JsonArrayStream can parse each row as soon as it is complete.
+# They share their cache entries with the non-streaming functions.
+
+@cached_stream("openai", get_threat_model, postprocess=parse_json_response)
+def get_threat_model_stream(api_key, model_name, prompt):
+    client = get_openai_client(api_key)
+
+    with client.chat.completions.create(
+        model=model_name,
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": THREAT_MODEL_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=4000,
+        stream=True,
+    ) as stream:
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+@cached_stream("azure", get_threat_model_azure, postprocess=parse_json_response)
+def get_threat_model_azure_stream(azure_api_endpoint, azure_api_key, azure_api_version, azure_deployment_name, prompt):
+    client = get_azure_openai_client(azure_api_endpoint, azure_api_key, azure_api_version)
+
+    with client.chat.completions.create(
+        model = azure_deployment_name,
+        response_format={"type": "json_object"},
+        messages=[
+            {"role": "system", "content": THREAT_MODEL_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        stream=True,
+    ) as stream:
+        for chunk in stream:
+            # Azure sends chunks without choices for its content filter results
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+@cached_stream("google", get_threat_model_google, postprocess=parse_json_response)
+def get_threat_model_google_stream(google_api_key, google_model, prompt):
+    configure_google(google_api_key)
+    model = genai.GenerativeModel(
+        google_model,
+        generation_config={"response_mime_type": "application/json"})
+    response = model.generate_content(
+        prompt,
+        safety_settings={
+            'DANGEROUS': 'block_only_high' # Set safety filter to allow generation of threat models
+        },
+        stream=True,
+        request_options=google_request_options())
+    for chunk in response:
+        if chunk.parts:
+            yield chunk.text
+
+@cached_stream("mistral", get_threat_model_mistral, postprocess=parse_json_response)
+def get_threat_model_mistral_stream(mistral_api_key, mistral_model, prompt):
+    client = get_mistral_client(mistral_api_key)
+
+    stream = client.chat.stream(
+        model = mistral_model,
+        response_format={"type": "json_object"},
+        messages=[
+            UserMessage(content=prompt)
+        ]
+    )
+    for event in stream:
+        if event.data.choices and event.data.choices[0].delta.content:
+            yield event.data.choices[0].delta.content
+
+@cached_stream("ollama", get_threat_model_ollama, postprocess=parse_json_response)
+def get_threat_model_ollama_stream(ollama_model, prompt):
+    url = "http://localhost:11434/api/generate"
+
+    data = {
+        "model": ollama_model,
+        "prompt": prompt,
+        "format": "json",
+        "stream": True
+    }
+
+    # Ollama streams one JSON object per line, the last one has "done" set
+    with get_http_session().post(url, json=data, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if line:
+                message = json.loads(line)
+                if message.get("response"):
+                    yield message["response"]
+                if message.get("done"):
+                    break